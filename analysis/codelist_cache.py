@@ -0,0 +1,169 @@
+# COMPILED CODELIST CACHE
+#
+# Parsing the CSVs in codelists/ with codelist_from_csv is the bulk of the
+# cost of importing codelists.py. Each CSV is compiled once into a compact
+# binary form (deduplicated code array plus category array) which is keyed by
+# the sha1 of the CSV's content, and reloaded from there on later imports. A
+# cache entry is rebuilt whenever the content of the CSV changes; while the
+# CSV's size and mtime are those the entry was built from, it is not hashed
+# again. (The shas in codelists/codelists.json are not used: for some files
+# they are not the sha1 of the CSV as checked out.)
+#
+# Codelists come back as CompactCodelist: unique codes in sorted order, so the
+# code sets sent to the extractor carry no duplicate rows and membership is a
+# binary search over the list itself.
+
+import hashlib
+import os
+import pickle
+from array import array
+from bisect import bisect_left
+
+from cohortextractor import codelist_from_csv
+from cohortextractor.codelistlib import Codelist, check_categories_consistent
+
+CODELIST_DIR = "codelists"
+CACHE_DIR = os.environ.get("CODELIST_CACHE_DIR", os.path.join(CODELIST_DIR, ".cache"))
+
+# bump this whenever the layout of a cache entry changes
+FORMAT_VERSION = 3
+
+
+class CompactCodelist(Codelist):
+    """Codelist holding each code (or code, category pair) once, sorted.
+
+    `duplicates_collapsed` is the number of repeated rows dropped when the
+    codelist was loaded - many CSVs list the same code once per source (eg
+    CTV3Map_Code_And_Term, CTV3Map_Code_Only and QOF).
+    """
+
+    duplicates_collapsed = 0
+
+    def __contains__(self, item):
+        try:
+            i = bisect_left(self, item)
+        except TypeError:
+            # eg a bare code looked up in a categorised codelist
+            return False
+        return i < len(self) and self[i] == item
+
+    def has_code(self, code):
+        if not self.has_categories:
+            return code in self
+        # (code,) sorts immediately before every (code, category) pair
+        i = bisect_left(self, (code,))
+        return i < len(self) and self[i][0] == code
+
+
+def compact_codelist(codes, system, duplicates_collapsed=0):
+    """Build a CompactCodelist from codes which are already unique and sorted."""
+    codes = CompactCodelist(codes)
+    codes.system = system
+    codes.duplicates_collapsed = duplicates_collapsed
+    codes.has_categories = bool(codes) and isinstance(codes[0], tuple)
+    if codes.has_categories:
+        check_categories_consistent(codes)
+    return codes
+
+
+def file_sha(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_path(filename, column, category_column):
+    # the same CSV can be read with different columns, so they are part of the key
+    name = os.path.basename(filename)
+    return os.path.join(CACHE_DIR, f"{name}.{column}.{category_column or '-'}.bin")
+
+
+def compile_codelist(codes, has_categories):
+    """Return the compact cache payload for a parsed codelist."""
+    rows = sorted(set(codes))
+    duplicates_collapsed = len(codes) - len(rows)
+    if not has_categories:
+        return {
+            "codes": "\n".join(rows).encode("utf8"),
+            "categories": None,
+            "duplicates_collapsed": duplicates_collapsed,
+        }
+
+    labels = sorted({category for _, category in rows})
+    lookup = {label: i for i, label in enumerate(labels)}
+    index = array("B" if len(labels) < 256 else "H", (lookup[c] for _, c in rows))
+    return {
+        "codes": "\n".join(code for code, _ in rows).encode("utf8"),
+        "categories": (labels, index.typecode, index.tobytes()),
+        "duplicates_collapsed": duplicates_collapsed,
+    }
+
+
+def load_codelist(payload, system):
+    codes = payload["codes"].decode("utf8").split("\n")
+    if payload["categories"] is not None:
+        labels, typecode, data = payload["categories"]
+        index = array(typecode)
+        index.frombytes(data)
+        # every pair shares one string object per category label
+        codes = list(zip(codes, (labels[i] for i in index)))
+    return compact_codelist(codes, system, payload["duplicates_collapsed"])
+
+
+def read_entry(path):
+    try:
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(entry, dict) or entry.get("version") != FORMAT_VERSION:
+        return None
+    return entry
+
+
+def write_entry(path, entry):
+    # the cache is an optimisation only, so a read-only checkout just means
+    # every import falls back to parsing the CSV
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def cached_codelist_from_csv(filename, system, column="code", category_column=None):
+    """Drop-in replacement for cohortextractor's codelist_from_csv.
+
+    The result is read from the compiled cache when the entry for this file
+    was built from a CSV with the same content sha1, and is compiled (and
+    cached) from the CSV otherwise.
+    """
+    path = cache_path(filename, column, category_column)
+    st = os.stat(filename)
+    stat = (st.st_size, st.st_mtime_ns)
+
+    entry = read_entry(path)
+    if entry is not None and entry["stat"] == stat:
+        sha = entry["sha"]
+    else:
+        # fresh checkout or local edit: trust the entry only if the content
+        # still hashes to what it was compiled from
+        sha = file_sha(filename)
+        if entry is not None and entry["sha"] == sha:
+            entry["stat"] = stat
+            write_entry(path, entry)
+
+    if entry is None or entry["sha"] != sha:
+        codes = codelist_from_csv(filename, system, column, category_column)
+        entry = {
+            "version": FORMAT_VERSION,
+            "sha": sha,
+            "stat": stat,
+            "system": system,
+            **compile_codelist(codes, codes.has_categories),
+        }
+        write_entry(path, entry)
+
+    return load_codelist(entry, system)
@@ -1,15 +1,13 @@
 from cohortextractor import (
-    codelist_from_csv,
     combine_codelists,
     codelist,
 )
 
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity-snomed-0removed.csv",
-    system="snomed",
-    column="snomedcode",
-    category_column="Grouping_6",
-    )
+# CSVs are compiled once and then read from codelists/.cache - see codelist_cache.py
+from codelist_cache import (
+    cached_codelist_from_csv as codelist_from_csv,
+    compact_codelist,
+)
 
 high_risk_codes = codelist(
     ['1300561000000107'], 
@@ -21,13 +19,6 @@ not_high_risk_codes = codelist(
     system="snomed",
     )
 
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
 systolic_blood_pressure_codes = codelist(
     ["2469."], 
     system="ctv3",
@@ -48,202 +39,258 @@ hba1c_old_codes = codelist(
     system="ctv3",
     )
 
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-copd_codes = codelist_from_csv(    
-    "codelists/opensafely-current-copd.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-other_respiratory_codes = codelist_from_csv(
-    "codelists/opensafely-other-respiratory-conditions.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-asthma_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-diagnosis.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-chronic_respiratory_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-pred_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-oral-prednisolone-medication.csv",
-    system="snomed",
-    column="snomed_id",
-    )
-
-lung_cancer_codes = codelist_from_csv( 
-    "codelists/opensafely-lung-cancer.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-haem_cancer_codes = codelist_from_csv( 
-    "codelists/opensafely-haematological-cancer.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-hiv_codes = codelist_from_csv(
-    "codelists/opensafely-hiv.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-permanent_immune_codes = codelist_from_csv(
-    "codelists/opensafely-permanent-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-sickle_cell_codes = codelist_from_csv(
-    "codelists/opensafely-sickle-cell-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-spleen_codes = codelist_from_csv(
-    "codelists/opensafely-asplenia.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-temp_immune_codes = codelist_from_csv(
-    "codelists/opensafely-temporary-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-organ_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-solid-organ-transplantation.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-aplastic_codes = codelist_from_csv(
-    "codelists/opensafely-aplastic-anaemia.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-af_codes = codelist_from_csv(
-    "codelists/opensafely-atrial-fibrillation-clinical-finding.csv",
-    system="ctv3",
-    column="CTV3Code",
-    )
-
-pad_codes = codelist_from_csv(
-    "codelists/opensafely-peripheral-arterial-disease.csv",
-    system="ctv3",
-    column="code",
-    )
-
-heart_failure_codes = codelist_from_csv(
-    "codelists/opensafely-heart-failure.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-mi_codes = codelist_from_csv(
-    "codelists/opensafely-myocardial-infarction.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-vte_codes = codelist_from_csv(
-    "codelists/opensafely-venous-thromboembolic-disease.csv",
-    system="ctv3",
-    column="CTV3Code",
-    )
-
-chd_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-stroke_codes = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-tia_codes = codelist_from_csv(
-    "codelists/opensafely-transient-ischaemic-attack.csv",
-    system="ctv3",
-    column="code",
-    )
-
-dementia_codes = codelist_from_csv(
-    "codelists/opensafely-dementia-complete.csv",
-    system="ctv3",
-    column="code",
-    )
-
-liver_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-other_neuro_codes = codelist_from_csv(
-    "codelists/opensafely-other-neurological-conditions.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-rheumatoid_arthritis_codes = codelist_from_csv(
-    "codelists/opensafely-rheumatoid-arthritis.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-sle_codes = codelist_from_csv(
-    "codelists/opensafely-systemic-lupus-erythematosus-sle.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-psoriasis_codes = codelist_from_csv(
-    "codelists/opensafely-psoriasis.csv",
-    system="ctv3",
-    column="code",
-    )
-
-dialysis_codes = codelist_from_csv(
-    "codelists/opensafely-dialysis.csv",
-    system="ctv3",
-    column="CTV3ID",
-    )
-
-creatinine_codes = codelist_from_csv(
-    "codelists/user-bangzheng-creatinine-value.csv",
-    system="snomed",
-    column="code",
-    )
-
-
+# Codelists read from CSV are only loaded when they are first used (PEP 562
+# module __getattr__), so a consumer that needs a handful of them does not pay
+# for reading all of them.
+CSV_CODELISTS = {
+    "ethnicity_codes": dict(
+        filename="codelists/opensafely-ethnicity-snomed-0removed.csv",
+        system="snomed",
+        column="snomedcode",
+        category_column="Grouping_6",
+    ),
+    "clear_smoking_codes": dict(
+        filename="codelists/opensafely-smoking-clear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+    "diabetes_codes": dict(
+        filename="codelists/opensafely-diabetes.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "hypertension_codes": dict(
+        filename="codelists/opensafely-hypertension.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "copd_codes": dict(
+        filename="codelists/opensafely-current-copd.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "other_respiratory_codes": dict(
+        filename="codelists/opensafely-other-respiratory-conditions.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "asthma_codes": dict(
+        filename="codelists/opensafely-asthma-diagnosis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "chronic_respiratory_disease_codes": dict(
+        filename="codelists/opensafely-chronic-respiratory-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "pred_codes": dict(
+        filename="codelists/opensafely-asthma-oral-prednisolone-medication.csv",
+        system="snomed",
+        column="snomed_id",
+    ),
+    "lung_cancer_codes": dict(
+        filename="codelists/opensafely-lung-cancer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "haem_cancer_codes": dict(
+        filename="codelists/opensafely-haematological-cancer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "other_cancer_codes": dict(
+        filename="codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "hiv_codes": dict(
+        filename="codelists/opensafely-hiv.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "permanent_immune_codes": dict(
+        filename="codelists/opensafely-permanent-immunosuppression.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "sickle_cell_codes": dict(
+        filename="codelists/opensafely-sickle-cell-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "spleen_codes": dict(
+        filename="codelists/opensafely-asplenia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "temp_immune_codes": dict(
+        filename="codelists/opensafely-temporary-immunosuppression.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "organ_transplant_codes": dict(
+        filename="codelists/opensafely-solid-organ-transplantation.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "aplastic_codes": dict(
+        filename="codelists/opensafely-aplastic-anaemia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "af_codes": dict(
+        filename="codelists/opensafely-atrial-fibrillation-clinical-finding.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "pad_codes": dict(
+        filename="codelists/opensafely-peripheral-arterial-disease.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "heart_failure_codes": dict(
+        filename="codelists/opensafely-heart-failure.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "mi_codes": dict(
+        filename="codelists/opensafely-myocardial-infarction.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "vte_codes": dict(
+        filename="codelists/opensafely-venous-thromboembolic-disease.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "chd_codes": dict(
+        filename="codelists/opensafely-chronic-cardiac-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "stroke_codes": dict(
+        filename="codelists/opensafely-stroke-updated.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "tia_codes": dict(
+        filename="codelists/opensafely-transient-ischaemic-attack.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "dementia_codes": dict(
+        filename="codelists/opensafely-dementia-complete.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "liver_codes": dict(
+        filename="codelists/opensafely-chronic-liver-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "other_neuro_codes": dict(
+        filename="codelists/opensafely-other-neurological-conditions.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "rheumatoid_arthritis_codes": dict(
+        filename="codelists/opensafely-rheumatoid-arthritis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "sle_codes": dict(
+        filename="codelists/opensafely-systemic-lupus-erythematosus-sle.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "psoriasis_codes": dict(
+        filename="codelists/opensafely-psoriasis.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "dialysis_codes": dict(
+        filename="codelists/opensafely-dialysis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "creatinine_codes": dict(
+        filename="codelists/user-bangzheng-creatinine-value.csv",
+        system="snomed",
+        column="code",
+    ),
+}
+
+# Unions of the codelists above used by the study definition, each built (and
+# deduplicated) once per process by union_codelists.
+COMBINED_CODELISTS = {
+    "non_haem_cancer_codes": ("lung_cancer_codes", "other_cancer_codes"),
+    "permanent_immunodeficiency_codes": (
+        "hiv_codes",
+        "permanent_immune_codes",
+        "sickle_cell_codes",
+    ),
+}
+
+# `from codelists import *` only pulls in what is cheap to build; import the CSV
+# codelists you need by name.
+__all__ = [
+    "combine_codelists",
+    "union_codelists",
+    "codelist",
+    "high_risk_codes",
+    "not_high_risk_codes",
+    "systolic_blood_pressure_codes",
+    "diastolic_blood_pressure_codes",
+    "hba1c_new_codes",
+    "hba1c_old_codes",
+]
+
+
+_unions = {}
+
+
+def union_codelists(*codelists):
+    """Memoised combine_codelists.
+
+    Results are cached on the identities of the input codelists (the cache
+    keeps a reference to the inputs, so the identities stay valid), and come
+    back as a sorted, deduplicated CompactCodelist.
+    """
+    key = tuple(map(id, codelists))
+    if key not in _unions:
+        combined = sorted(combine_codelists(*codelists))
+        collapsed = sum(len(codes) for codes in codelists) - len(combined)
+        _unions[key] = (
+            codelists,
+            compact_codelist(combined, codelists[0].system, collapsed),
+        )
+    return _unions[key][1]
+
+
+def __getattr__(name):
+    if name in CSV_CODELISTS:
+        value = codelist_from_csv(**CSV_CODELISTS[name])
+    elif name in COMBINED_CODELISTS:
+        value = union_codelists(*map(_lookup, COMBINED_CODELISTS[name]))
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def _lookup(name):
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+def duplicate_report():
+    """Return {name: number of duplicate rows collapsed} for the CSV codelists."""
+    report = {}
+    for name in CSV_CODELISTS:
+        report[name] = _lookup(name).duplicates_collapsed
+    return report
+
+
+def __dir__():
+    return sorted(set(globals()) | set(CSV_CODELISTS) | set(COMBINED_CODELISTS))
@@ -0,0 +1,279 @@
+# TYPED COLUMNAR COHORT OUTPUT
+#
+# Converts the extracted cohort (output/input.csv) into an Arrow IPC / Feather
+# v2 file with typed columns, so later steps don't re-parse ~60 text columns:
+#   - YYYY-MM-DD and YYYY-MM dates -> date32 (month-only dates on the 1st)
+#   - 0/1 flags                    -> int8
+#   - other integers               -> the narrowest of int8/16/32/64, but ids
+#                                     (patient_id, household_id) always int64
+#   - decimals                     -> float64
+#   - low-cardinality strings      -> dictionary-encoded (eg sex, region, stp)
+#   - declared categories          -> dictionary-encoded, even if they are
+#                                     numbers (eg asthma's 0, 1 and 2)
+# The CSV is streamed twice in blocks: once to settle each column's type (and
+# the full dictionary of every categorical column) and once to convert, so a
+# column's type can only depend on its values where nothing fixes it. The
+# file is written uncompressed by default so read_cohort() can memory-map it
+# and load only the columns it is asked for.
+#
+# A categorical variable's codes follow the order of the categories declared
+# for it in study_definition.py, with any other values after them (sorted), so
+# a label has the same code in every extract. The labels of every categorical
+# column are written to a sidecar JSON file, {variable: [label of code 0, ...]},
+# and with --codes the columns are written as plain int8/int16 codes (-1 for
+# blank) rather than as Arrow dictionaries, for steps that only need the codes.
+#
+# Usage: python analysis/cohort_arrow.py [--input output/input.csv]
+#            [--output output/input.feather] [--compression lz4]
+#            [--labels output/input_labels.json] [--codes]
+
+import argparse
+import csv
+import json
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+from pyarrow import feather
+
+from study_parameters import categorical_variables
+
+DATE = r"^\d{4}-\d{2}-\d{2}$"
+MONTH = r"^\d{4}-\d{2}$"
+INT = r"^[+-]?\d+$"
+FLOAT = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+
+# string columns with more distinct values than this are kept as plain strings
+MAX_CATEGORIES = 1000
+
+# columns with the same type in every extract, whatever their values
+ID_TYPES = {"patient_id": pa.int64(), "household_id": pa.int64()}
+
+BLOCK_SIZE = 16 << 20
+
+
+def open_as_strings(path):
+    """Stream `path` in record batches with every column read as a string."""
+    with open(path, newline="") as f:
+        names = next(csv.reader(f))
+    return pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in names},
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def all_match(values, pattern):
+    return len(values) == 0 or pc.all(pc.match_substring_regex(values, pattern)).as_py()
+
+
+def parses_as(values, type_):
+    try:
+        return values.cast(type_)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+
+
+class ColumnType:
+    """Running type inference for one column over successive blocks."""
+
+    def __init__(self, declared=(), int_type=None):
+        # categories study_definition.py declares, which get the first codes;
+        # a column declaring them is categorical, whatever its values look like
+        self.declared = [str(category) for category in declared]
+        if self.declared:
+            self.kinds = ["category"]
+        else:
+            self.kinds = ["date", "month", "int", "float", "category"]
+        # the type of an int column, rather than the narrowest that fits
+        self.int_type = int_type
+        self.min = self.max = None
+        self.categories = set()
+        self.seen_values = False
+        self._dictionary = None
+
+    def update(self, column):
+        values = column.drop_null()
+        if len(values) == 0:
+            return
+        self.seen_values = True
+        # a failed cast over a whole block is slow, so rule kinds out on the
+        # first value before checking them against every value
+        first = values[0].as_py()
+        for kind, pattern in (
+            ("date", DATE),
+            ("month", MONTH),
+            ("int", INT),
+            ("float", FLOAT),
+        ):
+            if kind in self.kinds and not re.match(pattern, first):
+                self.kinds.remove(kind)
+        if "date" in self.kinds and not all_match(values, DATE):
+            self.kinds.remove("date")
+        if "month" in self.kinds and not all_match(values, MONTH):
+            self.kinds.remove("month")
+        if "int" in self.kinds:
+            ints = parses_as(values, pa.int64())
+            if ints is None:
+                self.kinds.remove("int")
+            else:
+                lo, hi = pc.min_max(ints).values()
+                self.min = lo.as_py() if self.min is None else min(self.min, lo.as_py())
+                self.max = hi.as_py() if self.max is None else max(self.max, hi.as_py())
+        if "float" in self.kinds and parses_as(values, pa.float64()) is None:
+            self.kinds.remove("float")
+        if "category" in self.kinds:
+            self.categories.update(pc.unique(values).to_pylist())
+            if len(self.categories) > MAX_CATEGORIES:
+                self.kinds.remove("category")
+                self.categories = set()
+
+    def arrow_type(self):
+        kind = self.kind()
+        if kind in ("date", "month"):
+            return pa.date32()
+        if kind == "int":
+            if self.int_type is not None:
+                return self.int_type
+            for type_ in (pa.int8(), pa.int16(), pa.int32()):
+                bits = type_.bit_width - 1
+                if -(2**bits) <= self.min and self.max < 2**bits:
+                    return type_
+            return pa.int64()
+        if kind == "float":
+            return pa.float64()
+        if kind == "category":
+            return pa.dictionary(self.index_type(), pa.string())
+        return pa.string()
+
+    def kind(self):
+        if not self.seen_values and not self.declared:
+            # nothing but blanks: keep the column, but as (null) flags
+            return "int"
+        return self.kinds[0] if self.kinds else "string"
+
+    def index_type(self):
+        return pa.int8() if len(self.labels()) < 128 else pa.int16()
+
+    def labels(self):
+        """The declared categories then the other values seen, sorted."""
+        others = sorted(self.categories.difference(self.declared))
+        return self.declared + others
+
+    def dictionary(self):
+        if self._dictionary is None:
+            self._dictionary = pa.array(self.labels(), pa.string())
+        return self._dictionary
+
+
+def infer_schema(path):
+    declared = categorical_variables()
+    types = {}
+    for batch in open_as_strings(path):
+        for name, column in zip(batch.schema.names, batch.columns):
+            if name not in types:
+                types[name] = ColumnType(declared.get(name, ()), ID_TYPES.get(name))
+            types[name].update(column)
+    for column_type in types.values():
+        if column_type.min is None:
+            column_type.min = column_type.max = 0
+    return types
+
+
+def convert_column(column, column_type, codes=False):
+    kind = column_type.kind()
+    if kind == "date":
+        return pc.strptime(column, format="%Y-%m-%d", unit="s").cast(pa.date32())
+    if kind == "month":
+        return pc.strptime(column, format="%Y-%m", unit="s").cast(pa.date32())
+    if kind == "category":
+        dictionary = column_type.dictionary()
+        indices = pc.index_in(column, value_set=dictionary)
+        indices = indices.cast(column_type.index_type())
+        if codes:
+            return indices.fill_null(-1)
+        return pa.DictionaryArray.from_arrays(indices, dictionary)
+    return column.cast(column_type.arrow_type())
+
+
+def column_schema(types, codes=False):
+    fields = []
+    for name, column_type in types.items():
+        if codes and column_type.kind() == "category":
+            fields.append((name, column_type.index_type()))
+        else:
+            fields.append((name, column_type.arrow_type()))
+    return pa.schema(fields)
+
+
+def convert(
+    input_path, output_path, compression="uncompressed", labels_path=None, codes=False
+):
+    """Write `input_path` to `output_path` as typed Arrow; return the schema.
+
+    The labels of the categorical columns are written to `labels_path`, if
+    given; with `codes`, those columns are written as plain integer codes.
+    """
+    types = infer_schema(input_path)
+    schema = column_schema(types, codes)
+    if labels_path is not None:
+        write_labels(labels_path, types)
+    options = pa.ipc.IpcWriteOptions(
+        compression=None if compression == "uncompressed" else compression
+    )
+    with pa.ipc.new_file(output_path, schema, options=options) as writer:
+        for batch in open_as_strings(input_path):
+            columns = [
+                convert_column(column, types[name], codes)
+                for name, column in zip(batch.schema.names, batch.columns)
+            ]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+    return schema
+
+
+def write_labels(path, types):
+    labels = {
+        name: column_type.labels()
+        for name, column_type in types.items()
+        if column_type.kind() == "category"
+    }
+    with open(path, "w") as f:
+        json.dump(labels, f, indent=2)
+
+
+def read_cohort(path="output/input.feather", columns=None):
+    """Memory-map the typed cohort and return (only) the requested columns."""
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+
+def read_labels(path="output/input_labels.json"):
+    """{variable: [label of code 0, ...]} for the cohort's categorical columns."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument(
+        "--compression", default="uncompressed", choices=["uncompressed", "lz4", "zstd"]
+    )
+    parser.add_argument("--labels", default="output/input_labels.json")
+    parser.add_argument(
+        "--codes", action="store_true", help="write categories as plain integer codes"
+    )
+    args = parser.parse_args()
+
+    schema = convert(args.input, args.output, args.compression, args.labels, args.codes)
+    print(f"wrote {len(schema)} typed columns to {args.output}")
+    for field in schema:
+        print(f"  {field.name}: {field.type}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# CHUNKED COHORT OUTPUT
+#
+# Splits the extracted cohort (output/input.csv) into numbered part-files of
+# at most --rows-per-chunk rows each, plus a manifest.json recording the
+# columns and the row count of every part. Rows are streamed through as raw
+# text, so peak memory is bounded by a single row rather than the cohort size,
+# and downstream steps can use iter_chunks() to process one part at a time.
+# Any part-files and manifest already in the output directory are removed
+# first, so no part of an earlier, longer cohort is left behind.
+#
+# Usage: python analysis/cohort_chunks.py [--input output/input.csv]
+#            [--output-dir output/input_chunks] [--rows-per-chunk 250000]
+
+import argparse
+import csv
+import glob
+import json
+import os
+
+MANIFEST = "manifest.json"
+
+
+def chunk_name(i):
+    return f"part-{i:05d}.csv"
+
+
+def remove_chunks(chunk_dir):
+    """Remove the part-files and manifest in `chunk_dir`, if any."""
+    for path in glob.glob(os.path.join(chunk_dir, "part-*.csv")) + [
+        os.path.join(chunk_dir, MANIFEST)
+    ]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def records(f):
+    """Yield the raw text of each CSV record in `f`.
+
+    Records are copied through without being parsed. A quoted field can
+    contain a newline, so lines are joined until their quotes balance.
+    """
+    record = ""
+    for line in f:
+        record += line
+        if record.count('"') % 2 == 0:
+            yield record
+            record = ""
+    if record:
+        yield record
+
+
+def write_chunks(input_path, output_dir, rows_per_chunk):
+    """Stream `input_path` into part-files in `output_dir` and return the manifest."""
+    if rows_per_chunk < 1:
+        raise ValueError("rows_per_chunk must be at least 1")
+    chunks = []
+    with open(input_path, newline="") as f:
+        rows = records(f)
+        header_line = next(rows, None)
+        if header_line is None:
+            raise ValueError(f"{input_path} is empty: it has no header row")
+        os.makedirs(output_dir, exist_ok=True)
+        remove_chunks(output_dir)
+        out = None
+        for row in rows:
+            if out is None or chunks[-1]["rows"] == rows_per_chunk:
+                if out is not None:
+                    out.close()
+                chunks.append({"file": chunk_name(len(chunks)), "rows": 0})
+                out = open(
+                    os.path.join(output_dir, chunks[-1]["file"]), "w", newline=""
+                )
+                out.write(header_line)
+            out.write(row)
+            chunks[-1]["rows"] += 1
+        if out is not None:
+            out.close()
+
+    header = next(csv.reader([header_line]))
+
+    manifest = {
+        "source": os.path.basename(input_path),
+        "columns": header,
+        "rows_per_chunk": rows_per_chunk,
+        "rows": sum(chunk["rows"] for chunk in chunks),
+        "chunks": chunks,
+    }
+    with open(os.path.join(output_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_manifest(chunk_dir):
+    with open(os.path.join(chunk_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def iter_chunks(chunk_dir, **read_csv_kwargs):
+    """Yield the parts listed in the manifest one at a time as DataFrames."""
+    import pandas as pd
+
+    for chunk in read_manifest(chunk_dir)["chunks"]:
+        yield pd.read_csv(os.path.join(chunk_dir, chunk["file"]), **read_csv_kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--output-dir", default="output/input_chunks")
+    parser.add_argument("--rows-per-chunk", type=int, default=250_000)
+    args = parser.parse_args()
+
+    manifest = write_chunks(args.input, args.output_dir, args.rows_per_chunk)
+    print(
+        f"wrote {manifest['rows']} rows in {len(manifest['chunks'])} chunks "
+        f"to {args.output_dir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
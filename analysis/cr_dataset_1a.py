@@ -0,0 +1,613 @@
+# CREATE THE OBJECTIVE 1A DATASET
+#
+# Python port of cr_dataset_1a.do. Reads output/input.csv, applies the same
+# cohort restrictions, date conversion, recodes and categorisations with
+# whole-column pandas/NumPy operations, and writes a CSV laid out as Stata's
+# `export delimited` writes cr_dataset_1a.csv: the same columns in the same
+# order, dates as eg 01sep2022, and missing values as empty fields.
+#
+# Stata semantics kept on purpose:
+#   - decimals are imported as single precision floats (Stata's default type)
+#     but compared against double precision constants, eg bmi < 24.99999
+#   - a missing value is greater than any number, so eg `distance > 450` is
+#     true when there is no HbA1c date
+#   - `gen x = 1 if ...` leaves x missing (not 0) where the condition fails
+#   - columns are added at the end and renamed in place, as in Stata
+#   - rows are left sorted by obese4cat, as `bysort obese4cat` leaves them
+#
+# The ~35 `<var>_index` flags (onset on or before the index date) are not made
+# as columns: they are packed into the bits of one "onset" column (see
+# onset.py) and only written out as columns by export.
+#
+# The derivation is a list of stages, each taking and returning the dataset.
+# With --output-1b the stages of cr_dataset_1b.do follow on the 1a dataset in
+# memory, and the 1b dataset is written as well, rather than by importing
+# cr_dataset_1a.csv again. cr_dataset_1b.do converts covid_vax and
+# first_positive_test_date from the text of cr_dataset_1a.csv, which moves them
+# to the end of the dataset, and adds wave_test (see periods.py).
+#
+# --compare (and --compare-1b) checks the result against the Stata output,
+# column by column, and reports the columns which differ. Until the port has
+# been checked against Stata output from the real data, differences are only
+# reported (eg decimals are written at single precision, as Python repr()s
+# them, which may not be how Stata writes them); with --strict they fail the
+# action. With --compare-only the datasets already written to --output and
+# --output-1b are compared, without deriving them again, so the comparison can
+# be its own action, run only where the Stata outputs are available.
+#
+# Usage: python analysis/cr_dataset_1a.py [--input output/input.csv]
+#            [--output output/cr_dataset_1a_python.csv]
+#            [--output-1b output/cr_dataset_1b_python.csv]
+#            [--compare output/cr_dataset_1a.csv]
+#            [--compare-1b output/cr_dataset_1b.csv] [--report PATH] [--strict]
+#            [--compare-only]
+
+import argparse
+import csv
+import functools
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from dates import day_number, day_numbers, decode_date_matrix, to_datetime64
+from onset import COLUMN as ONSET_COLUMN
+from onset import OnsetFlags
+from periods import WAVES, PeriodBins, stata_values
+from recode import lookup, recode_table, unrecoded
+from study_parameters import index_date
+
+INDEX_DATE = pd.Timestamp(index_date())
+INDEX_DAY = day_number(index_date())  # 22889 in the do-file
+
+# date variables in the order cr_dataset_1a.do converts them
+DATE_VARIABLES = [
+    "covid_vax", "first_positive_test_date", "bmi_date_measured",
+    "smoking_status_date", "hypertension", "bp_sys_date_measured",
+    "bp_dias_date_measured", "dementia", "diabetes", "hba1c_mmol_per_mol_date",
+    "hba1c_percentage_date", "copd", "other_respiratory", "cancer", "haem_cancer",
+    "permanent_immunodeficiency", "transplant", "asplenia", "aplastic_anaemia",
+    "temporary_immunodeficiency", "heart_failure", "stroke", "tia",
+    "myocardial_infarct", "heart_disease", "pad", "vte", "af",
+    "systemic_lupus_erythematosus", "rheumatoid_arthritis", "psoriasis",
+    "chronic_liver_disease", "other_neuro", "creatinine_date", "dialysis",
+]  # fmt: skip
+
+RENAMED_DATES = {"systemic_lupus_erythematosus": "sle"}
+
+# one onset flag per date variable, named as the do-file names `<var>_index`
+ONSET = OnsetFlags([RENAMED_DATES.get(name, name) for name in DATE_VARIABLES])
+
+# onset flags dropped by cr_dataset_1a.do once they have been combined
+DROPPED_FLAGS = [
+    "other_respiratory", "copd", "hypertension", "sle", "rheumatoid_arthritis",
+    "psoriasis", "stroke", "dementia", "heart_disease", "myocardial_infarct",
+    "temporary_immunodeficiency", "permanent_immunodeficiency",
+]  # fmt: skip
+
+# date variables dropped at the end of cr_dataset_1a.do
+DROPPED_DATES = [
+    "bmi_date_measured", "smoking_status_date", "hypertension",
+    "bp_sys_date_measured", "bp_dias_date_measured", "dementia", "diabetes",
+    "hba1c_percentage_date", "copd", "other_respiratory", "haem_cancer",
+    "permanent_immunodeficiency", "transplant", "asplenia", "aplastic_anaemia",
+    "temporary_immunodeficiency", "heart_failure", "stroke", "tia",
+    "myocardial_infarct", "heart_disease", "pad", "vte", "af", "sle",
+    "rheumatoid_arthritis", "psoriasis", "chronic_liver_disease", "other_neuro",
+    "creatinine_date", "dialysis",
+]  # fmt: skip
+
+# the do-file's recodes of the categories declared in study_definition.py
+SMOKING = {"N": 1, "E": 2, "S": 3}
+AGEGROUP = {"18-39": 1, "40-49": 2, "50-59": 3, "60-69": 4, "70-79": 5, "80+": 6}
+SEX = {"M": 1, "F": 2}
+ETHNICITY = {"White": 1, "Black": 2, "South Asian": 3, "Mixed": 4, "Other": 5}
+REGION = {
+    "East Midlands": 1,
+    "East": 2,
+    "London": 3,
+    "North East": 4,
+    "North West": 5,
+    "South East": 6,
+    "West Midlands": 7,
+    "Yorkshire and The Humber": 8,
+}
+
+
+def log(message):
+    print(message, flush=True)
+
+
+# IMPORT
+
+
+def read_input(path):
+    """Read the cohort as Stata's `import delimited` would type it.
+
+    Text columns stay text, with empty strings for blanks. Numeric columns
+    become float64 with NaN for missing; columns holding decimals are rounded
+    to single precision first.
+    """
+    df = pd.read_csv(path, keep_default_na=False, na_values=[""], low_memory=False)
+    columns = {}
+    for name, column in df.items():
+        if column.dtype == object:
+            columns[name] = column.fillna("")
+        elif column.dtype.kind == "f" and (column.dropna() % 1 != 0).any():
+            columns[name] = column.astype(np.float32).astype(np.float64)
+        else:
+            columns[name] = column.astype(np.float64)
+    return pd.DataFrame(columns)
+
+
+def days_before_index(dates):
+    return (INDEX_DATE - dates).dt.days
+
+
+def onset(df, *names):
+    """True where any of the named dates is on or before the index date."""
+    return pd.Series(ONSET.any(df[ONSET_COLUMN].values, *names), index=df.index)
+
+
+def flag(condition):
+    """`gen x = 1 if condition`: 1 where true, missing elsewhere."""
+    return pd.Series(np.where(condition, 1.0, np.nan), index=condition.index)
+
+
+def recode(df, variable, codes):
+    """`gen x = .` followed by `replace x = value if variable == label`.
+
+    Rows left missing by a category without a value, or a value outside the
+    categories, are logged.
+    """
+    table = recode_table(variable, codes)
+    values, categories = lookup(table, df[variable])
+    for line in unrecoded(table, df[variable], categories):
+        log(line)
+    return values
+
+
+# STAGES OF cr_dataset_1a.do
+
+
+def create_cohort(df, population_filtered=False):
+    """The cohort drops of cr_dataset_1a.do.
+
+    They repeat part of the study's population, so on an extract (rather than
+    dummy data) they remove nothing; with `population_filtered` that is
+    checked.
+    """
+    rows = len(df)
+    log(f"DIED ON/BEFORE STUDY START DATE: {(df['died'] == 1).sum()}")
+
+    keep = ~(df["age"] < 18)
+    log(f"DROPPING AGE<18: {(~keep).sum()}")
+    df = df[keep]
+
+    if df["age"].isna().any():
+        raise ValueError("assertion is false: age<.")
+    keep = ~(df["age"] > 120)
+    log(f"DROPPING AGE<120: {(~keep).sum()}")
+    df = df[keep]
+
+    if not df["sex"].isin(["M", "F", "I", "U"]).all():
+        raise ValueError('assertion is false: inlist(sex, "M", "F", "I", "U")')
+    keep = ~df["sex"].isin(["I", "U"])
+    log(f"DROPPING GENDER NOT M/F: {(~keep).sum()}")
+    df = df[keep]
+
+    df = df[
+        df["is_registered_with_tpp"].notna()
+        & df["has_follow_up"].notna()
+        & df["is_registered_with_tpp_feb2020"].notna()
+    ]
+    if population_filtered and len(df) != rows:
+        raise ValueError(
+            f"the cohort drops removed {rows - len(df)} rows of an input which "
+            "should already be limited to the study population"
+        )
+    return df.drop(
+        columns=[
+            "is_registered_with_tpp",
+            "has_follow_up",
+            "is_registered_with_tpp_feb2020",
+            "died",
+            "household_id",
+        ]
+    )
+
+
+def convert_dates(df):
+    """Convert the dates, returning the dataset and their day numbers."""
+    log("CONVERT DATES TO STATA DATES")
+    days = decode_date_matrix(df, DATE_VARIABLES)
+    for name, column in zip(DATE_VARIABLES, days):
+        # each converted date replaces the original at the end of the dataset
+        del df[name]
+        df[name] = to_datetime64(column)
+    return df.rename(columns=RENAMED_DATES), days
+
+
+def onset_before_index(df, days):
+    # `foreach var of varlist covid_vax - dialysis` makes a `<var>_index` flag
+    # for each converted date; all of them go into the onset bits at once
+    df[ONSET_COLUMN] = ONSET.pack(days, INDEX_DAY)
+    return df
+
+
+def recode_implausible(df):
+    df["bmi"] = df["bmi"].where(
+        (df["bmi"] >= 15) & (df["bmi"] <= 50) | df["bmi"].isna()
+    )
+    df["bp_sys"] = df["bp_sys"].mask((df["bp_sys"] > 300) | (df["bp_sys"] < 20))
+    return df
+
+
+def destring(df):
+    df["smok_status"] = recode(df, "smoking_status", SMOKING)
+    df = df.drop(columns="smoking_status")
+
+    df["agegroup"] = recode(df, "ageband_broad", AGEGROUP)
+    df = df.drop(columns="ageband_broad")
+
+    df["sex2"] = recode(df, "sex", SEX)
+    df = df.drop(columns="sex").rename(columns={"sex2": "sex"})
+
+    df["eth5"] = recode(df, "ethnicity", ETHNICITY)
+    df = df.drop(columns="ethnicity")
+
+    df["stp2"] = stp_number(df["stp"])
+    df = df.drop(columns="stp").rename(columns={"stp2": "stp"})
+
+    df["region_n"] = recode(df, "region", REGION)
+    df = df.drop(columns="region").rename(columns={"region_n": "region"})
+
+    df = df.rename(columns={"index_of_multiple_deprivation": "imd_o"})
+    imd = cut_groups(df["imd_o"], 5) + 1
+    imd[df["imd_o"] == -1] = np.nan
+    # reverse the order, so high is more deprived
+    df["imd"] = 6 - imd
+    df = df.drop(columns="imd_o")
+
+    keep = df["imd"].notna()
+    log(f"DROPPING IF NO IMD: {(~keep).sum()}")
+    return df[keep]
+
+
+def destring_column(column):
+    """`destring, replace`: numeric if every value is, otherwise unchanged."""
+    numbers = pd.to_numeric(column.replace("", np.nan), errors="coerce")
+    if (numbers.isna() & (column != "")).any():
+        return column
+    return numbers.astype(np.float64)
+
+
+def stp_number(stp):
+    """`substr(stp, 8, 2)` then `destring`, done on the distinct STP codes."""
+    codes, distinct = pd.factorize(stp, use_na_sentinel=False)
+    numbers = destring_column(
+        pd.Series(distinct, dtype=object).astype(str).str.slice(7, 9)
+    )
+    return pd.Series(numbers.values[codes], index=stp.index)
+
+
+def percentiles(values, nq):
+    """The nq-quantile cut points of `values` as _pctile computes them."""
+    values = np.sort(values)
+    n = len(values)
+    cuts = []
+    for i in range(1, nq):
+        position = n * i / nq
+        j = int(position)
+        if position == j:
+            cuts.append((values[j - 1] + values[j]) / 2)
+        else:
+            cuts.append(values[j])
+    return np.array(cuts)
+
+
+def cut_groups(column, nq):
+    """`egen x = cut(column), group(nq) icodes`.
+
+    Groups are numbered from 0 and each is closed on the left, so a value's
+    group is the number of cut points at or below it; tied cut points leave
+    groups empty, as in Stata.
+    """
+    values = column.values
+    present = ~np.isnan(values)
+    groups = np.full(len(values), np.nan)
+    if present.any():
+        cuts = percentiles(values[present], nq)
+        groups[present] = np.searchsorted(cuts, values[present], side="right")
+    return pd.Series(groups, index=column.index)
+
+
+def distance_band(distance):
+    """1 if < 1 year, 2 if 1 to 4.9 years, 3 if 5+ years, else missing."""
+    bands = np.select(
+        [distance < 365, (distance >= 365) & (distance < 1826), distance >= 1826],
+        [1.0, 2.0, 3.0],
+        np.nan,
+    )
+    return pd.Series(bands, index=distance.index)
+
+
+def categorise(df):
+    bmi = df["bmi"]
+    df["obese4cat"] = np.select(
+        [
+            bmi < 18.5,
+            (bmi >= 18.5) & (bmi < 24.99999),
+            (bmi >= 25) & (bmi < 29.99999),
+            (bmi >= 30) & (bmi < 34.99999),
+            (bmi >= 35) & (bmi < 39.99999),
+            bmi >= 40,
+        ],
+        [0.0, 1.0, 2.0, 3.0, 4.0, 5.0],
+        np.nan,
+    )
+    df = df.sort_values("obese4cat", kind="stable", na_position="last")
+    df = df.drop(columns="bmi")
+
+    df["chronic_respiratory_disease"] = onset(df, "other_respiratory", "copd").astype(
+        np.float64
+    )
+
+    # dates after the index date count as no diagnosis
+    distance = days_before_index(df["haem_cancer"])
+    df["haemcancer"] = distance_band(distance.mask(distance < 0))
+
+    distance = days_before_index(df["cancer"])
+    df["cancer2"] = distance_band(distance.mask(distance < 0))
+    df = df.drop(columns="cancer").rename(columns={"cancer2": "cancer"})
+
+    bp_sys = df["bp_sys"]
+    df["bp_cat"] = np.select(
+        [
+            bp_sys < 130,
+            (bp_sys >= 130) & (bp_sys < 140),
+            (bp_sys >= 140) & (bp_sys < 160),
+            bp_sys >= 160,
+        ],
+        [1.0, 2.0, 3.0, 4.0],
+        np.nan,
+    )
+
+    df["highbp_hyper"] = flag(onset(df, "hypertension") | (bp_sys >= 140))
+    df = df.drop(columns=["bp_sys", "bp_dias"])
+
+    df["ra_p_sle"] = flag(onset(df, "sle", "rheumatoid_arthritis", "psoriasis"))
+
+    # HbA1c within 15 months (450 days); a missing date counts as too old
+    distance = days_before_index(df["hba1c_mmol_per_mol_date"])
+    hba1c = df["hba1c_mmol_per_mol"].mask(
+        (distance < 0) | (distance > 450) | distance.isna()
+    )
+    diabetic = onset(df, "diabetes")
+    df["diab"] = np.select(
+        [diabetic & (hba1c < 58), diabetic & (hba1c >= 58), diabetic & hba1c.isna()],
+        [1.0, 2.0, 3.0],
+        np.nan,
+    )
+    df = df.drop(columns=["hba1c_mmol_per_mol", "hba1c_mmol_per_mol_date"])
+
+    df["strokedementia"] = flag(onset(df, "dementia", "stroke"))
+
+    df["chd"] = flag(onset(df, "heart_disease", "myocardial_infarct"))
+
+    # temporary immunodeficiency counts only if recorded within the last year
+    distance = days_before_index(df["temporary_immunodeficiency"])
+    temporary = (
+        onset(df, "temporary_immunodeficiency") & (distance >= 0) & (distance <= 365)
+    )
+    df["immunodeficiency"] = np.where(
+        onset(df, "permanent_immunodeficiency"),
+        2.0,
+        np.where(temporary, 1.0, np.nan),
+    )
+
+    return df.drop(columns=DROPPED_DATES)
+
+
+def dates_and_onset(df):
+    df, days = convert_dates(df.copy())
+    return onset_before_index(df, days)
+
+
+def stages_1a(population_filtered=False):
+    """The stages of cr_dataset_1a.do, in order."""
+    return [
+        functools.partial(create_cohort, population_filtered=population_filtered),
+        dates_and_onset,
+        recode_implausible,
+        destring,
+        lambda df: categorise(df.copy()),
+    ]
+
+
+# STAGES OF cr_dataset_1b.do
+
+WAVE_BINS = PeriodBins([WAVES])
+
+
+def wave_test(df):
+    # converting the dates again moves them to the end of the dataset
+    for name in ("covid_vax", "first_positive_test_date"):
+        df[name] = df.pop(name)
+    days = day_numbers(df["first_positive_test_date"].values)
+    df["wave_test"] = stata_values(WAVE_BINS.periods(days)[WAVES.name])
+    return df
+
+
+STAGES_1B = [wave_test]
+
+
+def run_stages(df, stages):
+    for stage in stages:
+        df = stage(df)
+    return df
+
+
+def derive(df, population_filtered=False):
+    """Apply every stage of cr_dataset_1a.do to the imported cohort."""
+    return run_stages(df, stages_1a(population_filtered))
+
+
+# EXPORT
+
+
+def format_dates(dates):
+    """Format dates as Stata's %td does, eg 01sep2022."""
+    codes, uniques = pd.factorize(dates)
+    labels = pd.Series(uniques).dt.strftime("%d%b%Y").str.lower()
+    # factorize codes missing dates as -1, which picks the trailing ""
+    return pd.Series(np.append(labels.values, "")[codes], index=dates.index)
+
+
+def format_numbers(column):
+    if column.dtype == object:
+        return column
+    # most columns hold a handful of distinct values, so only those are formatted
+    codes, uniques = pd.factorize(column)
+    uniques = np.asarray(uniques)
+    if (uniques % 1 == 0).all():
+        labels = uniques.astype(np.int64).astype(str)
+    else:
+        # decimals were imported as floats, so print them at that precision
+        labels = pd.Series(uniques.astype(np.float32)).astype(str)
+        labels = labels.str.replace(r"\.0$", "", regex=True).values
+    return pd.Series(np.append(labels, "")[codes], index=column.index)
+
+
+def exported_columns(df):
+    """(name, values) of the output columns, with the onset bits unpacked."""
+    kept = [name for name in ONSET.names if name not in DROPPED_FLAGS]
+    for name, column in df.items():
+        if name == ONSET_COLUMN:
+            # the surviving `<var>_index` flags, where the do-file leaves them
+            for flag_name in kept:
+                values = ONSET.values(column.values, flag_name)
+                yield f"{flag_name}_index", pd.Series(values, index=df.index)
+        else:
+            yield name, column
+
+
+def export(df, path):
+    names, columns = [], []
+    for name, column in exported_columns(df):
+        names.append(name)
+        columns.append(
+            format_dates(column) if column.dtype.kind == "M" else format_numbers(column)
+        )
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(names)
+        writer.writerows(zip(*(column.values for column in columns)))
+
+
+# PARITY WITH THE STATA OUTPUT
+
+
+def compare(path, stata_path):
+    """Return a list of differences between two cr_dataset_1a.csv files.
+
+    Rows are matched on patient_id, since Stata's sort leaves the order of
+    tied rows unspecified. Numbers are compared at single precision, which is
+    how the decimals in both files were stored.
+    """
+    ours = pd.read_csv(path, dtype=str, keep_default_na=False)
+    theirs = pd.read_csv(stata_path, dtype=str, keep_default_na=False)
+    if list(ours.columns) != list(theirs.columns):
+        return [f"columns differ: {list(ours.columns)} != {list(theirs.columns)}"]
+    if len(ours) != len(theirs):
+        return [f"row counts differ: {len(ours)} != {len(theirs)}"]
+    ours = ours.set_index("patient_id").sort_index()
+    theirs = theirs.set_index("patient_id").sort_index()
+    if not ours.index.equals(theirs.index):
+        return ["patient_ids differ"]
+
+    differences = []
+    for name in ours.columns:
+        a, b = ours[name], theirs[name]
+        differs = a != b
+        if differs.any():
+            x = pd.to_numeric(a[differs].replace("", np.nan), errors="coerce")
+            y = pd.to_numeric(b[differs].replace("", np.nan), errors="coerce")
+            same = x.astype(np.float32) == y.astype(np.float32)
+            differs[differs] = ~same.values
+        if differs.any():
+            differences.append(f"{name}: {differs.sum()} rows differ")
+    return differences
+
+
+def is_dummy_data():
+    """Whether the input is dummy data: it is, unless the job runs on a real
+    backend, which OPENSAFELY_BACKEND names."""
+    return os.environ.get("OPENSAFELY_BACKEND", "expectations") == "expectations"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--output", default="output/cr_dataset_1a_python.csv")
+    parser.add_argument("--output-1b", help="also write the 1b dataset here")
+    parser.add_argument("--compare", help="Stata cr_dataset_1a.csv to check against")
+    parser.add_argument(
+        "--compare-1b", help="Stata cr_dataset_1b.csv to check --output-1b against"
+    )
+    parser.add_argument("--report", help="write the comparison here, not to stdout")
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="exit with an error if the datasets differ",
+    )
+    parser.add_argument(
+        "--compare-only",
+        action="store_true",
+        help="compare the existing --output and --output-1b, not derive them",
+    )
+    parser.add_argument(
+        "--population-filtered",
+        action="store_true",
+        help="check the cohort drops remove nothing, as the input is an extract "
+        "(not on dummy data, which the population does not filter)",
+    )
+    args = parser.parse_args()
+    population_filtered = args.population_filtered and not is_dummy_data()
+
+    if not args.compare_only:
+        start = time.perf_counter()
+        df = read_input(args.input)
+        rows = len(df)
+        df = derive(df, population_filtered)
+        export(df, args.output)
+        outputs = [args.output]
+        if args.output_1b:
+            df = run_stages(df, STAGES_1B)
+            export(df, args.output_1b)
+            outputs.append(args.output_1b)
+        elapsed = time.perf_counter() - start
+        log(f"wrote {len(df)} of {rows} rows to {', '.join(outputs)} in {elapsed:.2f}s")
+
+    checks = [(args.output, args.compare), (args.output_1b, args.compare_1b)]
+    reports = []
+    failed = False
+    for path, stata_path in checks:
+        if path and stata_path:
+            differences = compare(path, stata_path)
+            reports += differences or [f"{path} matches {stata_path}"]
+            failed = failed or bool(differences)
+    if reports:
+        report = "\n".join(reports)
+        if args.report:
+            with open(args.report, "w") as f:
+                f.write(report + "\n")
+        log(report)
+        if failed and args.strict:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# BULK DATE DECODING
+#
+# The cohort has ~40 date columns of YYYY-MM-DD (or YYYY-MM, for variables
+# extracted with include_month=True) strings, which cr_dataset_1a.do converts
+# one column at a time by slicing out the year, month and day. A cohort holds
+# only a few thousand distinct dates, though, so here the values of all the
+# date columns are pooled and factorised in one pass, only the distinct
+# strings are parsed, and the day numbers are gathered back by code.
+#
+# Day numbers count from 1960-01-01, as Stata dates do (2022-09-01 is 22889),
+# and are int32. A missing date is MISSING_DATE, which, like Stata's missing
+# value, is greater than every date.
+
+import numpy as np
+import pandas as pd
+
+EPOCH = np.datetime64("1960-01-01", "D")
+
+MISSING_DATE = np.iinfo(np.int32).max
+
+
+def parse_distinct(values):
+    """Day numbers for an array of distinct date strings.
+
+    A month-only value is taken as the 1st of the month; anything else that
+    is not a valid YYYY-MM-DD date is missing.
+    """
+    values = pd.Series(values, dtype=object).astype(str)
+    values = values.where(values.str.len() != 7, values + "-01")
+    # to_datetime alone would also read eg "20220901" and "2022-9-1"
+    values = values.where(values.str.fullmatch(r"\d{4}-\d{2}-\d{2}"))
+    dates = pd.to_datetime(values, format="%Y-%m-%d", errors="coerce")
+    days = (dates.values.astype("datetime64[D]") - EPOCH).astype(np.int64)
+    return np.where(dates.isna().values, MISSING_DATE, days).astype(np.int32)
+
+
+def day_number(date):
+    """The day number of a YYYY-MM-DD string, eg 22889 for "2022-09-01"."""
+    return int((np.datetime64(date, "D") - EPOCH).astype(np.int64))
+
+
+def decode_date_matrix(df, columns):
+    """Return a (column x row) int32 matrix of day numbers for `columns`."""
+    if not columns:
+        return np.empty((0, len(df)), np.int32)
+    pooled = np.concatenate([df[column].to_numpy(dtype=object) for column in columns])
+    codes, distinct = pd.factorize(pooled)
+    # code -1 (a blank) picks up the trailing MISSING_DATE
+    lookup = np.append(parse_distinct(distinct), np.int32(MISSING_DATE))
+    return lookup[codes].reshape(len(columns), len(df))
+
+
+def decode_dates(df, columns):
+    """Return {column: int32 day numbers} for the date columns of `df`."""
+    return dict(zip(columns, decode_date_matrix(df, columns)))
+
+
+def to_datetime64(days):
+    """Convert day numbers to datetime64[ns], with NaT for missing dates."""
+    missing = days == MISSING_DATE
+    days = np.where(missing, 0, days).astype("timedelta64[D]")
+    dates = (EPOCH + days).astype("datetime64[ns]")
+    dates[missing] = np.datetime64("NaT")
+    return dates
+
+
+def day_numbers(dates):
+    """Convert datetime64 values to day numbers, MISSING_DATE for NaT."""
+    dates = np.asarray(dates).astype("datetime64[D]")
+    days = (dates - EPOCH).astype(np.int64)
+    return np.where(np.isnat(dates), MISSING_DATE, days).astype(np.int32)
@@ -0,0 +1,76 @@
+# DISCLOSURE CONTROL FOR MODERATELY SENSITIVE TABLES
+#
+# tabulate_1a.do and tabulate_1b.do round each count to the nearest 5 as they
+# write a table, write it out unredacted, import it again and then remove
+# counts of 5 or less. A RedactedTable does all of it as each row of counts is
+# written, so the only file written is the _redacted.csv itself:
+#   - counts are rounded to the nearest 5 (Stata's round(n, 5), halves up)
+#   - each count's percent is worked out from the rounded count, over the
+#     denominator its column is given (the do-files give the total column the
+#     unrounded number of patients, and the strata their rounded totals)
+#   - rounded counts of 5 or less, zero included, are removed and their
+#     percent replaced by "redacted"
+# A note row (eg a footnote) has no counts, so all its counts are redacted, as
+# the do-files' redaction leaves them.
+
+import csv
+
+import numpy as np
+
+# rounded counts of this many or fewer are redacted
+REDACT_AT_OR_BELOW = 5
+
+
+def round5(n):
+    """Stata's round(n, 5)."""
+    return 5 * np.floor(np.asarray(n) / 5 + 0.5)
+
+
+def percent(numerator, denominator, decimals):
+    """Format 100 * numerator / denominator as %w.df, "." if undefined."""
+    width = decimals + 2
+    if denominator == 0:
+        return f"{'.':>{width}}"
+    return f"{100 * (numerator / denominator):{width}.{decimals}f}"
+
+
+class RedactedTable:
+    """A CSV of labelled rows of (count, percent) pairs, written with every
+    count rounded and small counts redacted.
+
+    `denominators` holds a (denominator, decimals) pair for each count
+    column. Use as a context manager; `rows` counts the rows written.
+    """
+
+    def __init__(self, path, header, denominators):
+        self.path = path
+        self.header = header
+        self.denominators = denominators
+        self.rows = 0
+
+    def __enter__(self):
+        self.file = open(self.path, "w", newline="")
+        self.writer = csv.writer(self.file, lineterminator="\n")
+        self.writer.writerow(self.header)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def write_counts(self, labels, counts):
+        """Write a row of `labels` then each count, rounded, with its percent."""
+        row = list(labels)
+        for n, (denominator, decimals) in zip(round5(counts), self.denominators):
+            if n <= REDACT_AT_OR_BELOW:
+                row += [None, "redacted"]
+            else:
+                row += [int(n), f" ({percent(n, denominator, decimals)})"]
+        self.write(row)
+
+    def write_note(self, labels):
+        """Write a row of `labels` with every count redacted."""
+        self.write(list(labels) + [None, "redacted"] * len(self.denominators))
+
+    def write(self, row):
+        self.writer.writerow("" if value is None else value for value in row)
+        self.rows += 1
@@ -0,0 +1,189 @@
+# SHARDED DUMMY DATA
+#
+# `generate_cohort --expectations-population N` samples the whole dummy cohort
+# from the variables' return_expectations in one process, which takes a long
+# time for the millions of rows needed to test the pipeline at scale. Here the
+# population is cut into shards of --shard-rows rows which a pool of worker
+# processes generate (with expectations.py, or with --cohortextractor as
+# generate_cohort does) and write in parallel:
+#   - each shard samples with its own seed, spawned from --seed, so a shard's
+#     rows depend only on the seed and its position, and the output is the
+#     same whatever the number of workers
+#   - patient ids are drawn (as cohortextractor draws them, from ten times as
+#     many ids as rows) from a range of ids belonging to the shard, so they
+#     are unique across shards
+#   - the shards are concatenated into one CSV, or with --chunk-dir kept as
+#     part-files with a manifest, as cohort_chunks.py writes them
+#
+# The shards are sampled independently, so eg the number of patients with a
+# variable is not exactly its incidence times the population, just close to it.
+#
+# Usage: python analysis/dummy_data.py [--expectations-population 100000]
+#            [--shard-rows 100000] [--workers N] [--seed 0] [--cohortextractor]
+#            [--study-definition study_definition]
+#            [--output output/input.csv | --chunk-dir DIR]
+
+import argparse
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from cohort_chunks import MANIFEST, chunk_name, remove_chunks
+from expectations import sample_cohort
+
+SHARD_ROWS = 100_000
+
+
+def shard_sizes(population, shard_rows):
+    full, rest = divmod(population, shard_rows)
+    return [shard_rows] * full + ([rest] if rest else [])
+
+
+def shard_seeds(seed, shards):
+    """One 32-bit seed per shard, independent of each other."""
+    children = np.random.SeedSequence(seed).spawn(shards)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+
+def write_shard(task):
+    """Generate one shard of the dummy cohort and write it to `path`."""
+    index, rows, shard_rows, seed, sampler, study_definition, path = task
+    study = importlib.import_module(study_definition).study
+
+    rng = np.random.default_rng(seed)
+    if sampler == "cohortextractor":
+        # which samples from numpy's global random state
+        np.random.seed(seed)
+        df = study.make_df_from_expectations(rows)
+    else:
+        df = sample_cohort(study, rows, rng)
+    ids = rng.choice(rows * 10, size=rows, replace=False)
+    df["patient_id"] = ids + index * shard_rows * 10
+    df.to_csv(path, index=False)
+    return rows
+
+
+def generate_shards(
+    population,
+    output_dir,
+    shard_rows,
+    workers,
+    seed,
+    sampler="vectorised",
+    study_definition="study_definition",
+):
+    """Write the shards of the `study` of the module `study_definition` to
+    part-files in `output_dir`; returns their manifest."""
+    sizes = shard_sizes(population, shard_rows)
+    tasks = [
+        (
+            i,
+            rows,
+            shard_rows,
+            shard_seed,
+            sampler,
+            study_definition,
+            os.path.join(output_dir, chunk_name(i)),
+        )
+        for i, (rows, shard_seed) in enumerate(
+            zip(sizes, shard_seeds(seed, len(sizes)))
+        )
+    ]
+    os.makedirs(output_dir, exist_ok=True)
+    remove_chunks(output_dir)
+    if workers == 1:
+        list(map(write_shard, tasks))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            list(pool.imap_unordered(write_shard, tasks))
+
+    with open(tasks[0][-1], newline="") as f:
+        columns = next(csv.reader(f))
+    manifest = {
+        "source": "dummy data",
+        "columns": columns,
+        "rows_per_chunk": shard_rows,
+        "rows": population,
+        "chunks": [
+            {"file": chunk_name(i), "rows": rows} for i, rows in enumerate(sizes)
+        ],
+        "seed": seed,
+        "sampler": sampler,
+    }
+    with open(os.path.join(output_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def concatenate(chunk_dir, manifest, path):
+    """Join the part-files into one CSV, with the header of the first."""
+    with open(path, "w", newline="") as out:
+        for i, chunk in enumerate(manifest["chunks"]):
+            with open(os.path.join(chunk_dir, chunk["file"]), newline="") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--expectations-population", type=int, default=100_000)
+    parser.add_argument("--shard-rows", type=int, default=SHARD_ROWS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--cohortextractor",
+        action="store_const",
+        const="cohortextractor",
+        default="vectorised",
+        dest="sampler",
+        help="sample with cohortextractor's own (slower) generator",
+    )
+    parser.add_argument(
+        "--study-definition",
+        default="study_definition",
+        help="the module defining the study",
+    )
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--output", default="output/input.csv")
+    output.add_argument("--chunk-dir", help="keep the shards as part-files here")
+    args = parser.parse_args()
+    if args.expectations_population < 1 or args.shard_rows < 1:
+        parser.error("the population and shard rows must be at least 1")
+
+    def generate(output_dir):
+        return generate_shards(
+            args.expectations_population,
+            output_dir,
+            args.shard_rows,
+            args.workers,
+            args.seed,
+            args.sampler,
+            args.study_definition,
+        )
+
+    if args.chunk_dir:
+        manifest = generate(args.chunk_dir)
+        destination = args.chunk_dir
+    else:
+        out_dir = os.path.dirname(os.path.abspath(args.output))
+        os.makedirs(out_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=out_dir) as tmp:
+            manifest = generate(tmp)
+            concatenate(tmp, manifest, args.output)
+        destination = args.output
+    print(
+        f"wrote {manifest['rows']} dummy rows in {len(manifest['chunks'])} shards "
+        f"to {destination}"
+    )
+
+
+if __name__ == "__main__":
+    main()
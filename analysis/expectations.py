@@ -0,0 +1,274 @@
+# VECTORISED DUMMY DATA FROM RETURN_EXPECTATIONS
+#
+# cohortextractor's dummy data generator samples each column through pandas
+# and scipy (ages looked up band by band, categories relabelled with
+# DataFrame.replace, dates formatted with strftime). Here each column is drawn
+# as a whole NumPy array from one numpy Generator, with the same
+# distributions:
+#   - dates: exponential_increase (a truncated exponential back from the
+#     latest date) or uniform, then limited to the variable's own period
+#   - int: normal, poisson or population_ages; float: normal; categories from
+#     their ratios; flags
+#   - incidence: exactly int((1 - incidence) * n) rows, chosen at random, are
+#     left empty; a value with a measurement date is empty where its date is
+# A `categorised_as` variable (`satisfying` included) whose expression refers only to
+# variables which can themselves be sampled (hidden ones included) is not
+# drawn from its own ratios but derived from them with expressions.py, so eg
+# ageband_broad agrees with age. The rest are drawn from their ratios, as
+# cohortextractor draws them all. The population is not applied, as in
+# cohortextractor's dummy data.
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from expressions import categorise, names, parse
+
+UNSUPPORTED = ("aggregate_of", "with_value_from_file", "which_exist_in_file")
+
+# cohortextractor's types for the columns of dummy data, by column_type
+VALUE_TYPES = {"bool": "bool", "int": "int", "float": "float", "str": "category"}
+
+# the empty value of each type, as cohortextractor's set_empty_values has them
+EMPTY = {"bool": 0, "int": 0, "float": 0.0, "category": None}
+
+MAX_AGE = 110
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def population_age_probabilities(max_age=MAX_AGE):
+    """P(age) for ages 0 to max_age - 1, as cohortextractor's generate_ages."""
+    import cohortextractor
+
+    path = os.path.join(
+        os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv"
+    )
+    bands = pd.read_csv(path, thousands=",")
+    ends = bands["band"].str.split("-").str[1].astype(int).values
+    counts = bands["range"].values
+    ages = np.arange(max_age)
+    p = counts[np.searchsorted(ends, ages)] / counts.sum() / 5
+    p[np.argmax(p)] -= p.sum() - 1
+    return p
+
+
+def merged_expectations(default_expectations, return_expectations):
+    merged = dict(default_expectations)
+    for key, value in (return_expectations or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = {**merged[key], **value}
+        merged[key] = value
+    return merged
+
+
+class Sampler:
+    """Draws the dummy columns of a study, one array at a time."""
+
+    def __init__(self, study, population, rng):
+        self.definitions = study.covariate_definitions
+        self.default_expectations = study.default_expectations
+        self.population = population
+        self.rng = rng
+        self.columns = {}
+        self.derivable = {}
+        # {value: its measurement date}, where the value is empty without a date
+        self.measurement_dates = {
+            query_args["source"]: name
+            for name, (query_type, query_args) in self.definitions.items()
+            if query_type == "value_from" and query_args["column_type"] == "date"
+        }
+
+    def expectations(self, name):
+        query_type, query_args = self.definitions[name]
+        if query_type == "value_from":
+            # a measurement date has its value's expectations
+            query_type, query_args = self.definitions[query_args["source"]]
+        return merged_expectations(
+            self.default_expectations, query_args.get("return_expectations")
+        )
+
+    def value_type(self, name):
+        query_type, query_args = self.definitions[name]
+        if query_args.get("returning") in (
+            "index_of_multiple_deprivation",
+            "rural_urban_classification",
+        ):
+            return "category"
+        if query_type == "categorised_as" and query_args["column_type"] == "date":
+            return "category"
+        if query_args["column_type"] == "date":
+            return "date"
+        return VALUE_TYPES[query_args["column_type"]]
+
+    def can_sample(self, name):
+        query_type, _ = self.definitions[name]
+        if query_type == "categorised_as":
+            return self.can_derive(name) or self.can_draw(name)
+        return self.can_draw(name)
+
+    def can_draw(self, name):
+        query_type, _ = self.definitions[name]
+        if query_type in UNSUPPORTED or query_type == "fixed_value":
+            return False
+        expectations = self.expectations(name)
+        value_type = self.value_type(name)
+        if value_type == "date":
+            return "earliest" in expectations.get("date", {})
+        return value_type == "bool" or value_type in expectations
+
+    def can_derive(self, name):
+        if name not in self.derivable:
+            self.derivable[name] = False  # guards against cycles
+            self.derivable[name] = all(
+                other in self.definitions and self.can_sample(other)
+                for other in self.references(name)
+            )
+        return self.derivable[name]
+
+    def references(self, name):
+        """The variables `name`'s categories refer to, sorted, so they are
+        sampled (and draw from the rng) in the same order in every run."""
+        expressions = [
+            expression
+            for expression in self.definitions[name][1]["category_definitions"].values()
+            if expression.strip() != "DEFAULT"
+        ]
+        return sorted(
+            set().union(*(names(parse(expression)) for expression in expressions))
+        )
+
+    def column(self, name):
+        """The raw values of `name`: dates as datetime64[D], NaT where empty."""
+        if name not in self.columns:
+            self.columns[name] = self.sample(name)
+        return self.columns[name]
+
+    def sample(self, name):
+        query_type, query_args = self.definitions[name]
+        if query_type in UNSUPPORTED:
+            raise ValueError(f"{name}: {query_type} is not supported in dummy data")
+        if query_type == "fixed_value":
+            return np.full(self.population, query_args["value"], dtype=object)
+        if query_type == "categorised_as" and self.can_derive(name):
+            columns = {other: self.column(other) for other in self.references(name)}
+            values = categorise(
+                query_args["category_definitions"], columns, self.population
+            )
+            if query_args["column_type"] in ("bool", "int"):
+                # eg patients.satisfying, which is categorised as 1 or 0
+                return values.astype(np.int64)
+            return values
+
+        expectations = self.expectations(name)
+        value_type = self.value_type(name)
+        if value_type == "date":
+            return self.dates(name, expectations)
+        values = self.values(value_type, expectations)
+        empty = self.empty_rows(name, expectations)
+        if empty is not None:
+            values[empty] = EMPTY[value_type]
+        return values
+
+    def dates(self, name, expectations):
+        """Dates back from the latest date, limited to the variable's period."""
+        date = expectations["date"]
+        earliest = np.datetime64(date["earliest"], "D")
+        latest = np.datetime64(date["latest"], "D")
+        elapsed = (latest - earliest).astype(np.int64)
+        rate = expectations.get("rate", "exponential_increase")
+        u = self.rng.random(self.population)
+        if rate == "exponential_increase":
+            # exponential with scale elapsed / 10, truncated at elapsed days
+            fraction = -0.1 * np.log1p(-u * (1 - np.exp(-10.0)))
+        elif rate == "uniform":
+            fraction = u
+        elif rate == "universal":
+            fraction = np.zeros(self.population)
+        else:
+            raise ValueError(
+                "Only exponential_increase and uniform distributions currently "
+                "supported"
+            )
+        days = (fraction * elapsed).astype(np.int64)
+        dates = latest - days.astype("timedelta64[D]")
+        if rate != "universal":
+            dates[self.incidence_rows(expectations)] = np.datetime64("NaT")
+
+        query_args = self.definitions[name][1]
+        # dates relative to other variables are not applied, as in cohortextractor
+        start, end = query_args.get("between") or (None, None)
+        if start is not None and ISO_DATE.match(start):
+            dates[dates < np.datetime64(start, "D")] = np.datetime64("NaT")
+        if end is not None and ISO_DATE.match(end):
+            dates[dates > np.datetime64(end, "D")] = np.datetime64("NaT")
+        return dates
+
+    def values(self, value_type, expectations):
+        n = self.population
+        if value_type == "bool":
+            return np.ones(n, np.int64)
+        if value_type == "category":
+            ratios = expectations["category"]["ratios"]
+            labels = np.array(list(ratios), dtype=object)
+            p = np.array(list(ratios.values()), np.float64)
+            return labels[self.rng.choice(len(labels), size=n, p=p / p.sum())]
+        spec = expectations[value_type]
+        distribution = spec["distribution"]
+        if distribution == "normal":
+            values = self.rng.normal(spec["mean"], spec["stddev"], n)
+            return values.astype(np.int64) if value_type == "int" else values
+        if value_type == "int" and distribution == "poisson":
+            return self.rng.poisson(spec["mean"], n).astype(np.int64)
+        if value_type == "int" and distribution == "population_ages":
+            p = population_age_probabilities()
+            return self.rng.choice(len(p), size=n, p=p).astype(np.int64)
+        raise ValueError(f"Unsupported {value_type} distribution {distribution}")
+
+    def incidence_rows(self, expectations):
+        incidence = expectations["incidence"]
+        empty = int((1 - incidence) * self.population)
+        return self.rng.choice(self.population, size=empty, replace=False)
+
+    def empty_rows(self, name, expectations):
+        """The rows to leave empty, or None."""
+        date_column = self.measurement_dates.get(name)
+        if date_column is not None:
+            return np.isnat(self.column(date_column))
+        if expectations.get("rate") == "universal":
+            return None
+        return self.incidence_rows(expectations)
+
+
+def formatted_dates(dates, date_format):
+    """Dates as text at the precision of `date_format`, "" where empty.
+
+    Each distinct day is formatted once, and the rows look theirs up.
+    """
+    width = {"YYYY-MM-DD": 10, "YYYY-MM": 7}.get(date_format, 4)
+    empty = np.isnat(dates)
+    if empty.all():
+        return np.full(len(dates), "", dtype=object)
+    days = dates.astype(np.int64)
+    first = days[~empty].min()
+    offsets = np.where(empty, 0, days - first + 1)
+    table = np.arange(first, days[~empty].max() + 1).astype("datetime64[D]")
+    text = np.datetime_as_string(table, unit="D").astype(f"<U{width}")
+    return np.concatenate([[""], text.astype(object)])[offsets]
+
+
+def sample_cohort(study, population, rng):
+    """A dummy cohort of `population` rows, with the columns (and column
+    order) of cohortextractor's make_df_from_expectations."""
+    sampler = Sampler(study, population, rng)
+    csv_args = study.pandas_csv_args
+    data = {}
+    for name in csv_args["parse_dates"]:
+        data[name] = formatted_dates(
+            sampler.column(name), csv_args["args"][name].get("date_format")
+        )
+    for name in csv_args["dtype"]:
+        data[name] = sampler.column(name)
+    return pd.DataFrame(data)
@@ -0,0 +1,398 @@
+# SATISFYING / CATEGORISED_AS EXPRESSIONS OVER ARRAYS
+#
+# `patients.satisfying` and `patients.categorised_as` take expressions in
+# cohortextractor's small SQL dialect: names, numbers and quoted strings,
+# = != < <= > >=, + - * /, AND, OR, NOT and brackets, where a name not in a
+# comparison means "is not empty". In the database they become CASE WHEN
+# clauses; here they are parsed into a tree, compiled into a Plan of
+# whole-array NumPy steps (see below) and evaluated on one array per variable,
+# eg to derive dummy data from the variables an expression refers to.
+#
+# Empty values are as in the extracted data: 0 for flags and numbers, "" for
+# strings and NaT for dates.
+
+import collections
+import functools
+import re
+
+import numpy as np
+import pandas as pd
+
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<number>\d+(?:\.\d*)?)
+      | (?P<string>'[^']*'|"[^"]*")
+      | (?P<op><=|>=|!=|<>|[=<>()+\-*/])
+      | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    )""",
+    re.VERBOSE,
+)
+
+# a string column is coded before this many tests of it
+MIN_CODED_TESTS = 3
+
+KEYWORDS = ("AND", "OR", "NOT")
+COMPARISONS = ("=", "!=", "<>", "<", "<=", ">", ">=")
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ExpressionError(f"Cannot parse {expression[position:]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "word" and text in KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """Recursive descent over the tokens, in SQL's order of precedence."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, *texts):
+        kind, text = self.peek()
+        if text in texts and kind in ("keyword", "op"):
+            self.position += 1
+            return text
+        return None
+
+    def parse(self):
+        tree = self.disjunction()
+        if self.position != len(self.tokens):
+            raise ExpressionError(
+                f"Unexpected {self.peek()[1]!r} in {self.expression!r}"
+            )
+        return tree
+
+    def disjunction(self):
+        tree = self.conjunction()
+        while self.take("OR"):
+            tree = ("or", tree, self.conjunction())
+        return tree
+
+    def conjunction(self):
+        tree = self.negation()
+        while self.take("AND"):
+            tree = ("and", tree, self.negation())
+        return tree
+
+    def negation(self):
+        if self.take("NOT"):
+            return ("not", self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        if self.peek()[1] == "(" and self.brackets_condition():
+            self.take("(")
+            tree = self.disjunction()
+            self.expect(")")
+            return tree
+        left = self.sum()
+        op = self.take(*COMPARISONS)
+        if op is None:
+            return ("truthy", left)
+        return ("compare", "!=" if op == "<>" else op, left, self.sum())
+
+    def brackets_condition(self):
+        """Whether the bracket opening here holds a condition, not a value."""
+        depth = 0
+        for kind, text in self.tokens[self.position :]:
+            if text == "(":
+                depth += 1
+            elif text == ")":
+                depth -= 1
+                if depth == 0:
+                    return False
+            elif kind == "keyword" or text in COMPARISONS:
+                return True
+        return False
+
+    def sum(self):
+        tree = self.product()
+        while op := self.take("+", "-"):
+            tree = ("arithmetic", op, tree, self.product())
+        return tree
+
+    def product(self):
+        tree = self.value()
+        while op := self.take("*", "/"):
+            tree = ("arithmetic", op, tree, self.value())
+        return tree
+
+    def value(self):
+        kind, text = self.peek()
+        if self.take("("):
+            tree = self.sum()
+            self.expect(")")
+            return tree
+        if self.take("-"):
+            return ("arithmetic", "-", ("literal", 0), self.value())
+        self.position += 1
+        if kind == "number":
+            return ("literal", float(text) if "." in text else int(text))
+        if kind == "string":
+            return ("literal", text[1:-1])
+        if kind == "word":
+            return ("name", text)
+        raise ExpressionError(f"Unexpected {text!r} in {self.expression!r}")
+
+    def expect(self, text):
+        if not self.take(text):
+            raise ExpressionError(f"Expected {text!r} in {self.expression!r}")
+
+
+def parse(expression):
+    return Parser(expression).parse()
+
+
+def names(tree):
+    """The variables `tree` refers to."""
+    if tree[0] == "name":
+        return {tree[1]}
+    if tree[0] == "literal":
+        return set()
+    return set().union(
+        *(names(child) for child in tree[1:] if isinstance(child, tuple))
+    )
+
+
+def canonical(tree):
+    """`tree` with AND/OR chains flattened, sorted and deduplicated, and
+    double negatives removed, so equivalent subexpressions are equal."""
+    kind = tree[0]
+    if kind in ("and", "or"):
+        children = set()
+        for child in map(canonical, tree[1:]):
+            children.update(child[1:] if child[0] == kind else [child])
+        if len(children) == 1:
+            return children.pop()
+        return (kind, *sorted(children, key=repr))
+    if kind == "not":
+        child = canonical(tree[1])
+        return child[1] if child[0] == "not" else ("not", child)
+    if kind == "truthy":
+        return ("truthy", canonical(tree[1]))
+    if kind in ("compare", "arithmetic"):
+        return (kind, tree[1], canonical(tree[2]), canonical(tree[3]))
+    return tree
+
+
+COMPARE = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+ARITHMETIC = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.divide,
+}
+
+
+class Plan:
+    """Expressions compiled into a list of whole-array steps.
+
+    Each distinct subexpression (after `canonical`) is one step, so one
+    which several expressions share, eg the
+    `recent_asthma_code OR (asthma_code_ever AND NOT copd_code_ever)` of two
+    asthma categories, is evaluated once. A step's result is dropped after
+    its last use. A string column tested against literals (or for being
+    empty) several times is coded once with pd.factorize, and the tests are
+    lookups of its integer codes.
+    """
+
+    def __init__(self, trees):
+        self.steps = []
+        self.slots = {}
+        self.outputs = [self.lower(canonical(tree)) for tree in trees]
+        last_use = {}
+        for i, step in enumerate(self.steps):
+            for operand in self.operands(step):
+                last_use[operand] = i
+        self.release = [[] for _ in self.steps]
+        for slot, i in last_use.items():
+            if slot not in self.outputs:
+                self.release[i].append(slot)
+        # the operands tested often enough to be worth coding, if strings
+        tests = collections.Counter(
+            step[2] if step[0] == "compare" else step[1]
+            for step in self.steps
+            if step[0] == "truthy"
+            or (step[0] == "compare" and self.steps[step[3]][0] == "literal")
+        )
+        self.coded = {slot for slot, n in tests.items() if n >= MIN_CODED_TESTS}
+
+    @staticmethod
+    def operands(step):
+        return [operand for operand in step[1:] if isinstance(operand, Slot)]
+
+    def lower(self, tree):
+        if tree not in self.slots:
+            kind = tree[0]
+            if kind in ("name", "literal"):
+                step = tree
+            elif kind in ("compare", "arithmetic"):
+                step = (kind, tree[1], self.lower(tree[2]), self.lower(tree[3]))
+            else:
+                step = (kind, *(self.lower(child) for child in tree[1:]))
+            self.slots[tree] = Slot(len(self.steps))
+            self.steps.append(step)
+        return self.slots[tree]
+
+    @property
+    def names(self):
+        return {step[1] for step in self.steps if step[0] == "name"}
+
+    def run(self, columns):
+        """The value of each expression on `columns` ({name: array})."""
+        values = [None] * len(self.steps)
+        codes = {}
+        for i, step in enumerate(self.steps):
+            values[i] = self.run_step(step, values, codes, columns)
+            for slot in self.release[i]:
+                values[slot] = None
+                codes.pop(slot, None)
+        return [values[slot] for slot in self.outputs]
+
+    def run_step(self, step, values, codes, columns):
+        kind = step[0]
+        if kind == "name":
+            try:
+                return columns[step[1]]
+            except KeyError:
+                raise ExpressionError(f"Unknown column: {step[1]}")
+        if kind == "literal":
+            return step[1]
+        if kind in ("and", "or"):
+            combine = np.logical_and if kind == "and" else np.logical_or
+            result = combine(values[step[1]], values[step[2]])
+            for slot in step[3:]:
+                combine(result, values[slot], out=result)
+            return result
+        if kind == "not":
+            return ~values[step[1]]
+        if kind == "truthy":
+            operand = step[1]
+            if operand in self.coded and is_strings(values[operand]):
+                return code_lookup(
+                    values, codes, operand, lambda uniques: uniques != ""
+                )
+            return truthy(np.asarray(values[operand]))
+        if kind == "arithmetic":
+            return ARITHMETIC[step[1]](values[step[2]], values[step[3]])
+        if kind == "compare":
+            return self.compare(step, values, codes)
+        raise ExpressionError(f"Cannot evaluate {kind}")
+
+    def compare(self, step, values, codes):
+        _, op, left, right = step
+        if self.steps[left][0] == "literal":
+            # literal on the left: flip the comparison
+            op = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}.get(op, op)
+            left, right = right, left
+        values_left, literal = values[left], values[right]
+        if self.steps[right][0] == "literal":
+            if op in ("=", "!=") and left in self.coded and is_strings(values_left):
+                matches = code_lookup(
+                    values, codes, left, lambda uniques: uniques == literal
+                )
+                return matches if op == "=" else ~matches
+            literal = literal_for(values_left, literal)
+        return np.asarray(COMPARE[op](values_left, literal), bool)
+
+
+class Slot(int):
+    """The index of a step's result, as an operand of a later step."""
+
+
+def is_strings(values):
+    return isinstance(values, np.ndarray) and values.dtype.kind == "O"
+
+
+def code_lookup(values, codes, slot, test):
+    """`test` of the strings in `slot`, applied to each distinct string once.
+
+    The factorised codes of the slot are cached in `codes`; a missing value
+    (code -1) never passes.
+    """
+    if slot not in codes:
+        column_codes, uniques = pd.factorize(values[slot])
+        codes[slot] = (column_codes, np.asarray(uniques, dtype=object))
+    column_codes, uniques = codes[slot]
+    table = np.append(np.asarray(test(uniques), bool), False)
+    return table[column_codes]
+
+
+def truthy(values):
+    if values.dtype.kind == "M":
+        return ~np.isnat(values)
+    if values.dtype.kind == "O":
+        return (values != "") & (values != None)  # noqa: E711
+    return values != 0
+
+
+def literal_for(values, literal):
+    """`literal` as a value comparable with `values`."""
+    if isinstance(values, np.ndarray) and values.dtype.kind == "M":
+        return np.datetime64(literal, "D")
+    return literal
+
+
+def evaluate(tree, columns):
+    """Evaluate `tree` on `columns` ({name: array}), giving a bool array."""
+    return Plan([tree]).run(columns)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def category_plan(category_definitions):
+    """The labels, default and Plan of the categories of a categorised_as,
+    given as a tuple of (label, expression) pairs."""
+    default = None
+    labels = []
+    trees = []
+    for label, expression in category_definitions:
+        if expression.strip() == "DEFAULT":
+            default = label
+            continue
+        labels.append(label)
+        trees.append(parse(expression))
+    return labels, default, Plan(trees)
+
+
+def categorise(category_definitions, columns, size):
+    """The category of each row, as patients.categorised_as assigns it.
+
+    The categories are tried in order and the first whose expression holds
+    is taken; rows matching none get the DEFAULT category (or None).
+    """
+    labels, default, plan = category_plan(tuple(category_definitions.items()))
+    # index into labels + [default], filled from the last category to the first
+    index = np.full(size, len(labels), np.min_scalar_type(len(labels)))
+    for i, condition in reversed(list(enumerate(plan.run(columns)))):
+        index[condition] = i
+    return np.array(labels + [default], dtype=object)[index]
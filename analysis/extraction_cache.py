@@ -0,0 +1,289 @@
+# INCREMENTAL EXTRACTION
+#
+# Rerunning generate_study_population after a new index date or one new
+# variable extracts every column for the whole population again. With
+# EXTRACTION_CACHE_DIR set, each output column of a CSV extraction is kept in
+# that directory, keyed by a fingerprint of its definition, and a rerun only
+# extracts the columns whose fingerprint has changed:
+#   - a fingerprint covers the query type and arguments after date expressions
+#     are evaluated (so the index date and every date window are in it), the
+#     codes of its codelists, the fingerprints of the variables it refers to
+#     and the database extracted from
+#   - the population is always extracted, with the variables it refers to; if
+#     its definition has changed, or it no longer selects exactly the cached
+#     patients, every column is extracted again
+#   - the stale columns are extracted in one query, alongside (hidden) any
+#     variables they need, and joined to the cached columns on patient_id:
+#     every column is cached in patient_id order, so as the patients are the
+#     same the join is by position
+#
+# The cache does not know when the database itself was refreshed, so it is
+# for iterating on a study definition against one snapshot; delete the
+# directory to force a full extraction. Dummy data and non-CSV output are
+# always generated in full.
+#
+# The cached columns are patient level data, as sensitive as the extract, so
+# EXTRACTION_CACHE_DIR must be inside the workspace's output/ directory, where
+# the extract itself is written; any other directory is refused.
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+from itertools import chain
+from urllib import parse
+
+import pandas as pd
+from cohortextractor.csv_utils import is_csv_filename, write_rows_to_csv
+
+from population_first import PopulationFirstStudyDefinition
+
+CACHE_DIR = os.environ.get("EXTRACTION_CACHE_DIR")
+
+# the cache must be in here
+OUTPUT_DIR = "output"
+
+# bump this whenever the layout of the cache changes
+FORMAT_VERSION = 1
+
+FINGERPRINTS = "fingerprints.json"
+
+# arguments which don't change a column's values
+IGNORED_ARGS = ("return_expectations", "hidden")
+
+
+def canonical(value):
+    """A JSON-serialisable form of a query argument, codelists by their codes."""
+    if isinstance(value, list) and hasattr(value, "system"):
+        codes = sorted(
+            tuple(code) if isinstance(code, tuple) else code for code in value
+        )
+        digest = hashlib.sha256(json.dumps([value.system, codes]).encode()).hexdigest()
+        return {"codelist": digest}
+    if isinstance(value, dict):
+        return {
+            str(key): canonical(item) for key, item in sorted(value.items(), key=str)
+        }
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def definition_json(query_args):
+    args = {key: value for key, value in query_args.items() if key not in IGNORED_ARGS}
+    return json.dumps(canonical(args), sort_keys=True, default=str)
+
+
+def references(covariate_definitions):
+    """{name: names of the other variables its arguments mention}.
+
+    This looks for the names as words anywhere in the arguments, so it can
+    only over-state what a variable depends on.
+    """
+    names = set(covariate_definitions)
+    words = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+    referenced = {}
+    for name, (_, query_args) in covariate_definitions.items():
+        mentioned = set(words.findall(definition_json(query_args)))
+        referenced[name] = sorted((mentioned & names) - {name})
+    return referenced
+
+
+def fingerprints(covariate_definitions, database):
+    """{name: fingerprint} for every variable, including the population."""
+    referenced = references(covariate_definitions)
+    prints = {}
+
+    def fingerprint(name, seen=()):
+        if name not in prints:
+            if name in seen:
+                raise ValueError(f"{name} refers to itself")
+            query_type, query_args = covariate_definitions[name]
+            parts = [
+                FORMAT_VERSION,
+                database,
+                query_type,
+                definition_json(query_args),
+                [fingerprint(other, seen + (name,)) for other in referenced[name]],
+            ]
+            prints[name] = hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+        return prints[name]
+
+    for name in covariate_definitions:
+        fingerprint(name)
+    return prints
+
+
+def output_columns(covariate_definitions):
+    """The variables written to the output, in order."""
+    return [
+        name
+        for name, (_, query_args) in covariate_definitions.items()
+        if name != "population" and not query_args.get("hidden", False)
+    ]
+
+
+def needed_definitions(covariate_definitions, columns):
+    """The definitions to extract `columns`: the population, the columns, and
+    (hidden) the variables they need."""
+    referenced = references(covariate_definitions)
+    needed = set()
+    pending = ["population", *columns]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(referenced[name])
+    definitions = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name in needed:
+            if name != "population" and name not in columns:
+                query_args = {**query_args, "hidden": True}
+            definitions[name] = (query_type, query_args)
+    return definitions
+
+
+def database_key(database_url):
+    """The server and database of `database_url`, without any credentials."""
+    parts = parse.urlparse(database_url)
+    return f"{parts.hostname}:{parts.port}{parts.path}"
+
+
+def patients_digest(patient_ids):
+    return hashlib.sha256("\n".join(sorted(patient_ids)).encode()).hexdigest()
+
+
+# THE CACHE DIRECTORY
+
+
+def checked_cache_dir(cache_dir, output_dir=OUTPUT_DIR):
+    """`cache_dir`, which must be inside `output_dir` (symlinks resolved)."""
+    resolved = os.path.realpath(cache_dir)
+    allowed = os.path.realpath(output_dir)
+    if os.path.commonpath([resolved, allowed]) != allowed or resolved == allowed:
+        raise ValueError(
+            f"EXTRACTION_CACHE_DIR {cache_dir} is not a directory inside "
+            f"{output_dir}/, where patient level data may be kept"
+        )
+    return resolved
+
+
+def column_path(cache_dir, name):
+    return os.path.join(cache_dir, f"{name}.feather")
+
+
+def read_fingerprints(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, FINGERPRINTS)) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if saved.get("version") != FORMAT_VERSION:
+        return None
+    return saved
+
+
+def write_cache(cache_dir, df, columns, prints, saved):
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = dict(saved["columns"]) if saved else {}
+    for name in columns:
+        df[["patient_id", name]].reset_index(drop=True).to_feather(
+            column_path(cache_dir, name)
+        )
+        cached[name] = prints[name]
+    saved = {
+        "version": FORMAT_VERSION,
+        "population": prints["population"],
+        "patients": patients_digest(df["patient_id"]),
+        "columns": cached,
+    }
+    # fingerprints are written last, so an interrupted run leaves the columns
+    # it did not finish marked as stale
+    tmp = os.path.join(cache_dir, f"{FINGERPRINTS}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(saved, f, indent=2)
+    os.replace(tmp, os.path.join(cache_dir, FINGERPRINTS))
+
+
+def read_column(cache_dir, name, rows):
+    values = pd.read_feather(column_path(cache_dir, name), columns=[name])[name]
+    if len(values) != rows:
+        raise ValueError(f"{name} has {len(values)} cached rows, not {rows}")
+    return values.values
+
+
+# EXTRACTION
+
+
+def stale_columns(covariate_definitions, prints, saved, cache_dir):
+    columns = output_columns(covariate_definitions)
+    if saved is None or saved["population"] != prints["population"]:
+        return columns
+    return [
+        name
+        for name in columns
+        if saved["columns"].get(name) != prints[name]
+        or not os.path.exists(column_path(cache_dir, name))
+    ]
+
+
+class IncrementalStudyDefinition(PopulationFirstStudyDefinition):
+    """StudyDefinition which extracts only the changed columns, see above."""
+
+    def to_file(
+        self, filename, expectations_population=False, dummy_data_file=None, **kwargs
+    ):
+        if (
+            CACHE_DIR is None
+            or expectations_population
+            or dummy_data_file
+            or not is_csv_filename(filename)
+        ):
+            return super().to_file(
+                filename, expectations_population, dummy_data_file, **kwargs
+            )
+        self.assert_backend_is_configured()
+        self.incremental_to_file(filename, checked_cache_dir(CACHE_DIR))
+
+    def incremental_to_file(self, filename, cache_dir):
+        definitions = self.covariate_definitions
+        columns = output_columns(definitions)
+        prints = fingerprints(definitions, database_key(self.database_url))
+        saved = read_fingerprints(cache_dir)
+
+        stale = stale_columns(definitions, prints, saved, cache_dir)
+        print(
+            f"extracting {len(stale)} of {len(columns)} columns: {', '.join(stale)}",
+            flush=True,
+        )
+        df = self.extract(needed_definitions(definitions, stale))
+        if len(stale) < len(columns) and (
+            patients_digest(df["patient_id"]) != saved["patients"]
+        ):
+            print("the population has changed, so extracting every column", flush=True)
+            stale = columns
+            df = self.extract(definitions)
+        df = df.sort_values("patient_id", ignore_index=True)
+
+        write_cache(cache_dir, df, stale, prints, saved)
+        for name in columns:
+            if name not in stale:
+                df[name] = read_column(cache_dir, name, len(df))
+        header = ["patient_id", *columns]
+        rows = df[header].itertuples(index=False, name=None)
+        write_rows_to_csv(chain([header], rows), filename)
+
+    def extract(self, definitions):
+        """Extract `definitions` from the database, with every value as text."""
+        Backend = self.get_backend_for_database_url(self.database_url)
+        backend = Backend(
+            self.database_url, definitions, temporary_database=self.temporary_database
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "extract.csv")
+            try:
+                backend.to_file(path)
+            finally:
+                backend.close()
+            return pd.read_csv(path, dtype=str, keep_default_na=False)
@@ -0,0 +1,159 @@
+# HOUSEHOLD AGGREGATION
+#
+# study_definition.py extracts each patient's household as of 2020-02-01
+# (household_id, a pseudonymous id that is 0 where the patient has no
+# household, and household_size), which cr_dataset_1a.do drops. Here the
+# cohort's households are kept as a CSR-style index: the household ids are
+# factorised to codes 0..H-1 (in order of household_id), and the patients'
+# rows sorted by household are `order`, with the members of household h at
+# order[offsets[h]:offsets[h + 1]]. Every per-household feature is one
+# bincount of a patient flag over the codes, and is gathered back to the
+# patients by code, so each is an O(n) pass over whole arrays; the sort
+# giving `order` is only made if the members themselves are needed.
+#
+# Features, counted over the household's patients in the cohort (who may be
+# fewer than its household_size):
+#   - members
+#   - in_cis: members with an ONS CIS record
+#   - positive: members with a first positive test
+#   - vaccinated: members with a COVID-19 vaccination
+# The patient file has each patient's household features with the patient's
+# own values taken out (eg household_others_in_cis), for clustering analyses.
+#
+# The cohort is read in chunks, each reduced to the household columns and one
+# bool per feature, so the date strings of ~25M patients are never held at once.
+#
+# Usage: python analysis/households.py [--input output/input.csv]
+#            [--households output/households.csv]
+#            [--patients output/household_features.csv]
+
+import argparse
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+
+# {feature: (column, test of the column)}
+FEATURES = {
+    "in_cis": ("in_cis", lambda values: values == 1),
+    "positive": ("first_positive_test_date", pd.notna),
+    "vaccinated": ("covid_vax", pd.notna),
+}
+
+COLUMNS = ["patient_id", "household_id", "household_size"] + sorted(
+    {column for column, _ in FEATURES.values()}
+)
+
+CHUNK_ROWS = 1_000_000
+
+
+class HouseholdIndex:
+    """The patients of each household, as offsets into the rows sorted by
+    household. Patients with no household (household_id 0) are in none."""
+
+    def __init__(self, household_ids):
+        household_ids = np.asarray(household_ids)
+        in_household = household_ids != 0
+        codes, self.ids = pd.factorize(household_ids[in_household], sort=True)
+        # -1 for the patients with no household
+        self.codes = np.full(len(household_ids), -1, np.int64)
+        self.codes[in_household] = codes
+        self.in_household = in_household
+        self.counts = np.bincount(codes, minlength=len(self.ids))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @functools.cached_property
+    def order(self):
+        """The rows in a household, sorted by household (stably)."""
+        rows = np.flatnonzero(self.in_household)
+        return rows[np.argsort(self.codes[rows], kind="stable")]
+
+    def members(self, household):
+        """The rows of the patients in the household with code `household`."""
+        return self.order[self.offsets[household] : self.offsets[household + 1]]
+
+    def count(self, flags):
+        """The number of patients with `flags` set in each household."""
+        flags = np.asarray(flags, bool) & self.in_household
+        return np.bincount(self.codes[flags], minlength=len(self))
+
+    def first(self, values):
+        """The value of `values` of one patient of each household."""
+        result = np.zeros(len(self), np.asarray(values).dtype)
+        result[self.codes[self.in_household]] = np.asarray(values)[self.in_household]
+        return result
+
+    def gather(self, household_values, missing=0):
+        """A household's value for each of its patients, `missing` for the
+        patients with no household."""
+        values = np.append(household_values, missing)
+        # code -1 picks up the trailing `missing`
+        return values[self.codes]
+
+
+def read_flags(path, chunk_rows=CHUNK_ROWS):
+    """The household columns of the cohort, and a bool column per feature."""
+    chunks = []
+    for chunk in pd.read_csv(
+        path, usecols=COLUMNS, chunksize=chunk_rows, low_memory=False
+    ):
+        flags = {name: chunk[name].to_numpy() for name in COLUMNS[:3]}
+        for name, (column, test) in FEATURES.items():
+            flags[name] = np.asarray(test(chunk[column].to_numpy()), bool)
+        chunks.append(pd.DataFrame(flags))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def household_features(df):
+    """The index, and a table of the features of each household, from the
+    flags of read_flags."""
+    index = HouseholdIndex(df["household_id"].to_numpy())
+    households = {
+        "household_id": index.ids,
+        "household_size": index.first(df["household_size"].to_numpy()),
+        "members": index.counts,
+    }
+    for name in FEATURES:
+        households[name] = index.count(df[name].to_numpy())
+    return index, pd.DataFrame(households)
+
+
+def patient_features(df, index, households):
+    """Each patient's household features, without the patient's own values."""
+    patients = {
+        "patient_id": df["patient_id"].to_numpy(),
+        "household_id": df["household_id"].to_numpy(),
+        "household_members": index.gather(households["members"].to_numpy()),
+    }
+    for name in FEATURES:
+        counts = index.gather(households[name].to_numpy())
+        own = df[name].to_numpy() & index.in_household
+        patients[f"household_others_{name}"] = counts - own
+    return pd.DataFrame(patients)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--households", default="output/households.csv")
+    parser.add_argument("--patients", default="output/household_features.csv")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    df = read_flags(args.input)
+    index, households = household_features(df)
+    households.to_csv(args.households, index=False)
+    patient_features(df, index, households).to_csv(args.patients, index=False)
+    elapsed = time.perf_counter() - start
+    print(
+        f"wrote {len(index)} households of {index.in_household.sum()} of "
+        f"{len(df)} patients to {args.households} in {elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# EXTRACTION AT SEVERAL INDEX DATES IN ONE RUN
+#
+# `generate_cohort --index-date-range` runs the whole study definition once
+# per index date, rescanning every event table each time. Here the study is
+# evaluated at every date and the variables of all the dates are extracted
+# together as one wide query:
+#   - each date's variables are renamed <name>_<yyyymmdd> (and references
+#     between them renamed to match), and its population becomes the column
+#     population_<yyyymmdd>; the population extracted is their union
+#   - a variable whose definition is the same at every date (eg sex, or events
+#     ever recorded) has the same fingerprint (see extraction_cache.py), so it
+#     is extracted once and shared by the dates
+#   - the first/last-match event variables of every date share one scan of
+#     each event table, cut into segments at their period boundaries (see
+#     shared_scans.py)
+# The result is split into one input_<date>.csv per date, as generate_cohort
+# writes them, or with --panel into one long input_panel.csv with an
+# index_date column. SQL Server allows 1024 columns in a table, so dates are
+# extracted in batches that fit.
+#
+# Dummy data is generated for each date separately. --index-date-range is read
+# as generate_cohort reads it: "DATE to DATE by week|month", or one date, with
+# the dates in YYYY-MM-DD form or "today", and the latest date first.
+#
+# Usage: python analysis/index_dates.py --index-date-range "2022-01-01 to
+#            2022-12-01 by month" [--output-dir output] [--panel]
+#            [--expectations-population N]
+
+import argparse
+import datetime
+import os
+import re
+
+import pandas as pd
+
+from extraction_cache import fingerprints, output_columns
+
+# arguments which can refer to other variables by name
+REFERENCE_ARGS = ("category_definitions", "source", "between", "column_names")
+
+# keep the output table below SQL Server's limit of 1024 columns
+MAX_COLUMNS = 1000
+
+
+def parse_date(date):
+    if date == "today":
+        return datetime.date.today()
+    return datetime.date.fromisoformat(date)
+
+
+def next_date(date, period):
+    if period == "week":
+        return date + datetime.timedelta(days=7)
+    if date.month < 12:
+        return date.replace(month=date.month + 1)
+    return date.replace(year=date.year + 1, month=1)
+
+
+def index_date_range(date_range):
+    """The dates of `date_range` as YYYY-MM-DD, latest first."""
+    start, _, rest = date_range.partition(" to ")
+    end, _, period = (rest or start).partition(" by ")
+    period = period or "month"
+    if period not in ("week", "month"):
+        raise ValueError(f"Unknown time period '{period}': must be 'week' or 'month'")
+    try:
+        start, end = parse_date(start.strip()), parse_date(end.strip())
+    except ValueError:
+        raise ValueError(
+            f"Invalid date range '{date_range}': dates must be YYYY-MM-DD or "
+            "'today', and ranges 'DATE to DATE by (week|month)'"
+        )
+    if end < start:
+        raise ValueError(
+            f"Invalid date range '{date_range}': end cannot be earlier than start"
+        )
+    dates = []
+    while start <= end:
+        dates.append(start.isoformat())
+        start = next_date(start, period)
+    return dates[::-1]
+
+
+def date_suffix(index_date):
+    return index_date.replace("-", "")
+
+
+def rename_references(query_args, names):
+    """A copy of `query_args` with the variables in `names` renamed."""
+    if not names:
+        return query_args
+    pattern = re.compile(
+        r"\b(" + "|".join(map(re.escape, sorted(names, key=len, reverse=True))) + r")\b"
+    )
+
+    def rename(value):
+        if isinstance(value, str):
+            return pattern.sub(lambda match: names[match.group(1)], value)
+        if isinstance(value, dict):
+            return {key: rename(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(rename(item) for item in value)
+        return value
+
+    return {
+        key: rename(value) if key in REFERENCE_ARGS else value
+        for key, value in query_args.items()
+    }
+
+
+def combined_definitions(study, index_dates):
+    """The definitions of every date as one study.
+
+    Returns (definitions, columns), where columns[date] maps each output
+    column of the study to its column in the combined extract.
+    """
+    definitions = {}
+    columns = {}
+    shared = {}  # fingerprint -> combined name
+    for index_date in index_dates:
+        study.set_index_date(index_date)
+        prints = fingerprints(study.covariate_definitions, "")
+        names = {}
+        for name, (query_type, query_args) in study.covariate_definitions.items():
+            if name != "population" and prints[name] in shared:
+                names[name] = shared[prints[name]]
+                continue
+            names[name] = f"{name}_{date_suffix(index_date)}"
+            query_args = rename_references(query_args, names)
+            if name == "population":
+                query_args = {**query_args, "hidden": False}
+            else:
+                shared[prints[name]] = names[name]
+            definitions[names[name]] = (query_type, query_args)
+        columns[index_date] = {
+            name: names[name] for name in output_columns(study.covariate_definitions)
+        }
+        columns[index_date]["population"] = names["population"]
+
+    # the population is anyone in the population at any of the dates
+    query_type, query_args = study.covariate_definitions["population"]
+    either = " OR ".join(
+        columns[index_date]["population"] for index_date in index_dates
+    )
+    definitions["population"] = (
+        query_type,
+        {**query_args, "category_definitions": {1: either, 0: "DEFAULT"}},
+    )
+    return definitions, columns
+
+
+def batches(study, index_dates, max_columns=MAX_COLUMNS):
+    """Split `index_dates` into runs whose combined outputs fit in a table."""
+    batch = []
+    for index_date in index_dates:
+        definitions, _ = combined_definitions(study, batch + [index_date])
+        if batch and len(output_columns(definitions)) > max_columns:
+            yield batch
+            batch = []
+        batch.append(index_date)
+    if batch:
+        yield batch
+
+
+def split_by_date(df, columns):
+    """{date: that date's cohort} from a combined extract."""
+    cohorts = {}
+    for index_date, names in columns.items():
+        rows = df[names["population"]] == "1"
+        wanted = {combined: name for name, combined in names.items()}
+        del wanted[names["population"]]
+        cohort = df.loc[rows, ["patient_id", *wanted]].copy()
+        cohort.columns = ["patient_id", *wanted.values()]
+        cohorts[index_date] = cohort.reset_index(drop=True)
+    return cohorts
+
+
+def extract_index_dates(study, index_dates):
+    """{date: cohort DataFrame of text values}, extracted in shared batches."""
+    cohorts = {}
+    for batch in batches(study, index_dates):
+        definitions, columns = combined_definitions(study, batch)
+        print(
+            f"extracting index dates {', '.join(batch)} "
+            f"({len(definitions)} variables)",
+            flush=True,
+        )
+        cohorts.update(split_by_date(study.extract(definitions), columns))
+    return cohorts
+
+
+def dummy_index_dates(study, index_dates, population_size, output_dir):
+    cohorts = {}
+    for index_date in index_dates:
+        study.set_index_date(index_date)
+        path = os.path.join(output_dir, f"dummy_{index_date}.csv")
+        study.to_file(path, expectations_population=population_size)
+        cohorts[index_date] = pd.read_csv(path, dtype=str, keep_default_na=False)
+        os.remove(path)
+    return cohorts
+
+
+def write_cohorts(cohorts, output_dir, panel=False):
+    if panel:
+        frames = []
+        for index_date, cohort in sorted(cohorts.items()):
+            cohort = cohort.copy()
+            cohort.insert(1, "index_date", index_date)
+            frames.append(cohort)
+        path = os.path.join(output_dir, "input_panel.csv")
+        pd.concat(frames).to_csv(path, index=False)
+        return [path]
+    paths = []
+    for index_date, cohort in cohorts.items():
+        path = os.path.join(output_dir, f"input_{index_date}.csv")
+        cohort.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-date-range", required=True)
+    parser.add_argument("--output-dir", default="output")
+    parser.add_argument("--panel", action="store_true", help="write one long file")
+    parser.add_argument("--expectations-population", type=int)
+    args = parser.parse_args()
+
+    from study_definition import study
+
+    index_dates = index_date_range(args.index_date_range)
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.expectations_population:
+        cohorts = dummy_index_dates(
+            study, index_dates, args.expectations_population, args.output_dir
+        )
+    else:
+        study.assert_backend_is_configured()
+        cohorts = extract_index_dates(study, index_dates)
+    for path in write_cohorts(cohorts, args.output_dir, args.panel):
+        print(f"wrote {path}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
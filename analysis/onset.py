@@ -0,0 +1,56 @@
+# ONSET BEFORE THE INDEX DATE, AS A PACKED BIT-MATRIX
+#
+# cr_dataset_1a.do makes a `<var>_index` flag (1 or missing) for each of ~35
+# date variables, saying whether it was on or before the index date; as
+# float columns that is 8 bytes per patient per variable. Here all the flags
+# are computed at once from the matrix of day numbers made by
+# dates.decode_date_matrix, and each patient's flags are packed into the
+# bits of one uint64, so a row carries all of them in 8 bytes and moves with
+# its patient when rows are dropped or sorted. Flags are unpacked one at a
+# time, only where a derivation, table or output needs them.
+
+import numpy as np
+
+MAX_FLAGS = 64
+
+# the dataset column holding each patient's onset bits
+COLUMN = "onset"
+
+
+class OnsetFlags:
+    """The names of the flags packed into a column of uint64 onset bits."""
+
+    def __init__(self, names):
+        if len(names) > MAX_FLAGS:
+            raise ValueError(f"at most {MAX_FLAGS} flags fit in the onset bits")
+        self.names = list(names)
+        self.bits = {name: np.uint64(1) << np.uint64(i) for i, name in enumerate(names)}
+
+    def pack(self, days, index_day):
+        """Pack the flags for a (flag x patient) matrix of day numbers.
+
+        A flag is set where the date is on or before `index_day`; missing
+        dates (MISSING_DATE) are after every date, so are never set.
+        """
+        if days.shape[0] != len(self.names):
+            raise ValueError("need one row of day numbers per flag")
+        onset = days <= index_day
+        # (patient x flag) bits, padded to 64 per patient, least significant first
+        packed = np.packbits(onset.T, axis=1, bitorder="little")
+        padded = np.zeros((packed.shape[0], MAX_FLAGS // 8), np.uint8)
+        padded[:, : packed.shape[1]] = packed
+        return padded.view("<u8").ravel()
+
+    def mask(self, *names):
+        mask = np.uint64(0)
+        for name in names:
+            mask |= self.bits[name]
+        return mask
+
+    def any(self, onset_bits, *names):
+        """True where any of the named flags is set."""
+        return (onset_bits & self.mask(*names)) != 0
+
+    def values(self, onset_bits, name):
+        """The flag as cr_dataset_1a.do has it: 1 if set, missing if not."""
+        return np.where(self.any(onset_bits, name), 1.0, np.nan)
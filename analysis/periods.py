@@ -0,0 +1,89 @@
+# CALENDAR PERIODS OF DATES
+#
+# cr_dataset_1b.do puts first_positive_test_date into the pandemic's waves
+# with one `replace wave_test = i if date >= start & date < next start` per
+# wave, each a pass over the dataset. Here a period scheme is a table of named
+# periods, each given by its first day and lasting until the next one's (the
+# last until the scheme's end, or with no end). The first days of every scheme
+# binned together cut time into segments, and one np.searchsorted of a date
+# (or of a whole (column x row) matrix of day numbers, as
+# dates.decode_date_matrix makes) finds its segment; each scheme's period is
+# then looked up from the segment, so any number of schemes, over any number
+# of date columns, cost one pass.
+#
+# A period is its number in the scheme (0 for the first), or -1 for a date
+# outside every period of the scheme, or missing.
+
+from collections import namedtuple
+
+import numpy as np
+
+from dates import MISSING_DATE, day_number
+
+# `periods` is a list of (label, first day as YYYY-MM-DD); the last period
+# ends the day before `end`, or never if `end` is None
+Scheme = namedtuple("Scheme", ["name", "periods", "end"], defaults=[None])
+
+# the wave_test of cr_dataset_1b.do, labelled as tabulate_1b.do labels it
+WAVES = Scheme(
+    "wave",
+    [
+        ("Wave 1, 23/03/20-30/05/20", "2020-03-23"),
+        ("Easing 1, 31/05/20-06/09/20", "2020-05-31"),
+        ("Wave 2, 07/09/20-23/04-21", "2020-09-07"),
+        ("Easing 2, 24/04/21 to 27/05/21", "2021-04-24"),
+        ("Wave 3, 28/05/21-13/12/21", "2021-05-28"),
+        ("Easing 3, 14/12/21-01/09/22", "2021-12-14"),
+    ],
+)
+
+
+def scheme_cuts(scheme):
+    """The day numbers starting each period, then the scheme's end, if any."""
+    days = [day_number(start) for _, start in scheme.periods]
+    if scheme.end is not None:
+        days.append(day_number(scheme.end))
+    if days != sorted(set(days)):
+        raise ValueError(f"the periods of {scheme.name} are not in date order")
+    return days
+
+
+class PeriodBins:
+    """Puts day numbers into the periods of several schemes at once."""
+
+    def __init__(self, schemes):
+        self.schemes = list(schemes)
+        self.cuts = np.array(
+            sorted(set().union(*map(scheme_cuts, self.schemes))), np.int32
+        )
+        # segment i holds the days from cut i - 1 (inclusive) to cut i
+        # (exclusive); one more segment at the end is for missing dates
+        segment_starts = np.concatenate([[np.iinfo(np.int32).min], self.cuts])
+        self.tables = {}
+        for scheme in self.schemes:
+            cuts = scheme_cuts(scheme)
+            period = np.searchsorted(cuts, segment_starts, side="right") - 1
+            # days before the first period, or from the end on, are in none
+            period[period >= len(scheme.periods)] = -1
+            self.tables[scheme.name] = np.append(period, -1).astype(np.int8)
+
+    def segments(self, days):
+        segments = np.searchsorted(self.cuts, days, side="right")
+        segments[days == MISSING_DATE] = len(self.cuts) + 1
+        return segments
+
+    def periods(self, days):
+        """{scheme name: the period of each of `days`}, from one search."""
+        segments = self.segments(np.asarray(days))
+        return {name: table[segments] for name, table in self.tables.items()}
+
+    def labels(self, name, periods):
+        """The label of each period of scheme `name`, None for -1."""
+        scheme = next(scheme for scheme in self.schemes if scheme.name == name)
+        labels = np.array([label for label, _ in scheme.periods] + [None], object)
+        return labels[periods]
+
+
+def stata_values(periods):
+    """Periods as a Stata variable has them: a float, missing for -1."""
+    return np.where(periods < 0, np.nan, periods.astype(np.float64))
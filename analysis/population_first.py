@@ -0,0 +1,167 @@
+# POPULATION FIRST
+#
+# The TPP backend extracts every variable for every patient in the database
+# and only applies the population in the final join. With POPULATION_FIRST
+# set, the variables the population is defined from are extracted first, the
+# ids of the patients in the population are written to a temporary table with
+# a clustered primary key, and the query of every other variable is limited
+# to those patients:
+#   - with SHARED_SCANS set, the shared scans of the coded event tables (see
+#     shared_scans.py) join the table of ids before grouping (a variable the
+#     population needs keeps its own query, as it runs before the table
+#     exists)
+#   - any other variable's query is filtered to patient_ids in the table. Its
+#     query groups by patient_id (or returns one row per patient), so SQL
+#     Server applies the filter below the grouping, to the rows it reads
+# The output is unchanged: the final join still applies the population.
+#
+# This only applies when the population is a categorised_as (or satisfying)
+# expression, as in study_definition.py.
+
+import os
+import re
+
+from cohortextractor.tpp_backend import TPPBackend
+
+from expressions import names, parse
+from shared_scans import SharedScanStudyDefinition, SharedScanTPPBackend
+
+POPULATION_FIRST = bool(os.environ.get("POPULATION_FIRST"))
+
+WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def variable_references(covariate_definitions, query_type, query_args):
+    """The other variables a variable's definition refers to."""
+    if query_type == "categorised_as":
+        return set().union(
+            *(
+                names(parse(expression))
+                for expression in query_args["category_definitions"].values()
+                if expression.strip() != "DEFAULT"
+            )
+        )
+    words = set()
+    for value in query_args.values():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for item in values:
+            if isinstance(item, str):
+                words.update(WORD.findall(item))
+    return words & set(covariate_definitions)
+
+
+def population_dependencies(covariate_definitions):
+    """The population and every variable it is defined from."""
+    needed = set()
+    pending = ["population"]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            query_type, query_args = covariate_definitions[name]
+            pending.extend(
+                variable_references(covariate_definitions, query_type, query_args)
+            )
+    return needed
+
+
+class PopulationFirstTPPBackend(SharedScanTPPBackend):
+    def get_queries(self, covariate_definitions):
+        self.population_ids = None
+        query_type, population_args = covariate_definitions["population"]
+        if query_type != "categorised_as":
+            return super().get_queries(covariate_definitions)
+
+        self.population_variables = population_dependencies(covariate_definitions)
+        self.population_ids = self.get_temp_table_name("population_ids")
+        self.column_queries = {}
+        queries = super().get_queries(covariate_definitions)
+
+        # run the population's own queries, then the table of ids, then the rest
+        first = []
+        rest = []
+        for name, column_queries in self.column_queries.items():
+            if name in self.population_variables:
+                first.extend(column_queries)
+            else:
+                rest.extend(column_queries)
+        assert len(first) + len(rest) == len(queries) - 1
+        population_args = {
+            key: value
+            for key, value in population_args.items()
+            if key not in ("return_expectations", "hidden")
+        }
+        population = self.get_case_expression(
+            self.population_columns, **population_args
+        )
+        return first + self.population_id_queries(population) + rest + queries[-1:]
+
+    def population_id_queries(self, population):
+        joins = "\n            ".join(
+            f"LEFT JOIN {table} ON {table}.patient_id = Patient.Patient_ID"
+            for table in population.source_tables
+        )
+        return [
+            f"""
+            -- Patients in the population, to limit the other variables to
+            SELECT Patient.Patient_ID AS patient_id
+            INTO {self.population_ids}
+            FROM Patient
+            {joins}
+            WHERE {population} = 1
+            """,
+            f"CREATE UNIQUE CLUSTERED INDEX patient_id_ix ON {self.population_ids} "
+            "(patient_id)",
+        ]
+
+    def get_queries_for_column(
+        self, column_name, query_type, query_args, output_columns
+    ):
+        queries = super().get_queries_for_column(
+            column_name, query_type, query_args, output_columns
+        )
+        if self.population_ids is None:
+            return queries
+        self.population_columns = output_columns
+        if (
+            column_name not in self.population_variables
+            and column_name not in self.scan_groups
+        ):
+            queries[-1] = f"""
+            SELECT * FROM ({queries[-1]}) t
+            WHERE t.patient_id IN (SELECT patient_id FROM {self.population_ids})
+            """
+        # the list is finished in place by get_queries, so this sees the
+        # final queries
+        self.column_queries[column_name] = queries
+        return queries
+
+    def shared_scan_groups(self, covariate_definitions):
+        # the population's variables are extracted before the shared scans
+        if self.population_ids is not None:
+            covariate_definitions = {
+                name: definition
+                for name, definition in covariate_definitions.items()
+                if name not in self.population_variables
+            }
+        return super().shared_scan_groups(covariate_definitions)
+
+    def scan_restriction(self, group):
+        if self.population_ids is None:
+            return ""
+        return (
+            f"INNER JOIN {self.population_ids} "
+            f"ON {self.population_ids}.patient_id = {group.table}.Patient_ID"
+        )
+
+
+class PopulationFirstStudyDefinition(SharedScanStudyDefinition):
+    """StudyDefinition which, with POPULATION_FIRST set, limits every variable
+    to the population, see above."""
+
+    @staticmethod
+    def get_backend_for_database_url(database_url):
+        Backend = SharedScanStudyDefinition.get_backend_for_database_url(database_url)
+        if POPULATION_FIRST and Backend in (TPPBackend, SharedScanTPPBackend):
+            return PopulationFirstTPPBackend
+        return Backend
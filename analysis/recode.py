@@ -0,0 +1,77 @@
+# CATEGORICAL RECODES
+#
+# cr_dataset_1a.do recodes each categorical string variable with a chain of
+# `replace x = k if s == "..."`, a pass over the data for every category. Here
+# a recode is a lookup table over the variable's categories, applied in one
+# pass: the column is coded against the categories, and the codes index an
+# array of the recoded values.
+#
+# The categories are the ones study_definition.py declares for the variable
+# and the recoded values are the do-file's. As in Stata, a declared category
+# the do-file has no value for is left missing, as is any value outside the
+# table; both are reported, so that eg a category spelt differently in the
+# study definition and the do-file shows up in the log.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from study_parameters import categories as declared_categories
+
+# `categories` are the declared categories followed by any the do-file recodes
+# that are not declared; `values` holds the recoded value of each, or NaN
+Recode = namedtuple("Recode", ["variable", "categories", "declared", "values"])
+
+
+def recode_table(variable, codes):
+    """The Recode of `variable` to the do-file's `codes` ({label: value})."""
+    declared = declared_categories(variable)
+    categories = declared + [label for label in codes if label not in declared]
+    values = np.array([codes.get(label, np.nan) for label in categories], np.float64)
+    return Recode(variable, categories, declared, values)
+
+
+def lookup(recode, column):
+    """Recode `column` in one pass, returning the values and category codes.
+
+    A category code of -1 is a value outside the table.
+    """
+    codes = pd.Index(recode.categories).get_indexer(column.values)
+    # code -1 picks up the trailing NaN
+    values = np.append(recode.values, np.nan)[codes]
+    return pd.Series(values, index=column.index), codes
+
+
+def unrecoded(recode, column, codes):
+    """Describe the rows `lookup` left missing, and any undeclared categories."""
+    lines = []
+    counts = np.bincount(codes + 1, minlength=len(recode.categories) + 1)
+    for label, value, n in zip(recode.categories, recode.values, counts[1:]):
+        if label not in recode.declared:
+            lines.append(
+                f'{recode.variable}: "{label}" is recoded but not declared '
+                f"in study_definition.py ({n} rows)"
+            )
+        elif np.isnan(value) and n:
+            lines.append(
+                f'{recode.variable}: {n} rows of "{label}" left missing '
+                "(declared in study_definition.py, not recoded)"
+            )
+    if counts[0]:
+        outside = column[codes == -1].value_counts(dropna=False)
+        for label, n in outside.items():
+            lines.append(
+                f'{recode.variable}: {n} rows of "{label}" left missing '
+                "(neither declared nor recoded)"
+            )
+    return lines
+
+
+def lookup_codes(recode, codes, labels):
+    """Recode integer category codes, whose labels are `labels` (-1 is blank).
+
+    Only the labels are looked up, so the rows are never compared as strings.
+    """
+    values, _ = lookup(recode, pd.Series(labels + [""], dtype=object))
+    return values.values[codes]
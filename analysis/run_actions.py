@@ -0,0 +1,316 @@
+# LOCAL PARALLEL ACTION RUNNER
+#
+# `opensafely run run_all` runs the actions of project.yaml one after another.
+# Here the `needs:` of the actions make a graph, and each action starts as
+# soon as everything it needs has finished, on a pool of MAX_WORKERS workers
+# (which .gitpod.yml sets, to keep within the workspace's memory), so eg
+# create_dataset_1b and create_table_1a run side by side once
+# create_dataset_1a is done.
+#
+# An action is skipped if nothing it depends on has changed since it last ran
+# successfully, going by content hashes of:
+#   - its command
+#   - its code: the files named in its command and, for Python and
+#     cohortextractor actions, which import them, every module in analysis/
+#     and codelist in codelists/
+#   - the declared outputs of the actions it needs
+#   - its own declared outputs, which must still be as it left them
+# The hashes are kept in output/.action_hashes.json; --force runs everything.
+# An action whose needs failed is not run.
+#
+# Actions run with `opensafely exec` (Python actions, with --local-python, run
+# with this interpreter instead), each logging to logs/<action>.log. The time
+# of each action and the end-to-end wall time are printed at the end.
+#
+# Usage: python analysis/run_actions.py [ACTION ...] [--force] [--local-python]
+#            [--max-workers N]
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+
+PROJECT = "project.yaml"
+STATE = "output/.action_hashes.json"
+LOG_DIR = "logs"
+
+# the code every Python and cohortextractor action may import
+SHARED_CODE = ["analysis/*.py", "codelists/*.csv"]
+
+BLOCK_SIZE = 1 << 20
+
+
+def load_actions(path=PROJECT):
+    with open(path) as f:
+        actions = yaml.safe_load(f)["actions"]
+    for name, action in actions.items():
+        for need in action.get("needs", []):
+            if need not in actions:
+                raise ValueError(f"{name} needs unknown action {need}")
+    return actions
+
+
+def with_needs(actions, targets):
+    """`targets` and every action they need, directly or not."""
+    wanted = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in actions:
+            raise ValueError(f"unknown action {name}")
+        if name not in wanted:
+            wanted.add(name)
+            pending.extend(actions[name].get("needs", []))
+    return wanted
+
+
+def depth(actions, name, seen=()):
+    """The length of the longest chain of needs below the action."""
+    if name in seen:
+        raise ValueError(f"the needs of {name} form a cycle")
+    needs = actions[name].get("needs", [])
+    return 1 + max((depth(actions, need, seen + (name,)) for need in needs), default=-1)
+
+
+def chain_lengths(actions, names):
+    """{action: the length of the longest chain of the `names` needing it}."""
+    lengths = {}
+
+    def length(name):
+        if name not in lengths:
+            dependants = [
+                other for other in names if name in actions[other].get("needs", [])
+            ]
+            lengths[name] = 1 + max(map(length, dependants), default=-1)
+        return lengths[name]
+
+    for name in names:
+        length(name)
+    return lengths
+
+
+def image(action):
+    return action["run"].split()[0].split(":")[0]
+
+
+def output_patterns(action):
+    return [
+        pattern
+        for outputs in action.get("outputs", {}).values()
+        for pattern in outputs.values()
+    ]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def files_digest(patterns, required=True):
+    """A hash of the files matching `patterns`, or None if one is `required`
+    and matches none."""
+    digest = hashlib.sha256()
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern))
+        if not paths and required:
+            return None
+        for path in paths:
+            digest.update(f"{path}\0{file_digest(path)}\0".encode())
+    return digest.hexdigest()
+
+
+def code_patterns(action):
+    files = [
+        arg
+        for arg in shlex.split(action["run"])[1:]
+        if arg.endswith((".py", ".do")) and os.path.isfile(arg)
+    ]
+    if image(action) in ("python", "cohortextractor"):
+        files += SHARED_CODE
+    return files
+
+
+def fingerprint(actions, name):
+    """A hash of everything the action's outputs depend on."""
+    action = actions[name]
+    parts = {
+        "run": action["run"],
+        "code": files_digest(code_patterns(action), required=False),
+        "inputs": {
+            need: files_digest(output_patterns(actions[need]))
+            for need in action.get("needs", [])
+        },
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def command(action, local_python=False):
+    args = shlex.split(action["run"])
+    if local_python and image(action) == "python":
+        return [sys.executable] + args[1:]
+    return ["opensafely", "exec"] + args
+
+
+def read_state(path=STATE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_state(state, path=STATE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def run_action(actions, name, last_run, force, local_python):
+    """Run the action unless it is unchanged; returns (status, its record)."""
+    action = actions[name]
+    record = {"fingerprint": fingerprint(actions, name)}
+    if not force and last_run == {
+        **record,
+        "outputs": files_digest(output_patterns(action)),
+    }:
+        return "unchanged", last_run
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(os.path.join(LOG_DIR, f"{name}.log"), "w") as log:
+        try:
+            result = subprocess.run(
+                command(action, local_python), stdout=log, stderr=subprocess.STDOUT
+            )
+        except OSError as e:
+            # eg opensafely is not installed
+            log.write(f"could not run {name}: {e}\n")
+            return "failed", None
+    outputs = files_digest(output_patterns(action))
+    if result.returncode != 0 or outputs is None:
+        return "failed", None
+    return "ran", {**record, "outputs": outputs}
+
+
+def timed(function, *args):
+    """Call `function`, returning when it began and ended, and its result."""
+    began = time.perf_counter()
+    result = function(*args)
+    return began, time.perf_counter(), result
+
+
+def run_actions(actions, names, max_workers, force=False, local_python=False):
+    """Run the actions `names` in order of their needs, up to `max_workers`
+    at a time; returns {name: (status, start, seconds)}.
+
+    Each pass over the pending actions takes them in order of depth, so an
+    action whose needs failed is marked not run in the same pass as they are.
+    Of the actions ready to run, those with the longest chains of actions
+    waiting on them start first.
+    """
+    state = read_state()
+    results = {}
+    pending = set(names)
+    running = {}
+    # depth finds any cycle in the needs, which chain_lengths would not end on
+    depths = {name: depth(actions, name) for name in names}
+    chains = chain_lengths(actions, names)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers) as pool:
+        while pending or running:
+            for name in sorted(pending, key=depths.get):
+                needs = actions[name].get("needs", [])
+                if any(
+                    results[need][0] in ("failed", "not run")
+                    for need in needs
+                    if need in results
+                ):
+                    pending.remove(name)
+                    results[name] = ("not run", None, 0.0)
+            ready = [
+                name
+                for name in pending
+                if all(need in results for need in actions[name].get("needs", []))
+            ]
+            ready.sort(key=lambda name: (-chains[name], name))
+            for name in ready[: max_workers - len(running)]:
+                pending.remove(name)
+                future = pool.submit(
+                    timed,
+                    run_action,
+                    actions,
+                    name,
+                    state.get(name),
+                    force,
+                    local_python,
+                )
+                running[future] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                began, ended, (status, record) = future.result()
+                results[name] = (status, began - start, ended - began)
+                if record is None:
+                    state.pop(name, None)
+                else:
+                    state[name] = record
+                write_state(state)
+                print(f"{name}: {status} in {ended - began:.1f}s", flush=True)
+    return results
+
+
+def report(results, wall_time, max_workers):
+    lines = []
+    for name, (status, started, elapsed) in sorted(
+        results.items(), key=lambda item: (item[1][1] is None, item[1][1] or 0)
+    ):
+        when = "" if started is None else f"+{started:.1f}s"
+        lines.append(f"  {name:<32} {status:<10} {when:>9} {elapsed:8.1f}s")
+    total = sum(elapsed for _, _, elapsed in results.values())
+    lines.append(
+        f"wall time {wall_time:.1f}s for {len(results)} actions with "
+        f"MAX_WORKERS={max_workers} (the actions took {total:.1f}s in all)"
+    )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("actions", nargs="*", help="defaults to every action")
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=int(os.environ.get("MAX_WORKERS") or os.cpu_count()),
+    )
+    parser.add_argument("--force", action="store_true", help="run unchanged actions")
+    parser.add_argument(
+        "--local-python",
+        action="store_true",
+        help="run Python actions with this interpreter, not opensafely exec",
+    )
+    args = parser.parse_args()
+
+    actions = load_actions()
+    names = with_needs(actions, args.actions or list(actions))
+    start = time.perf_counter()
+    results = run_actions(
+        actions, names, args.max_workers, args.force, args.local_python
+    )
+    print(report(results, time.perf_counter() - start, args.max_workers))
+    if any(status in ("failed", "not run") for status, _, _ in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
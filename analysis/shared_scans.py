@@ -0,0 +1,297 @@
+# SHARED SCANS OF THE CODED EVENT TABLES
+#
+# Most of the comorbidity variables are `with_these_clinical_events` queries
+# which return the first or last date (or just a flag) of a matching event in
+# a fixed period. The TPP backend scans CodedEvent once for each of them.
+# Here those variables are grouped by event table, and each group is answered
+# by a single scan against one codelist table which tags every code with the
+# codelist(s) it belongs to, so variables using the same codelist share a tag.
+#
+# The periods of a group's variables can differ (and do, when a study is
+# extracted at several index dates at once - see index_dates.py): their start
+# and end dates cut time into segments, and the scan keeps the first and last
+# matching date per patient, tag and segment. Every period is a run of whole
+# segments, so each variable's own query reads the first or last date of its
+# tag over the segments of its period.
+#
+# The scans are opt-in, with SHARED_SCANS set. They build on the internals of
+# cohortextractor's TPPBackend (get_queries_for_column, get_date_condition,
+# get_temp_table_name and its column state), so they refuse to run against
+# any cohortextractor but the one they were written for.
+
+import datetime
+import os
+import re
+from collections import namedtuple
+
+import cohortextractor
+from cohortextractor import StudyDefinition
+from cohortextractor.tpp_backend import (
+    TPPBackend,
+    coded_event_table_column,
+    make_batches_of_insert_statements,
+)
+
+SHARED_SCANS = bool(os.environ.get("SHARED_SCANS"))
+
+# the cohortextractor whose TPPBackend internals SharedScanTPPBackend overrides
+COHORTEXTRACTOR_VERSION = "1.93.3"
+
+ScanGroup = namedtuple("ScanGroup", ["table", "code_column", "variables"])
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def can_share_scan(query_type, query_args):
+    if query_type != "with_these_clinical_events":
+        return False
+    if query_args.get("returning") not in ("date", "binary_flag"):
+        return False
+    # anything that changes which events match, or needs more than the date of
+    # the match, keeps its own query
+    if (
+        query_args.get("ignore_days_where_these_codes_occur")
+        or query_args.get("ignore_missing_values")
+        or query_args.get("episode_defined_as")
+        or query_args.get("include_reference_range_columns")
+    ):
+        return False
+    # dates relative to other variables are joined per patient, so only fixed
+    # dates are grouped
+    between = query_args.get("between") or (None, None)
+    return all(date is None or ISO_DATE.match(date) for date in between)
+
+
+def plan_shared_scans(covariate_definitions, min_group_size=2):
+    """Group the variables which can share a scan of a coded event table.
+
+    Returns a list of ScanGroups; variables which are not in a group of at
+    least `min_group_size` keep their own query.
+    """
+    groups = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if not can_share_scan(query_type, query_args):
+            continue
+        key = coded_event_table_column(query_args["codelist"])
+        groups.setdefault(key, {})[name] = query_args
+    return [
+        ScanGroup(*key, variables)
+        for key, variables in groups.items()
+        if len(variables) >= min_group_size
+    ]
+
+
+def period(query_args):
+    return tuple(query_args.get("between") or (None, None))
+
+
+def check_cohortextractor_version(version=cohortextractor.__version__):
+    if version != COHORTEXTRACTOR_VERSION:
+        raise RuntimeError(
+            f"shared scans were written against cohortextractor "
+            f"{COHORTEXTRACTOR_VERSION}, not {version}: check them against its "
+            "TPPBackend, or unset SHARED_SCANS"
+        )
+
+
+def day_after(date):
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=1)).isoformat()
+
+
+def segment_cuts(group):
+    """The dates cutting time into segments, so every period is whole segments.
+
+    Segment i holds the dates from cut i - 1 (inclusive) to cut i (exclusive),
+    with segment 0 open to the past and the last segment open to the future.
+    """
+    cuts = set()
+    for query_args in group.variables.values():
+        start, end = period(query_args)
+        if start is not None:
+            cuts.add(start)
+        if end is not None:
+            cuts.add(day_after(end))
+    return sorted(cuts)
+
+
+def segment_range(cuts, between):
+    """The first and last segment of the period `between`."""
+    start, end = between
+    first = 0 if start is None else cuts.index(start) + 1
+    last = len(cuts) if end is None else cuts.index(day_after(end))
+    return first, last
+
+
+def scan_period(group):
+    """The period covering every variable's period."""
+    starts, ends = zip(*(period(query_args) for query_args in group.variables.values()))
+    start = None if None in starts else min(starts)
+    end = None if None in ends else max(ends)
+    return start, end
+
+
+def codelist_tags(group):
+    """{variable: tag}, where variables with the same codes share a tag."""
+    tags = {}
+    by_codes = {}
+    for name, query_args in group.variables.items():
+        codes = frozenset(codelist_codes(query_args["codelist"]))
+        tags[name] = by_codes.setdefault(codes, f"c{len(by_codes)}")
+    return tags
+
+
+def codelist_codes(codelist):
+    return (code[0] if codelist.has_categories else code for code in codelist)
+
+
+def describe_plan(covariate_definitions):
+    """Return a short summary of how many event table scans the plan saves."""
+    groups = plan_shared_scans(covariate_definitions)
+    shared = sum(len(group.variables) for group in groups)
+    lines = [f"{shared} variables answered by {len(groups)} shared scans"]
+    for group in groups:
+        tags = len(set(codelist_tags(group).values()))
+        segments = len(segment_cuts(group)) + 1
+        lines.append(
+            f"  {group.table} ({tags} codelists, {segments} segments): "
+            f"{', '.join(group.variables)}"
+        )
+    return "\n".join(lines)
+
+
+class SharedScanTPPBackend(TPPBackend):
+    def get_queries(self, covariate_definitions):
+        self.scan_groups = {}
+        self.scan_tables = {}
+        self.scan_tags = {}
+        self.scan_cuts = {}
+        for group in self.shared_scan_groups(covariate_definitions):
+            self.scan_tags.update(codelist_tags(group))
+            self.scan_cuts[group.table] = segment_cuts(group)
+            for name in group.variables:
+                self.scan_groups[name] = group
+        return super().get_queries(covariate_definitions)
+
+    def shared_scan_groups(self, covariate_definitions):
+        if not SHARED_SCANS:
+            return []
+        check_cohortextractor_version()
+        return plan_shared_scans(covariate_definitions)
+
+    def scan_restriction(self, group):
+        """A join limiting the patients a shared scan reads, or ""."""
+        return ""
+
+    def get_queries_for_column(
+        self, column_name, query_type, query_args, output_columns
+    ):
+        group = self.scan_groups.get(column_name)
+        if group is None:
+            return super().get_queries_for_column(
+                column_name, query_type, query_args, output_columns
+            )
+        # the first variable of each group carries the queries for the shared
+        # scan itself, which therefore run before any of its readers
+        queries = []
+        if group.table not in self.scan_tables:
+            self.output_columns = output_columns
+            self._current_column_name = None
+            queries = self.shared_scan_queries(group)
+        scan_table = self.scan_tables[group.table]
+        if query_args.get("find_first_match_in_period"):
+            date_column = "MIN(first_date)"
+        else:
+            date_column = "MAX(last_date)"
+        first, last = segment_range(self.scan_cuts[group.table], period(query_args))
+        queries.append(f"""
+            SELECT
+              patient_id,
+              1 AS binary_flag,
+              {date_column} AS date
+            FROM {scan_table}
+            WHERE tag = '{self.scan_tags[column_name]}'
+              AND segment BETWEEN {first} AND {last}
+            GROUP BY patient_id
+            """)
+        return queries
+
+    def shared_scan_queries(self, group):
+        codelist_table = self.get_temp_table_name("shared_scan_codelist")
+        scan_table = self.get_temp_table_name("shared_scan")
+        self.scan_tables[group.table] = scan_table
+
+        values = sorted(
+            {
+                (code, self.scan_tags[name])
+                for name, query_args in group.variables.items()
+                for code in codelist_codes(query_args["codelist"])
+            }
+        )
+        max_code_len = max(len(code) for code, _ in values)
+        max_tag_len = max(len(tag) for _, tag in values)
+        queries = [f"""
+            -- Uploading tagged codelist for shared scan of {group.table}
+            CREATE TABLE {codelist_table} (
+              code VARCHAR({max_code_len}) COLLATE Latin1_General_BIN NOT NULL,
+              tag VARCHAR({max_tag_len}) NOT NULL,
+              PRIMARY KEY (code, tag)
+            )
+            """]
+        queries += make_batches_of_insert_statements(
+            codelist_table, ("code", "tag"), values
+        )
+
+        date_condition, date_joins = self.get_date_condition(
+            group.table, "ConsultationDate", scan_period(group)
+        )
+        cuts = self.scan_cuts[group.table]
+        segment = segment_expression("CAST(ConsultationDate AS date)", cuts)
+        # SQL Server will not group by a constant, and with no cuts the
+        # segment is always 0
+        group_by = [f"{group.table}.Patient_ID", f"{codelist_table}.tag"]
+        if cuts:
+            group_by.append(segment)
+        queries.append(f"""
+            -- Shared scan for {', '.join(group.variables)}
+            SELECT
+              {group.table}.Patient_ID AS patient_id,
+              {codelist_table}.tag AS tag,
+              {segment} AS segment,
+              MIN(ConsultationDate) AS first_date,
+              MAX(ConsultationDate) AS last_date
+            INTO {scan_table}
+            FROM {group.table}
+            INNER JOIN {codelist_table}
+            ON {group.code_column} = {codelist_table}.code
+            {self.scan_restriction(group)}
+            {date_joins}
+            WHERE {date_condition}
+            GROUP BY {', '.join(group_by)}
+            """)
+        queries.append(
+            f"CREATE CLUSTERED INDEX tag_patient_ix ON {scan_table} "
+            "(tag, patient_id, segment)"
+        )
+        return queries
+
+
+def segment_expression(date_expr, cuts):
+    """SQL for the segment of `date_expr`: the number of cuts on or before it."""
+    if not cuts:
+        return "0"
+    cases = " ".join(
+        f"WHEN {date_expr} < '{cut}' THEN {i}" for i, cut in enumerate(cuts)
+    )
+    return f"CASE {cases} ELSE {len(cuts)} END"
+
+
+class SharedScanStudyDefinition(StudyDefinition):
+    """StudyDefinition which, with SHARED_SCANS set, extracts from TPP with
+    shared event table scans."""
+
+    @staticmethod
+    def get_backend_for_database_url(database_url):
+        Backend = StudyDefinition.get_backend_for_database_url(database_url)
+        if SHARED_SCANS and Backend is TPPBackend:
+            return SharedScanTPPBackend
+        return Backend
@@ -3,19 +3,41 @@
 # Import necessary functions
 
 from cohortextractor import (
-    StudyDefinition, 
     patients, 
     codelist, 
     filter_codes_by_category,
     codelist_from_csv  
 )
 
-# Import all codelists
-from codelists import *
+# With SHARED_SCANS set, TPP extraction answers the comorbidity variables from
+# a few shared scans of the coded event tables - see shared_scans.py - with
+# EXTRACTION_CACHE_DIR set, extracts only the columns whose definition changed
+# - see extraction_cache.py - and with POPULATION_FIRST set, only for the
+# patients in the population - see population_first.py
+from extraction_cache import IncrementalStudyDefinition
+
+# Table-driven variables - see variables.py
+from variables import EventDate, clinical_event_dates
+
+# Import codelists - the CSV codelists are only read when imported by name
+from codelists import (
+    ethnicity_codes,
+    high_risk_codes,
+    not_high_risk_codes,
+    clear_smoking_codes,
+    systolic_blood_pressure_codes,
+    diastolic_blood_pressure_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    asthma_codes,
+    chronic_respiratory_disease_codes,
+    pred_codes,
+    creatinine_codes,
+)
 
 
 # Specify study definition
-study = StudyDefinition(
+study = IncrementalStudyDefinition(
     index_date="2022-09-01",
     default_expectations={
         "date": {"earliest": "1900-01-01", "latest": "today"},
@@ -340,6 +362,10 @@ study = StudyDefinition(
                 find_last_match_in_period=True,
                 on_or_before="index_date",
                 returning="category",
+                return_expectations={
+                    "category": {"ratios": {"S": 0.6, "E": 0.2, "N": 0.2}},
+                    "incidence": 0.9,
+                },
             ),
             ever_smoked=patients.with_these_clinical_events(
                 filter_codes_by_category(clear_smoking_codes, include=["S", "E"]),
@@ -356,15 +382,14 @@ study = StudyDefinition(
         ),
 
     # COMORBIDITIES
+    # The dates of the first or last clinical event from a codelist are
+    # generated from tables of EventDate rows, one per variable - see variables.py:
+    # EventDate(variable, codelist in codelists.py, (start, end), first/last match)
+    # A start of None means on or before the end date.
 
         # HYPERTENSION - CLINICAL CODES ONLY
-        hypertension=patients.with_these_clinical_events(
-            hypertension_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
+        **clinical_event_dates(
+            EventDate("hypertension", "hypertension_codes", (None, "index_date"), "first"),
         ),
 
         # HIGH BLOOD PRESSURE
@@ -394,25 +419,14 @@ study = StudyDefinition(
             },
         ),
 
-        # DEMENTIA
-        dementia=patients.with_these_clinical_events(
-            dementia_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
+        **clinical_event_dates(
+            # DEMENTIA
+            EventDate("dementia", "dementia_codes", (None, "index_date"), "first"),
+            # DIABETES
+            EventDate("diabetes", "diabetes_codes", (None, "index_date"), "first"),
         ),
 
-        # DIABETES
-        diabetes=patients.with_these_clinical_events(
-            diabetes_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
+        # HBA1C
         hba1c_mmol_per_mol=patients.with_these_clinical_events(
             hba1c_new_codes,
             find_last_match_in_period=True,
@@ -440,24 +454,11 @@ study = StudyDefinition(
             },
         ),
 
-        # COPD
-        copd=patients.with_these_clinical_events(
-            copd_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        # OTHER RESPIRATORY DISEASES
-        other_respiratory=patients.with_these_clinical_events(
-            other_respiratory_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
+        **clinical_event_dates(
+            # COPD
+            EventDate("copd", "copd_codes", (None, "index_date"), "first"),
+            # OTHER RESPIRATORY DISEASES
+            EventDate("other_respiratory", "other_respiratory_codes", (None, "index_date"), "first"),
         ),
 
         # asthma
@@ -501,207 +502,48 @@ study = StudyDefinition(
                 pred_codes,
                 between=["index_date - 365 days", "index_date"],
                 returning="number_of_matches_in_period",
+                return_expectations={
+                    "int": {"distribution": "poisson", "mean": 2},
+                    "incidence": 0.7,
+                },
             ),
         ),
-        
-        # CANCER - 3 TYPES
-        cancer=patients.with_these_clinical_events(
-            combine_codelists(lung_cancer_codes, other_cancer_codes),
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        haem_cancer=patients.with_these_clinical_events(
-            haem_cancer_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_first_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        # IMMUNOSUPPRESSION
-        #### PERMANENT
-        permanent_immunodeficiency=patients.with_these_clinical_events(
-            combine_codelists(
-                hiv_codes,
-                permanent_immune_codes,
-                sickle_cell_codes,
-            ),
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        transplant=patients.with_these_clinical_events(
-            organ_transplant_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        asplenia=patients.with_these_clinical_events(
-            spleen_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        aplastic_anaemia=patients.with_these_clinical_events(
-            aplastic_codes,
-            between=["index_date - 365 days", "index_date"],
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={
-                "date": {"earliest": "2019-03-01", "latest": "index_date"}
-            },
-        ),
-        #### TEMPORARY
-        temporary_immunodeficiency=patients.with_these_clinical_events(
-            temp_immune_codes,
-            between=["2019-03-01", "index_date"],
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={
-                "date": {"earliest": "2019-03-01", "latest": "index_date"}
-            },
-        ),
 
-        # CARDIOVASCULAR DISEASE
-            # HEART FAILURE
-            heart_failure=patients.with_these_clinical_events(
-                heart_failure_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_first_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
+        **clinical_event_dates(
+            # CANCER - 3 TYPES
+            EventDate("cancer", "non_haem_cancer_codes", (None, "index_date"), "first"),
+            EventDate("haem_cancer", "haem_cancer_codes", (None, "index_date"), "first"),
+            # IMMUNOSUPPRESSION
+            #### PERMANENT
+            EventDate("permanent_immunodeficiency", "permanent_immunodeficiency_codes", (None, "index_date"), "last"),
+            EventDate("transplant", "organ_transplant_codes", (None, "index_date"), "last"),
+            EventDate("asplenia", "spleen_codes", (None, "index_date"), "last"),
+            EventDate(
+                "aplastic_anaemia", "aplastic_codes", ("index_date - 365 days", "index_date"), "last",
+                earliest="2019-03-01",
             ),
-
-            # stroke
-            stroke=patients.with_these_clinical_events(
-                stroke_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
-            ),
-            # Transient ischaemic attack
-            tia=patients.with_these_clinical_events(
-                tia_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
-            ),
-            # Myocardial infarction
-            myocardial_infarct=patients.with_these_clinical_events(
-                mi_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
+            #### TEMPORARY
+            EventDate(
+                "temporary_immunodeficiency", "temp_immune_codes", ("2019-03-01", "index_date"), "last",
+                earliest="2019-03-01",
             ),
-            # Chronic heart disease
-            heart_disease=patients.with_these_clinical_events(
-                chd_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
-            ),
-            # Peripheral artery disease
-            pad=patients.with_these_clinical_events(
-                pad_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
-            ),
-            # Venous thromboembolism
-            vte=patients.with_these_clinical_events(
-                vte_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
-            ),
-
-            # Atrial fibrillation
-            af=patients.with_these_clinical_events(
-                af_codes,
-                on_or_before="index_date",
-                returning="date",
-                find_last_match_in_period=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={"date": {"latest": "index_date"}},
-            ),
-
-        # Lupus
-        systemic_lupus_erythematosus=patients.with_these_clinical_events(
-            sle_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-        
-        # rheumatoid arthritis
-        rheumatoid_arthritis=patients.with_these_clinical_events(
-            rheumatoid_arthritis_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        # psoriasis
-        psoriasis=patients.with_these_clinical_events(
-            psoriasis_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        # liver disease
-        chronic_liver_disease=patients.with_these_clinical_events(
-            liver_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
-        ),
-
-        # other neurological disease
-        other_neuro = patients.with_these_clinical_events(
-            other_neuro_codes,
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
+            # CARDIOVASCULAR DISEASE
+            EventDate("heart_failure", "heart_failure_codes", (None, "index_date"), "first"),
+            EventDate("stroke", "stroke_codes", (None, "index_date"), "last"),
+            EventDate("tia", "tia_codes", (None, "index_date"), "last"),
+            EventDate("myocardial_infarct", "mi_codes", (None, "index_date"), "last"),
+            EventDate("heart_disease", "chd_codes", (None, "index_date"), "last"),
+            EventDate("pad", "pad_codes", (None, "index_date"), "last"),
+            EventDate("vte", "vte_codes", (None, "index_date"), "last"),
+            EventDate("af", "af_codes", (None, "index_date"), "last"),
+            # Lupus, rheumatoid arthritis, psoriasis
+            EventDate("systemic_lupus_erythematosus", "sle_codes", (None, "index_date"), "last"),
+            EventDate("rheumatoid_arthritis", "rheumatoid_arthritis_codes", (None, "index_date"), "last"),
+            EventDate("psoriasis", "psoriasis_codes", (None, "index_date"), "last"),
+            # liver disease
+            EventDate("chronic_liver_disease", "liver_codes", (None, "index_date"), "last"),
+            # other neurological disease
+            EventDate("other_neuro", "other_neuro_codes", (None, "index_date"), "last"),
         ),
 
         # CKD
@@ -726,16 +568,9 @@ study = StudyDefinition(
             date_format = "YYYY-MM-DD",
         ),
 
-        # kidney dialysis 
-        dialysis=patients.with_these_clinical_events(
-            dialysis_codes,  
-            on_or_before="index_date",
-            returning="date",
-            find_last_match_in_period=True,
-            date_format="YYYY-MM-DD",
-            return_expectations={"date": {"latest": "index_date"}},
+        **clinical_event_dates(
+            # kidney dialysis
+            EventDate("dialysis", "dialysis_codes", (None, "index_date"), "last"),
         ),
 
 )
-
-
@@ -0,0 +1,95 @@
+# STUDY PARAMETERS FOR THE PYTHON ACTIONS
+#
+# The Python actions run in the python image, which has no cohortextractor,
+# so they cannot import study_definition.py. Instead its source is parsed and
+# the literal arguments of the StudyDefinition call are read from there, so
+# that the index date (and anything else the actions need) is stated once,
+# in the study definition.
+
+import ast
+import functools
+import os
+
+STUDY_DEFINITION = os.path.join(os.path.dirname(__file__), "study_definition.py")
+
+# what numeric variables return, whose return_expectations may still give
+# their dummy values as categories (eg index_of_multiple_deprivation)
+NUMERIC_RETURNS = (
+    "index_of_multiple_deprivation",
+    "household_size",
+    "number_of_matches_in_period",
+    "numeric_value",
+)
+
+
+@functools.lru_cache()
+def study_definition_call(path=STUDY_DEFINITION):
+    """Return the ast.Call node of the `study = ...StudyDefinition(...)` call."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id.endswith("StudyDefinition")
+        ):
+            return node
+    raise ValueError(f"no StudyDefinition in {path}")
+
+
+def keyword_value(call, name):
+    for keyword in call.keywords:
+        if keyword.arg == name:
+            return ast.literal_eval(keyword.value)
+    raise KeyError(f"StudyDefinition has no {name} argument")
+
+
+def index_date(path=STUDY_DEFINITION):
+    """The study's index_date, eg "2022-09-01"."""
+    return keyword_value(study_definition_call(path), "index_date")
+
+
+def declared_categories(call):
+    """The categories a variable's call declares, or None if it has none.
+
+    For patients.categorised_as these are the keys of its categories;
+    otherwise they are the categories of its return_expectations.
+    """
+    if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Attribute):
+        return None
+    if call.func.attr == "categorised_as":
+        return list(ast.literal_eval(call.args[0]))
+    try:
+        expectations = keyword_value(call, "return_expectations")
+    except KeyError:
+        return None
+    if "category" not in expectations:
+        return None
+    return list(expectations["category"]["ratios"])
+
+
+def categories(variable, path=STUDY_DEFINITION):
+    """The categories study_definition.py declares for `variable`."""
+    for keyword in study_definition_call(path).keywords:
+        if keyword.arg == variable:
+            return declared_categories(keyword.value)
+    raise KeyError(f"StudyDefinition has no variable {variable}")
+
+
+def returning(call):
+    """The literal `returning` argument of a variable's call, or None."""
+    try:
+        return keyword_value(call, "returning")
+    except (KeyError, ValueError):
+        return None
+
+
+def categorical_variables(path=STUDY_DEFINITION):
+    """{variable: categories} for every non-numeric variable declaring
+    categories."""
+    variables = {}
+    for keyword in study_definition_call(path).keywords:
+        declared = declared_categories(keyword.value)
+        if declared is not None and returning(keyword.value) not in NUMERIC_RETURNS:
+            variables[keyword.arg] = declared
+    return variables
@@ -0,0 +1,246 @@
+# DESCRIPTIVE TABLES FOR OBJECTIVES 1A AND 1B
+#
+# Python version of tabulate_1a.do and tabulate_1b.do. The do-files write
+# each table row with several `count if` commands, so the dataset is scanned
+# again for every cell. Here all the counts come from one pass over the rows:
+# for each block of rows, a matrix with one indicator row per table row
+# (variable == level) is multiplied by the indicators of the two strata, which
+# gives the total, stratum == 1 and stratum == 0 count of every table row.
+#
+# Each row is then rounded, turned into percentages and redacted as it is
+# written (see disclosure.py), in the same way as the do-files:
+#   - counts are rounded to the nearest 5
+#   - "Total percent" is of the unrounded number of patients (%3.1f)
+#   - stratum percents are of the rounded stratum total (%4.2f)
+#   - rounded counts of 5 or less are removed and their percent "redacted"
+#   - the unrounded missing BMI/smoking footnote is kept as the last row
+# so only the _redacted.csv table is written.
+#
+# Usage: python analysis/tabulate.py 1a|1b [--input PATH]
+#            [--output-dir output/tables]
+
+import argparse
+import os
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from disclosure import RedactedTable, percent, round5
+from onset import COLUMN as ONSET_COLUMN
+
+# one `tabulatevariable` call; `missing` adds a row for missing values
+Section = namedtuple(
+    "Section", ["variable", "start", "end", "missing"], defaults=[False]
+)
+
+# `stratum` is the 0/1 variable of the two right-hand column groups, whose
+# headings are given for stratum == 1 then stratum == 0; `prepare(df, values)`
+# returns any variables the do-file creates before tabulating, where
+# values(variable) gives a variable of the dataset as an array
+Table = namedtuple(
+    "Table", ["input", "output", "stratum", "headings", "sections", "prepare"]
+)
+
+# rows per block of count_cells, small enough to keep a block in cache
+BLOCK_SIZE = 1 << 16
+
+
+def section_list(*middle):
+    """The sections of table 1a/1b, which differ only after region."""
+    return [
+        Section("cons", 1, 1),
+        Section("agegroup", 1, 6),
+        Section("sex", 1, 2),
+        Section("obese4cat", 0, 5, missing=True),
+        Section("smok_status", 1, 3, missing=True),
+        Section("eth5", 1, 5, missing=True),
+        Section("imd", 1, 5),
+        Section("region", 1, 8),
+        *middle,
+        Section("covid_vax_index", 1, 1),
+        Section("bp_cat", 1, 4, missing=True),
+        Section("highbp_hyper", 1, 1),
+        # comorbidities
+        Section("chronic_respiratory_disease", 1, 1),
+        Section("asthma", 1, 2),
+        Section("chd", 1, 1),
+        Section("diab", 1, 3),
+        Section("cancer", 1, 3),
+        Section("haemcancer", 1, 3),
+        Section("dialysis_index", 1, 1),
+        Section("chronic_liver_disease_index", 1, 1),
+        Section("strokedementia", 1, 1),
+        Section("other_neuro_index", 1, 1),
+        Section("transplant_index", 1, 1),
+        Section("asplenia_index", 1, 1),
+        Section("ra_p_sle", 1, 1),
+        Section("immunodeficiency", 1, 2),
+    ]
+
+
+def covid_stratum(df, values):
+    # tabulate_1b.do: rename first_positive_test_date_index covid, 0 if missing
+    return {"covid": np.nan_to_num(values("first_positive_test_date_index"))}
+
+
+TABLES = {
+    "1a": Table(
+        input="output/cr_dataset_1a.csv",
+        output="an_table_PublicationDescriptivesTable_1a_redacted.csv",
+        stratum="in_cis",
+        headings=("In CIS", "Not in CIS"),
+        sections=section_list(Section("first_positive_test_date_index", 1, 1)),
+        prepare=None,
+    ),
+    "1b": Table(
+        input="output/cr_dataset_1b.csv",
+        output="an_table_PublicationDescriptivesTable_1b_os_redacted.csv",
+        stratum="covid",
+        headings=("Had COVID", "No COVID"),
+        sections=section_list(Section("in_cis", 0, 1), Section("wave_test", 0, 5)),
+        prepare=covid_stratum,
+    ),
+}
+
+
+# COUNTING
+
+
+def cells(table):
+    """(variable, level) for every row of `table`; a level of None is missing."""
+    for section in table.sections:
+        for level in range(section.start, section.end + 1):
+            yield section.variable, level
+        if section.missing:
+            yield section.variable, None
+
+
+def count_cells(columns, stratum, cells, block_size=BLOCK_SIZE):
+    """Count each cell in total and for stratum == 1 and == 0.
+
+    `columns` maps each variable to its values. Each block of rows is turned
+    into a (cell x row) matrix of indicators and a (row x 3) matrix of
+    stratum indicators, and their product is the three counts for every
+    cell. Returns an int64 array of shape (cells, 3).
+    """
+    n = len(stratum)
+    # float32 counts are exact up to 2**24, far more than the rows in a block
+    indicators = np.empty((len(cells), min(block_size, n)), np.float32)
+    strata = np.ones((min(block_size, n), 3), np.float32)
+    counts = np.zeros((len(cells), 3), np.int64)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        rows = stop - start
+        np.equal(stratum[start:stop], 1, out=strata[:rows, 1])
+        np.equal(stratum[start:stop], 0, out=strata[:rows, 2])
+        for i, (variable, level) in enumerate(cells):
+            values = columns[variable][start:stop]
+            if level is None:
+                np.isnan(values, out=indicators[i, :rows])
+            else:
+                np.equal(values, level, out=indicators[i, :rows])
+        counts += (indicators[:, :rows] @ strata[:rows]).astype(np.int64)
+    return counts
+
+
+def stata_varname(columns, name):
+    """Resolve `name` as Stata does, allowing an unambiguous abbreviation."""
+    if name in columns:
+        return name
+    matches = [column for column in columns if column.startswith(name)]
+    if len(matches) != 1:
+        raise KeyError(f"variable {name} not found")
+    return matches[0]
+
+
+def tabulate(df, table, path, flags=None):
+    """Write `table` for the cr_dataset in `df` to `path`, redacted, and
+    return the number of rows written.
+
+    If `df` is a derived dataset that still has its onset bits, `flags` are
+    their OnsetFlags, and the `<var>_index` variables are read from the bits.
+    """
+    variables = list(df.columns)
+    onset = {}
+    if flags is not None:
+        onset = {f"{name}_index": name for name in flags.names}
+        variables += list(onset)
+
+    def values(variable):
+        if variable in created:
+            return np.asarray(created[variable])
+        if variable in onset:
+            return flags.values(df[ONSET_COLUMN].values, onset[variable])
+        return np.asarray(df[variable])
+
+    # variables made by the do-file are kept apart, so df is never copied
+    created = {"cons": np.ones(len(df), np.int8)}
+    if table.prepare is not None:
+        created.update(table.prepare(df, values))
+
+    overall = len(df)
+    stratum = values(table.stratum)
+    stratum_totals = round5([(stratum == 1).sum(), (stratum == 0).sum()])
+
+    table_cells = list(cells(table))
+    columns = {variable: values(variable) for variable, _ in table_cells}
+    counts = count_cells(columns, stratum, table_cells)
+
+    denominators = [(overall, 1), (stratum_totals[0], 2), (stratum_totals[1], 2)]
+    with RedactedTable(path, header(table), denominators) as out:
+        for (variable, level), row_counts in zip(table_cells, counts):
+            level = ">=." if level is None else f"=={level}"
+            out.write_counts([variable, level], row_counts)
+
+        # `cou if bmi==.` picks up the only variable whose name starts with bmi
+        bmi_missing = pd.isna(values(stata_varname(variables, "bmi"))).sum()
+        smok_missing = pd.isna(values("smok_status")).sum()
+        out.write_note(
+            [
+                "*missing could be included in 'not obese' "
+                f"(n = {bmi_missing} ({percent(bmi_missing, overall, 1)}%); "
+                "missing smoking could be included in 'never smoker' "
+                f"(n = {smok_missing} ({percent(smok_missing, overall, 1)}%))",
+                None,
+            ]
+        )
+    return out.rows
+
+
+# OUTPUT
+
+
+def stata_name(heading):
+    """The variable name `import delimited` gives a column heading."""
+    return re.sub(r"[^a-z0-9_]", "", heading.lower())
+
+
+def header(table):
+    headings = ["variable", "level", "Total N", "Total percent"]
+    for heading in table.headings:
+        headings += [f"{heading}, N", f"{heading}, percent"]
+    return [stata_name(heading) for heading in headings]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("table", choices=sorted(TABLES))
+    parser.add_argument("--input", help="defaults to the table's cr_dataset")
+    parser.add_argument("--output-dir", default="output/tables")
+    args = parser.parse_args()
+
+    table = TABLES[args.table]
+    start = time.perf_counter()
+    df = pd.read_csv(args.input or table.input, low_memory=False)
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, table.output)
+    rows = tabulate(df, table, path)
+    elapsed = time.perf_counter() - start
+    print(f"wrote {rows} rows for {len(df)} patients to {path} in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# VARIABLE FACTORY
+#
+# The comorbidity variables all have the same shape: the date of the first or
+# last clinical event from a codelist within a period. Rather than writing
+# each one out, they are declared as rows of a table and generated here. The
+# rows are plain tuples (codelists are referred to by name in codelists.py),
+# so a table is hashable and the variables it generates are built only once
+# per process.
+
+from collections import namedtuple
+from functools import lru_cache
+
+from cohortextractor import patients
+
+import codelists
+
+# period is (start, end); a start of None means "on or before end"
+EventDate = namedtuple(
+    "EventDate", ["name", "codelist", "period", "match", "earliest"], defaults=[None]
+)
+
+
+def clinical_event_dates(*rows):
+    """Return {name: variable} for a table of EventDate rows."""
+    return dict(_clinical_event_dates(rows))
+
+
+@lru_cache(maxsize=None)
+def _clinical_event_dates(rows):
+    variables = {}
+    for row in rows:
+        if row.match not in ("first", "last"):
+            raise ValueError(f"{row.name}: match must be 'first' or 'last'")
+        start, end = row.period
+        if start is None:
+            period = {"on_or_before": end}
+        else:
+            period = {"between": [start, end]}
+        expected_dates = {"latest": end}
+        if row.earliest is not None:
+            expected_dates = {"earliest": row.earliest, **expected_dates}
+
+        variables[row.name] = patients.with_these_clinical_events(
+            getattr(codelists, row.codelist),
+            **period,
+            returning="date",
+            **{f"find_{row.match}_match_in_period": True},
+            date_format="YYYY-MM-DD",
+            return_expectations={"date": expected_dates},
+        )
+    return variables
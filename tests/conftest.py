@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of analysis/ import one another as top-level modules, as they do
+# when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "analysis"))
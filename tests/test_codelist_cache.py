@@ -0,0 +1,39 @@
+import pytest
+
+import codelist_cache
+from codelist_cache import cache_path, cached_codelist_from_csv, file_sha, read_entry
+
+
+@pytest.fixture
+def csv_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(codelist_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    path = tmp_path / "codelist.csv"
+    path.write_text("code,term\nX2,b\nX1,a\nX2,b\n")
+    return str(path)
+
+
+def entry_sha(path):
+    return read_entry(cache_path(path, "code", None))["sha"]
+
+
+def test_entry_is_keyed_on_the_content_sha1(csv_path):
+    codes = cached_codelist_from_csv(csv_path, system="ctv3")
+    assert list(codes) == ["X1", "X2"]
+    assert codes.duplicates_collapsed == 1
+    assert entry_sha(csv_path) == file_sha(csv_path)
+
+    # read back from the cache on a stat hit, under the same key
+    assert list(cached_codelist_from_csv(csv_path, system="ctv3")) == ["X1", "X2"]
+    assert entry_sha(csv_path) == file_sha(csv_path)
+
+
+def test_entry_is_rebuilt_when_the_content_changes(csv_path):
+    cached_codelist_from_csv(csv_path, system="ctv3")
+    with open(csv_path, "a") as f:
+        f.write("X3,c\n")
+    assert list(cached_codelist_from_csv(csv_path, system="ctv3")) == [
+        "X1",
+        "X2",
+        "X3",
+    ]
+    assert entry_sha(csv_path) == file_sha(csv_path)
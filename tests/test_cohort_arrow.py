@@ -0,0 +1,56 @@
+import pyarrow as pa
+
+from cohort_arrow import ColumnType, convert, infer_schema
+
+
+def write_cohort(path, rows):
+    path.write_text(
+        "patient_id,household_id,asthma,sex,bmi,flag\n"
+        + "".join(",".join(map(str, row)) + "\n" for row in rows)
+    )
+
+
+def column_type(values, declared=()):
+    column_type = ColumnType(declared)
+    column_type.update(pa.array(values, pa.string()))
+    return column_type
+
+
+def test_declared_categories_are_categories_even_if_numbers():
+    asthma = column_type(["0", "1", "2", None], declared=["0", "1", "2"])
+    assert asthma.kind() == "category"
+    assert asthma.labels() == ["0", "1", "2"]
+    assert column_type(["0", "1", "2"]).kind() == "int"
+
+
+def test_undeclared_values_follow_the_declared_categories():
+    sex = column_type(["U", "F", "M"], declared=["M", "F"])
+    assert sex.labels() == ["M", "F", "U"]
+
+
+def test_declared_categories_with_no_values_are_still_categories():
+    assert column_type([None, None], declared=["M", "F"]).kind() == "category"
+
+
+def test_schema_is_the_same_for_small_and_large_ids(tmp_path):
+    small = tmp_path / "small.csv"
+    write_cohort(small, [(1, 0, 1, "F", 20.5, 1), (2, 3, 0, "M", "", 0)])
+    large = tmp_path / "large.csv"
+    write_cohort(large, [(10**11, 2**40, 2, "M", 30, 0), (7, 0, "", "F", 22.5, 1)])
+
+    schemas = [
+        convert(path, tmp_path / f"{path.stem}.feather") for path in (small, large)
+    ]
+    assert schemas[0] == schemas[1]
+    assert schemas[0].field("patient_id").type == pa.int64()
+    assert schemas[0].field("household_id").type == pa.int64()
+    assert schemas[0].field("asthma").type == pa.dictionary(pa.int8(), pa.string())
+    assert schemas[0].field("flag").type == pa.int8()
+
+
+def test_declared_categories_come_from_the_study_definition(tmp_path):
+    path = tmp_path / "input.csv"
+    write_cohort(path, [(1, 0, 2, "F", 20.5, 1)])
+    types = infer_schema(path)
+    assert types["asthma"].labels() == ["0", "1", "2"]
+    assert types["sex"].labels() == ["M", "F"]
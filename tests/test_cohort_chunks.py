@@ -0,0 +1,37 @@
+import pytest
+
+from cohort_chunks import iter_chunks, write_chunks
+
+
+def write_cohort(path, rows):
+    path.write_text(
+        "patient_id,note\n" + "".join(f'{i},"line\nbreak"\n' for i in range(rows))
+    )
+
+
+def test_rows_are_split_into_parts(tmp_path):
+    write_cohort(tmp_path / "input.csv", 5)
+    manifest = write_chunks(tmp_path / "input.csv", tmp_path / "chunks", 2)
+    assert [chunk["rows"] for chunk in manifest["chunks"]] == [2, 2, 1]
+    assert manifest["columns"] == ["patient_id", "note"]
+    parts = list(iter_chunks(tmp_path / "chunks"))
+    assert [list(part["patient_id"]) for part in parts] == [[0, 1], [2, 3], [4]]
+    assert parts[0]["note"][0] == "line\nbreak"
+
+
+def test_parts_of_an_earlier_cohort_are_removed(tmp_path):
+    write_cohort(tmp_path / "input.csv", 5)
+    write_chunks(tmp_path / "input.csv", tmp_path / "chunks", 1)
+    write_cohort(tmp_path / "input.csv", 2)
+    write_chunks(tmp_path / "input.csv", tmp_path / "chunks", 1)
+    assert sorted(path.name for path in (tmp_path / "chunks").iterdir()) == [
+        "manifest.json",
+        "part-00000.csv",
+        "part-00001.csv",
+    ]
+
+
+def test_empty_input_is_an_error(tmp_path):
+    (tmp_path / "input.csv").write_text("")
+    with pytest.raises(ValueError, match="is empty"):
+        write_chunks(tmp_path / "input.csv", tmp_path / "chunks", 10)
@@ -0,0 +1,98 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from cr_dataset_1a import compare, derive, read_input
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+# dummy_input.csv is 150 rows of dummy data for study_definition.py, and
+# cr_dataset_1a_snapshot.csv what the first port of cr_dataset_1a.do made of
+# them. The snapshot was not made by Stata, so it only catches changes in the
+# port's output: it says nothing of whether the port matches cr_dataset_1a.do,
+# which is what the compare_dataset_1a_python action reports on real data.
+DUMMY_INPUT = os.path.join(DATA, "dummy_input.csv")
+SNAPSHOT = os.path.join(DATA, "cr_dataset_1a_snapshot.csv")
+
+
+def run(tmp_path, compare_path, *args, backend=None):
+    env = {**os.environ, "OPENSAFELY_BACKEND": backend or "expectations"}
+    return subprocess.run(
+        [
+            sys.executable,
+            os.path.join("analysis", "cr_dataset_1a.py"),
+            f"--input={DUMMY_INPUT}",
+            f"--output={tmp_path / 'cr_dataset_1a_python.csv'}",
+            f"--compare={compare_path}",
+            f"--report={tmp_path / 'report.txt'}",
+            *args,
+        ],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+    )
+
+
+def test_dummy_data_output_is_unchanged_from_the_snapshot(tmp_path):
+    assert run(tmp_path, SNAPSHOT).returncode == 0
+    output = tmp_path / "cr_dataset_1a_python.csv"
+    assert compare(output, SNAPSHOT) == []
+    assert output.read_bytes() == open(SNAPSHOT, "rb").read()
+    assert "matches" in (tmp_path / "report.txt").read_text()
+
+
+def test_differences_are_reported(tmp_path):
+    changed = pd.read_csv(SNAPSHOT, dtype=str, keep_default_na=False)
+    changed.loc[0, "agegroup"] = "9"
+    changed_path = tmp_path / "changed.csv"
+    changed.to_csv(changed_path, index=False)
+
+    assert run(tmp_path, changed_path).returncode == 0
+    assert (tmp_path / "report.txt").read_text() == "agegroup: 1 rows differ\n"
+    assert run(tmp_path, changed_path, "--strict").returncode == 1
+
+
+def test_compare_only_compares_the_existing_output(tmp_path):
+    output = tmp_path / "cr_dataset_1a_python.csv"
+    output.write_bytes(open(SNAPSHOT, "rb").read())
+    assert (
+        run(tmp_path, SNAPSHOT, "--compare-only", "--input=missing.csv").returncode == 0
+    )
+    assert "matches" in (tmp_path / "report.txt").read_text()
+
+
+def in_population(df):
+    """The rows of `df` the study's population selects, but for `died`, which
+    the cohort drops don't repeat (and which is 1 throughout the dummy data)."""
+    return df[
+        (df["age"] >= 18)
+        & (df["age"] < 120)
+        & df["sex"].isin(["M", "F"])
+        & df["is_registered_with_tpp"].notna()
+        & df["has_follow_up"].notna()
+        & df["is_registered_with_tpp_feb2020"].notna()
+    ]
+
+
+def test_population_filtered_input_passes_the_check():
+    df = in_population(read_input(DUMMY_INPUT))
+    assert 0 < len(df) < 150
+    pd.testing.assert_frame_equal(
+        derive(df.copy(), population_filtered=True), derive(df.copy())
+    )
+
+
+def test_unfiltered_input_fails_the_check():
+    with pytest.raises(ValueError, match="should already be limited"):
+        derive(read_input(DUMMY_INPUT), population_filtered=True)
+
+
+def test_population_filtered_is_not_checked_on_dummy_data(tmp_path):
+    assert run(tmp_path, SNAPSHOT, "--population-filtered").returncode == 0
+    failed = run(tmp_path, SNAPSHOT, "--population-filtered", backend="tpp")
+    assert failed.returncode == 1
+    assert b"should already be limited" in failed.stderr
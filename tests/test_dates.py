@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from dates import (
+    MISSING_DATE,
+    day_number,
+    day_numbers,
+    decode_date_matrix,
+    decode_dates,
+    to_datetime64,
+)
+
+
+def test_day_numbers_count_from_1960_as_stata_dates_do():
+    assert day_number("1960-01-01") == 0
+    assert day_number("1959-12-31") == -1
+    assert day_number("2022-09-01") == 22889
+    assert day_number("2020-02-29") == 21974
+
+
+def test_blank_and_invalid_dates_are_missing():
+    df = pd.DataFrame(
+        {
+            "date": [
+                "2022-09-01",
+                "",
+                None,
+                np.nan,
+                "2022-02-30",
+                "2022-13-01",
+                "20220901",
+                "2022-9-1",
+                " 2022-09-01",
+                "not a date",
+            ]
+        }
+    )
+    days = decode_date_matrix(df, ["date"])
+    assert days.dtype == np.int32
+    assert days.tolist() == [[22889] + [MISSING_DATE] * 9]
+
+
+def test_months_are_the_first_of_the_month():
+    # cr_dataset_1a.do: replace day="1" if month!="" & day==""
+    df = pd.DataFrame({"date": ["2020-02", "2020-13", "2020-2"]})
+    assert decode_date_matrix(df, ["date"]).tolist() == [
+        [day_number("2020-02-01"), MISSING_DATE, MISSING_DATE]
+    ]
+
+
+def test_missing_is_after_every_date():
+    df = pd.DataFrame({"date": ["2200-12-31", ""]})
+    days = decode_date_matrix(df, ["date"])[0]
+    assert days[0] < days[1] == MISSING_DATE
+
+
+def test_columns_are_decoded_in_order():
+    df = pd.DataFrame(
+        {
+            "a": ["2022-09-01", "", "2020-01-01"],
+            "b": ["2020-01-01", "2022-09-01", ""],
+            "c": ["", "", ""],
+        }
+    )
+    days = decode_date_matrix(df, ["c", "a", "b"])
+    assert days.shape == (3, 3)
+    assert days.tolist() == [
+        [MISSING_DATE] * 3,
+        [22889, MISSING_DATE, 21915],
+        [21915, 22889, MISSING_DATE],
+    ]
+    assert decode_dates(df, ["b"])["b"].tolist() == days[2].tolist()
+    assert decode_date_matrix(df, []).shape == (0, 3)
+
+
+def test_day_numbers_round_trip_through_datetime64():
+    days = np.array([0, -1, 22889, MISSING_DATE], np.int32)
+    dates = to_datetime64(days)
+    assert list(np.datetime_as_string(dates[:3], unit="D")) == [
+        "1960-01-01",
+        "1959-12-31",
+        "2022-09-01",
+    ]
+    assert np.isnat(dates[3])
+    assert day_numbers(dates).tolist() == days.tolist()
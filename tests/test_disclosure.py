@@ -0,0 +1,67 @@
+import csv
+
+from disclosure import RedactedTable, percent, round5
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_round5_rounds_halves_up():
+    assert list(round5([0, 2, 3, 7, 8, 12, 13, 22.5, 27.5])) == [
+        0,
+        0,
+        5,
+        5,
+        10,
+        10,
+        15,
+        25,
+        30,
+    ]
+
+
+def test_percent_is_formatted_as_stata_does():
+    assert percent(1, 3, 1) == "33.3"
+    assert percent(2, 3, 2) == "66.67"
+    assert percent(5, 200, 1) == "2.5"
+    assert percent(5, 0, 2) == "   ."
+
+
+def test_counts_are_rounded_and_small_ones_redacted(tmp_path):
+    path = tmp_path / "table.csv"
+    header = ["variable", "level", "totaln", "totalpercent", "an", "apercent"]
+    with RedactedTable(path, header, [(200, 1), (60, 2)]) as table:
+        table.write_counts(["sex", "==1"], [103, 8])
+        table.write_counts(["sex", "==2"], [97, 52])
+        table.write_counts(["sex", "==3"], [0, 0])
+    assert table.rows == 3
+    assert read_rows(path) == [
+        header,
+        ["sex", "==1", "105", " (52.5)", "10", " (16.67)"],
+        ["sex", "==2", "95", " (47.5)", "50", " (83.33)"],
+        ["sex", "==3", "", "redacted", "", "redacted"],
+    ]
+
+
+def test_counts_of_five_or_less_after_rounding_are_redacted(tmp_path):
+    path = tmp_path / "table.csv"
+    with RedactedTable(
+        path, ["variable", "level", "n", "percent"], [(100, 1)]
+    ) as table:
+        for n in [5, 7, 8]:
+            table.write_counts(["x", f"=={n}"], [n])
+    assert read_rows(path)[1:] == [
+        ["x", "==5", "", "redacted"],
+        ["x", "==7", "", "redacted"],
+        ["x", "==8", "10", " (10.0)"],
+    ]
+
+
+def test_note_row_has_every_count_redacted(tmp_path):
+    path = tmp_path / "table.csv"
+    header = ["variable", "level", "n", "percent", "an", "apercent"]
+    with RedactedTable(path, header, [(100, 1), (50, 2)]) as table:
+        table.write_note(["*a footnote", None])
+    assert read_rows(path)[1:] == [["*a footnote", "", "", "redacted", "", "redacted"]]
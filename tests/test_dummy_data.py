@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+ANALYSIS = os.path.join(os.path.dirname(__file__), "..", "analysis")
+
+STUDY = """
+from cohortextractor import StudyDefinition, patients
+
+study = StudyDefinition(
+    default_expectations={
+        "date": {"earliest": "2020-01-01", "latest": "2021-12-31"},
+        "rate": "exponential_increase",
+        "incidence": 0.3,
+    },
+    population=patients.all(),
+    age=patients.age_as_of(
+        "2020-02-01",
+        return_expectations={"int": {"distribution": "population_ages"}},
+    ),
+    sex=patients.sex(
+        return_expectations={"category": {"ratios": {"F": 0.5, "M": 0.5}}}
+    ),
+    died=patients.died_from_any_cause(
+        returning="date_of_death", date_format="YYYY-MM-DD"
+    ),
+    group=patients.categorised_as(
+        {"0": "DEFAULT", "1": "age < 40 AND sex = 'F'", "2": "age >= 40"},
+        return_expectations={"category": {"ratios": {"0": 0.5, "1": 0.25, "2": 0.25}}},
+    ),
+)
+"""
+
+
+def generate(tmp_path, workers, hash_seed):
+    output = tmp_path / f"workers_{workers}.csv"
+    env = dict(
+        os.environ,
+        PYTHONHASHSEED=str(hash_seed),
+        PYTHONPATH=os.pathsep.join([ANALYSIS, str(tmp_path)]),
+    )
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ANALYSIS, "dummy_data.py"),
+            "--expectations-population=2500",
+            "--shard-rows=1000",
+            f"--workers={workers}",
+            "--seed=3",
+            "--study-definition=small_study",
+            f"--output={output}",
+        ],
+        env=env,
+        cwd=tmp_path,
+        check=True,
+        capture_output=True,
+    )
+    return output.read_bytes()
+
+
+def test_output_is_the_same_whatever_the_number_of_workers(tmp_path):
+    (tmp_path / "small_study.py").write_text(STUDY)
+    one = generate(tmp_path, workers=1, hash_seed=1)
+    assert one.count(b"\n") == 2501
+    assert generate(tmp_path, workers=3, hash_seed=2) == one
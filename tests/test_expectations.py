@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+ANALYSIS = os.path.join(os.path.dirname(__file__), "..", "analysis")
+
+# a variable derived from hidden variables, which are only sampled (in the
+# order of its references) as it is derived
+SAMPLE = """
+import hashlib
+
+import numpy as np
+from cohortextractor import StudyDefinition, patients
+
+from expectations import sample_cohort
+
+study = StudyDefinition(
+    default_expectations={
+        "date": {"earliest": "2020-01-01", "latest": "2021-12-31"},
+        "rate": "uniform",
+        "incidence": 0.5,
+    },
+    population=patients.all(),
+    group=patients.categorised_as(
+        {
+            "0": "DEFAULT",
+            "1": "age < 40 AND sex = 'F' AND NOT died",
+            "2": "age >= 40 AND (sex = 'M' OR died)",
+        },
+        return_expectations={"category": {"ratios": {"0": 0.5, "1": 0.25, "2": 0.25}}},
+        age=patients.age_as_of(
+            "2020-02-01",
+            return_expectations={"int": {"distribution": "population_ages"}},
+        ),
+        sex=patients.sex(
+            return_expectations={"category": {"ratios": {"F": 0.5, "M": 0.5}}}
+        ),
+        died=patients.died_from_any_cause(returning="binary_flag"),
+    ),
+)
+cohort = sample_cohort(study, 1000, np.random.default_rng(7))
+print(hashlib.sha1(cohort.to_csv(index=False).encode()).hexdigest())
+"""
+
+
+def sample_in_new_interpreter(hash_seed):
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed), PYTHONPATH=ANALYSIS)
+    result = subprocess.run(
+        [sys.executable, "-c", SAMPLE],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()[-1]
+
+
+def test_same_seed_samples_the_same_cohort_in_every_interpreter():
+    digests = {sample_in_new_interpreter(hash_seed) for hash_seed in range(4)}
+    assert len(digests) == 1
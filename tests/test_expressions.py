@@ -0,0 +1,229 @@
+import ast
+import re
+import sqlite3
+
+import numpy as np
+import pytest
+from cohortextractor.tpp_backend import ColumnExpression, TPPBackend
+
+from expressions import Plan, canonical, categorise, category_plan, names, parse
+from study_parameters import study_definition_call
+
+ASTHMA = (
+    "(recent_asthma_code OR (asthma_code_ever AND NOT copd_code_ever)) "
+    "AND (prednisolone_last_year = 0 OR prednisolone_last_year > 4)",
+    "(recent_asthma_code OR (asthma_code_ever AND NOT copd_code_ever)) "
+    "AND prednisolone_last_year > 0 AND prednisolone_last_year < 5",
+)
+
+
+def study_categories():
+    """{variable: category_definitions} of every categorised_as and satisfying
+    in study_definition.py, hidden ones included.
+
+    The study can't be loaded without a cohortextractor with every query it
+    uses, so its expressions are read from the source.
+    """
+    found = {}
+    for node in ast.walk(study_definition_call()):
+        for keyword in getattr(node, "keywords", []):
+            call = keyword.value
+            if not (
+                isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)
+            ):
+                continue
+            if call.func.attr == "categorised_as":
+                found[keyword.arg] = ast.literal_eval(call.args[0])
+            elif call.func.attr == "satisfying":
+                found[keyword.arg] = {1: ast.literal_eval(call.args[0]), 0: "DEFAULT"}
+    return found
+
+
+def column_types(expressions):
+    """{name: "str" or "int"}: a name compared to a quoted string is text."""
+    text = "\n".join(expressions)
+    types = {}
+    for name in set().union(*(names(parse(expression)) for expression in expressions)):
+        compared = rf"\b{name}\s*(=|!=|<>)\s*['\"]"
+        types[name] = "str" if re.search(compared, text) else "int"
+    return types
+
+
+def random_frame(expressions, types, rows, rng):
+    """Columns taking the values the expressions test, either side of them,
+    and empty."""
+    literals = re.findall(r"'([^']*)'|\"([^\"]*)\"|\b(\d+)\b", "\n".join(expressions))
+    strings = {a or b for a, b, _ in literals if a or b} | {"", "other"}
+    numbers = {int(n) for _, _, n in literals if n}
+    numbers = sorted({0, 1} | {n + d for n in numbers for d in (-1, 0, 1)})
+    columns = {}
+    for name, kind in types.items():
+        if kind == "str":
+            columns[name] = rng.choice(sorted(strings), rows).astype(object)
+        else:
+            columns[name] = rng.choice(numbers, rows).astype(np.int64)
+    return columns
+
+
+def cohortextractor_categories(category_definitions, types, columns):
+    """The categories cohortextractor's own CASE expression gives each row,
+    evaluated by SQLite."""
+    other_columns = {
+        name: ColumnExpression(
+            name, type=kind, default_value="" if kind == "str" else 0
+        )
+        for name, kind in types.items()
+    }
+    # get_case_expression uses nothing a backend is constructed with
+    backend = TPPBackend.__new__(TPPBackend)
+    case = backend.get_case_expression(other_columns, "str", category_definitions)
+    db = sqlite3.connect(":memory:")
+    db.execute(f"CREATE TABLE frame (row, {', '.join(types)})")
+    rows = len(next(iter(columns.values())))
+    db.executemany(
+        f"INSERT INTO frame VALUES ({', '.join('?' * (len(types) + 1))})",
+        [
+            (
+                i,
+                *(
+                    columns[name][i].item() if kind == "int" else columns[name][i]
+                    for name, kind in types.items()
+                ),
+            )
+            for i in range(rows)
+        ],
+    )
+    return [
+        str(value) for (value,) in db.execute(f"SELECT {case} FROM frame ORDER BY row")
+    ]
+
+
+def assert_same_categories(category_definitions, rows=3000, seed=0):
+    """categorise() gives each row of a random frame the category
+    cohortextractor does; returns the categories given."""
+    expressions = [
+        expression
+        for expression in category_definitions.values()
+        if expression.strip() != "DEFAULT"
+    ]
+    types = column_types(expressions)
+    columns = random_frame(expressions, types, rows, np.random.default_rng(seed))
+    ours = categorise(category_definitions, columns, rows)
+    theirs = cohortextractor_categories(category_definitions, types, columns)
+    assert [str(label) for label in ours] == theirs
+    return set(theirs)
+
+
+STUDY_CATEGORIES = study_categories()
+
+
+def test_every_categorised_as_in_the_study_is_found():
+    assert set(STUDY_CATEGORIES) == {
+        "population",
+        "ageband_broad",
+        "ethnicity",
+        "shielded",
+        "smoking_status",
+        "asthma",
+    }
+
+
+@pytest.mark.parametrize("variable", sorted(STUDY_CATEGORIES))
+def test_study_categories_agree_with_cohortextractor(variable):
+    category_definitions = STUDY_CATEGORIES[variable]
+    # every category is reached, so the comparison covers each of them
+    assert assert_same_categories(category_definitions) == {
+        str(label) for label in category_definitions
+    }
+
+
+@pytest.mark.parametrize(
+    "category_definitions",
+    [
+        # the first matching category is taken, wherever DEFAULT is
+        {"default": "DEFAULT", "a": "x > 2", "b": "x > 1", "c": "x > 0"},
+        {"c": "x > 0", "b": "x > 1", "default": "DEFAULT"},
+        # AND binds tighter than OR, and NOT tighter than both
+        {"yes": "x = 1 OR y = 1 AND NOT z", "no": "DEFAULT"},
+        {"yes": "NOT x = 1 AND y OR z = 2", "no": "DEFAULT"},
+        # arithmetic, literals on the left and strings
+        {"yes": "x + 1 > y * 2 - z", "no": "DEFAULT"},
+        {"yes": "2 < x AND s != 'a' AND NOT t", "no": "DEFAULT", "c": "s = 'a'"},
+    ],
+)
+def test_precedence_agrees_with_cohortextractor(category_definitions):
+    assert len(assert_same_categories(category_definitions, rows=500)) > 1
+
+
+def test_equivalent_subexpressions_are_the_same():
+    assert canonical(parse("a AND (b AND c)")) == canonical(parse("(c AND a) AND b"))
+    assert canonical(parse("a OR a")) == canonical(parse("a"))
+    assert canonical(parse("NOT NOT (a OR b)")) == canonical(parse("b OR a"))
+    assert canonical(parse("a AND b")) != canonical(parse("a OR b"))
+
+
+def test_shared_subexpressions_get_one_slot():
+    plan = Plan([parse(expression) for expression in ASTHMA])
+    shared = canonical(
+        parse("recent_asthma_code OR (asthma_code_ever AND NOT copd_code_ever)")
+    )
+    # every subexpression (and name) is one step, however often it is used
+    assert len(plan.steps) == len(set(map(repr, plan.steps)))
+    assert shared in plan.slots
+    slot = plan.slots[shared]
+    assert sum(slot in Plan.operands(step) for step in plan.steps) == 2
+    assert [step for step in plan.steps if step == ("name", "copd_code_ever")] == [
+        ("name", "copd_code_ever")
+    ]
+    # the same expression twice is one output
+    plan = Plan([parse("a AND b"), parse("b AND a")])
+    assert plan.outputs[0] == plan.outputs[1]
+
+
+def test_slots_are_released_after_their_last_use():
+    plan = Plan([parse(expression) for expression in ASTHMA])
+    released = [slot for slots in plan.release for slot in slots]
+    assert len(released) == len(set(released))
+    for i, slots in enumerate(plan.release):
+        for slot in slots:
+            assert slot in Plan.operands(plan.steps[i])
+            assert not any(slot in Plan.operands(step) for step in plan.steps[i + 1 :])
+    used = {slot for step in plan.steps for slot in Plan.operands(step)}
+    assert set(released) == used - set(plan.outputs)
+
+
+def test_released_slots_are_dropped_while_running():
+    plan = Plan([parse(expression) for expression in ASTHMA])
+    columns = {
+        "recent_asthma_code": np.array([1, 0, 0, 0, 1]),
+        "asthma_code_ever": np.array([1, 1, 1, 0, 1]),
+        "copd_code_ever": np.array([0, 0, 1, 0, 1]),
+        "prednisolone_last_year": np.array([0, 3, 0, 0, 5]),
+    }
+    held = []
+
+    class Watched(Plan):
+        def run_step(self, step, values, codes, columns):
+            held.append(sum(value is not None for value in values))
+            return super().run_step(step, values, codes, columns)
+
+    watched = Watched([parse(expression) for expression in ASTHMA])
+    results = watched.run(columns)
+    # before each step, the only values held are those still to be used
+    for i, n in enumerate(held):
+        live = {
+            slot for step in plan.steps[i:] for slot in Plan.operands(step) if slot < i
+        }
+        live.update(slot for slot in plan.outputs if slot < i)
+        assert n == len(live)
+    assert max(held) < len(plan.steps) // 2
+    np.testing.assert_array_equal(results[0], [True, False, False, False, True])
+    np.testing.assert_array_equal(results[1], [False, True, False, False, False])
+
+
+def test_category_plans_are_compiled_once():
+    definitions = tuple(STUDY_CATEGORIES["asthma"].items())
+    assert category_plan(definitions) is category_plan(definitions)
+    labels, default, _ = category_plan(definitions)
+    assert labels == ["1", "2"]
+    assert default == "0"
@@ -0,0 +1,74 @@
+import numpy as np
+
+from households import HouseholdIndex, household_features, patient_features, read_flags
+
+# household 0 is no household: patients 4 and 7 are in none, whatever their
+# own flags
+COHORT = """\
+patient_id,household_id,household_size,covid_vax,first_positive_test_date,in_cis
+1,20,3,2021-01-01,,1
+2,10,2,,2020-05-01,1
+3,20,3,2021-02-01,2020-06-01,0
+4,0,0,2021-01-01,2020-01-01,1
+5,10,2,,,0
+6,20,3,,,1
+7,0,0,,,0
+"""
+
+
+def features(tmp_path, chunk_rows=2):
+    path = tmp_path / "input.csv"
+    path.write_text(COHORT)
+    df = read_flags(path, chunk_rows)
+    index, households = household_features(df)
+    return index, households, patient_features(df, index, households)
+
+
+def test_household_features(tmp_path):
+    _, households, _ = features(tmp_path)
+    assert households.to_dict("list") == {
+        "household_id": [10, 20],
+        "household_size": [2, 3],
+        "members": [2, 3],
+        "in_cis": [1, 2],
+        "positive": [1, 1],
+        "vaccinated": [0, 2],
+    }
+
+
+def test_patient_features_leave_out_the_patients_own_values(tmp_path):
+    _, _, patients = features(tmp_path)
+    assert patients.to_dict("list") == {
+        "patient_id": [1, 2, 3, 4, 5, 6, 7],
+        "household_id": [20, 10, 20, 0, 10, 20, 0],
+        "household_members": [3, 2, 3, 0, 2, 3, 0],
+        "household_others_in_cis": [1, 0, 2, 0, 1, 1, 0],
+        "household_others_positive": [1, 0, 0, 0, 1, 1, 0],
+        "household_others_vaccinated": [1, 0, 1, 0, 0, 2, 0],
+    }
+
+
+def test_chunking_does_not_change_the_features(tmp_path):
+    _, households, patients = features(tmp_path, chunk_rows=2)
+    _, whole_households, whole_patients = features(tmp_path, chunk_rows=100)
+    assert households.equals(whole_households)
+    assert patients.equals(whole_patients)
+
+
+def test_members_are_the_rows_of_each_household():
+    index = HouseholdIndex([20, 10, 20, 0, 10, 20, 0])
+    assert len(index) == 2
+    assert list(index.ids) == [10, 20]
+    assert index.members(0).tolist() == [1, 4]
+    assert index.members(1).tolist() == [0, 2, 5]
+    assert index.codes.tolist() == [1, 0, 1, -1, 0, 1, -1]
+    np.testing.assert_array_equal(
+        index.gather([5, 6], missing=-1), [6, 5, 6, -1, 5, 6, -1]
+    )
+
+
+def test_no_households():
+    index = HouseholdIndex([0, 0])
+    assert len(index) == 0
+    assert index.count([True, True]).tolist() == []
+    assert index.gather(np.array([], np.int64)).tolist() == [0, 0]
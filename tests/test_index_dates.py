@@ -0,0 +1,190 @@
+import pandas as pd
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+from extraction_cache import output_columns
+from index_dates import (
+    batches,
+    combined_definitions,
+    index_date_range,
+    rename_references,
+    split_by_date,
+)
+
+ASTHMA = codelist(["X1", "X2"], system="ctv3")
+
+DATES = ["2020-03-01", "2020-02-01", "2020-01-01"]
+
+
+def study():
+    return StudyDefinition(
+        index_date="2020-01-01",
+        population=patients.satisfying(
+            "registered AND age >= 18",
+            registered=patients.registered_as_of("index_date"),
+        ),
+        age=patients.age_as_of("index_date"),
+        sex=patients.sex(),
+        ever_asthma=patients.with_these_clinical_events(
+            ASTHMA, returning="binary_flag"
+        ),
+        asthma_date=patients.with_these_clinical_events(
+            ASTHMA,
+            returning="date",
+            between=["index_date - 1 year", "index_date"],
+        ),
+        ageband=patients.categorised_as(
+            {"young": "age < 40", "old": "DEFAULT"},
+            return_expectations={"category": {"ratios": {"young": 0.5, "old": 0.5}}},
+        ),
+        asthma_month=patients.date_of("asthma_date", date_format="YYYY-MM"),
+    )
+
+
+@pytest.mark.parametrize(
+    "date_range, dates",
+    [
+        ("2022-09-01", ["2022-09-01"]),
+        ("2021-11-15 to 2022-01-15", ["2022-01-15", "2021-12-15", "2021-11-15"]),
+        ("2022-01-01 to 2022-02-15 by month", ["2022-02-01", "2022-01-01"]),
+        (
+            "2022-01-03 to 2022-01-24 by week",
+            ["2022-01-24", "2022-01-17", "2022-01-10", "2022-01-03"],
+        ),
+        ("2022-09-01 to 2022-09-01 by week", ["2022-09-01"]),
+    ],
+)
+def test_dates_are_those_generate_cohort_extracts(date_range, dates):
+    assert index_date_range(date_range) == dates
+
+
+@pytest.mark.parametrize(
+    "date_range, message",
+    [
+        ("2022-02-01 to 2022-01-01", "end cannot be earlier"),
+        ("2022-01-01 to 2022-02-01 by day", "Unknown time period"),
+        ("01/01/2022", "Invalid date range"),
+    ],
+)
+def test_bad_ranges_are_errors(date_range, message):
+    with pytest.raises(ValueError, match=message):
+        index_date_range(date_range)
+
+
+def test_references_are_renamed():
+    names = {"age": "age_20200101", "asthma_date": "asthma_date_20200101"}
+    query_args = {
+        "category_definitions": {"young": "age < 40 AND NOT page", "old": "DEFAULT"},
+        "source": "asthma_date",
+        "between": ["asthma_date", "asthma_date + 1 year"],
+        "return_expectations": {"category": {"ratios": {"age": 1}}},
+    }
+    assert rename_references(query_args, names) == {
+        "category_definitions": {
+            "young": "age_20200101 < 40 AND NOT page",
+            "old": "DEFAULT",
+        },
+        "source": "asthma_date_20200101",
+        "between": ["asthma_date_20200101", "asthma_date_20200101 + 1 year"],
+        # not an argument which refers to variables
+        "return_expectations": {"category": {"ratios": {"age": 1}}},
+    }
+
+
+def test_each_date_refers_to_its_own_variables():
+    definitions, columns = combined_definitions(study(), DATES[:2])
+    for index_date, names in columns.items():
+        suffix = index_date.replace("-", "")
+        _, ageband = definitions[names["ageband"]]
+        assert ageband["category_definitions"]["young"] == f"age_{suffix} < 40"
+        _, month = definitions[names["asthma_month"]]
+        assert month["source"] == f"asthma_date_{suffix}"
+        _, population = definitions[names["population"]]
+        assert population["category_definitions"][1] == (
+            f"registered_{suffix} AND age_{suffix} >= 18"
+        )
+        _, asthma_date = definitions[names["asthma_date"]]
+        assert asthma_date["between"][1] == index_date
+
+
+def test_definitions_the_same_at_every_date_are_extracted_once():
+    definitions, columns = combined_definitions(study(), DATES)
+    for name in ["sex", "ever_asthma"]:
+        assert {names[name] for names in columns.values()} == {f"{name}_20200301"}
+    for name in ["age", "asthma_date", "ageband", "asthma_month", "population"]:
+        assert len({names[name] for names in columns.values()}) == 3
+    assert "sex_20200201" not in definitions
+    assert len(definitions) == 2 + 3 * 6 + 1
+
+
+def test_the_population_is_the_union_of_the_dates():
+    definitions, columns = combined_definitions(study(), DATES)
+    query_type, query_args = definitions["population"]
+    assert query_type == "categorised_as"
+    assert query_args["category_definitions"] == {
+        1: "population_20200301 OR population_20200201 OR population_20200101",
+        0: "DEFAULT",
+    }
+    # each date's population is written, to split the extract by
+    for names in columns.values():
+        assert not definitions[names["population"]][1]["hidden"]
+
+
+@pytest.mark.parametrize("max_columns", [14, 15, 20, 27, 100])
+def test_batches_fit_in_max_columns(max_columns):
+    dates = ["2020-04-01", *DATES]
+    split = list(batches(study(), dates, max_columns))
+    assert sum(split, []) == dates
+    for i, batch in enumerate(split):
+        definitions, _ = combined_definitions(study(), batch)
+        assert len(output_columns(definitions)) <= max_columns
+        if i + 1 < len(split):
+            # the next date would not have fitted
+            definitions, _ = combined_definitions(study(), batch + split[i + 1][:1])
+            assert len(output_columns(definitions)) > max_columns
+
+
+def test_a_single_date_too_wide_is_a_batch_of_its_own():
+    assert list(batches(study(), DATES, max_columns=1)) == [[date] for date in DATES]
+
+
+def test_split_by_date_gives_each_dates_cohort():
+    _, columns = combined_definitions(study(), DATES[:2])
+    df = pd.DataFrame(
+        {
+            "patient_id": ["1", "2", "3", "4"],
+            "population_20200301": ["1", "0", "1", "0"],
+            "population_20200201": ["0", "1", "1", "0"],
+            "age_20200301": ["40", "50", "60", "70"],
+            "age_20200201": ["39", "49", "59", "69"],
+            "sex_20200301": ["M", "F", "M", "F"],
+            "ever_asthma_20200301": ["0", "1", "0", "0"],
+            "asthma_date_20200301": ["2020-01", "", "", ""],
+            "asthma_date_20200201": ["", "2019-12", "", ""],
+            "ageband_20200301": ["old", "old", "old", "old"],
+            "ageband_20200201": ["young", "old", "old", "old"],
+            "asthma_month_20200301": ["2020-01", "", "", ""],
+            "asthma_month_20200201": ["", "2019-12", "", ""],
+        }
+    )
+    cohorts = split_by_date(df, columns)
+    assert list(cohorts) == DATES[:2]
+    header = [
+        "patient_id",
+        "age",
+        "sex",
+        "ever_asthma",
+        "asthma_date",
+        "ageband",
+        "asthma_month",
+    ]
+    assert cohorts["2020-03-01"].values.tolist() == [
+        ["1", "40", "M", "0", "2020-01", "old", "2020-01"],
+        ["3", "60", "M", "0", "", "old", ""],
+    ]
+    assert cohorts["2020-02-01"].values.tolist() == [
+        ["2", "49", "F", "1", "2019-12", "old", "2019-12"],
+        ["3", "59", "M", "0", "", "old", ""],
+    ]
+    for cohort in cohorts.values():
+        assert list(cohort.columns) == header
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dates import MISSING_DATE
+from onset import MAX_FLAGS, OnsetFlags
+
+INDEX_DAY = 22889  # 2022-09-01
+
+
+def random_days(flags, patients, seed=0):
+    """Day numbers around the index day, a quarter of them missing."""
+    rng = np.random.default_rng(seed)
+    days = rng.integers(INDEX_DAY - 3, INDEX_DAY + 3, (flags, patients), np.int32)
+    days[rng.random((flags, patients)) < 0.25] = MISSING_DATE
+    return days
+
+
+def test_flags_are_set_on_or_before_the_index_day():
+    # cr_dataset_1a.do: gen `var'_index = 1 if `var' <= 22889
+    flags = OnsetFlags(["a", "b"])
+    days = np.array(
+        [[INDEX_DAY - 1, INDEX_DAY, INDEX_DAY + 1, MISSING_DATE], [0, 0, 0, 0]],
+        np.int32,
+    )
+    bits = flags.pack(days, INDEX_DAY)
+    assert bits.dtype == np.uint64
+    np.testing.assert_array_equal(flags.values(bits, "a"), [1, 1, np.nan, np.nan])
+    np.testing.assert_array_equal(flags.values(bits, "b"), [1, 1, 1, 1])
+    assert flags.any(bits, "a", "b").all()
+
+
+@pytest.mark.parametrize("n", [1, 7, 8, 9, 35, 63, MAX_FLAGS])
+def test_every_flag_unpacks_to_its_own_dates(n):
+    names = [f"flag{i}" for i in range(n)]
+    flags = OnsetFlags(names)
+    days = random_days(n, 200)
+    bits = flags.pack(days, INDEX_DAY)
+    for i, name in enumerate(names):
+        np.testing.assert_array_equal(flags.any(bits, name), days[i] <= INDEX_DAY)
+
+
+def test_flags_move_with_their_patients():
+    names = [f"flag{i}" for i in range(MAX_FLAGS)]
+    flags = OnsetFlags(names)
+    days = random_days(MAX_FLAGS, 500, seed=1)
+    df = pd.DataFrame({"patient_id": np.arange(500)})
+    df["onset"] = flags.pack(days, INDEX_DAY)
+    # drop and reorder rows, as the cohort drops and sorts do
+    df = df[df["patient_id"] % 3 != 0].sample(frac=1, random_state=2)
+    rows = df["patient_id"].values
+    for i, name in enumerate(names):
+        np.testing.assert_array_equal(
+            flags.any(df["onset"].values, name), days[i, rows] <= INDEX_DAY
+        )
+
+
+def test_any_combines_flags():
+    flags = OnsetFlags(["a", "b", "c"])
+    days = np.array(
+        [[0, MISSING_DATE, MISSING_DATE], [MISSING_DATE, 0, MISSING_DATE]] + [[0] * 3],
+        np.int32,
+    )
+    bits = flags.pack(days, INDEX_DAY)
+    assert flags.any(bits, "a", "b").tolist() == [True, True, False]
+    assert flags.any(bits, "c").tolist() == [True, True, True]
+    assert flags.any(bits).tolist() == [False, False, False]
+
+
+def test_at_most_64_flags_fit():
+    OnsetFlags([f"flag{i}" for i in range(MAX_FLAGS)])
+    with pytest.raises(ValueError, match="at most 64 flags"):
+        OnsetFlags([f"flag{i}" for i in range(MAX_FLAGS + 1)])
+
+
+def test_one_row_of_days_per_flag():
+    with pytest.raises(ValueError, match="one row of day numbers per flag"):
+        OnsetFlags(["a", "b"]).pack(np.zeros((3, 4), np.int32), INDEX_DAY)
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cr_dataset_1a import wave_test
+from dates import MISSING_DATE, day_number, to_datetime64
+from periods import WAVES, PeriodBins, Scheme, scheme_cuts, stata_values
+
+# the day numbers of cr_dataset_1b.do's wave_test
+DO_FILE_CUTS = [21997, 22066, 22165, 22394, 22428, 22628]
+
+
+def do_file_wave(day):
+    """cr_dataset_1b.do's chain of
+    `replace wave_test=i if first_positive_test_date>=X & first_positive_test_date<Y`.
+    """
+    wave = np.nan
+    for i, (start, end) in enumerate(zip(DO_FILE_CUTS, DO_FILE_CUTS[1:])):
+        if start <= day < end:
+            wave = i
+    if day >= DO_FILE_CUTS[-1] and day != MISSING_DATE:
+        wave = 5
+    return wave
+
+
+def boundary_days():
+    """Each cut, the days either side of it, and dates far from any."""
+    days = {0, 21000, 23500, MISSING_DATE}
+    for cut in DO_FILE_CUTS:
+        days.update({cut - 1, cut, cut + 1})
+    return np.array(sorted(days), np.int32)
+
+
+def test_waves_start_on_the_do_files_days():
+    assert scheme_cuts(WAVES) == DO_FILE_CUTS
+
+
+def test_boundary_dates_are_in_the_do_files_wave():
+    days = boundary_days()
+    waves = stata_values(PeriodBins([WAVES]).periods(days)["wave"])
+    np.testing.assert_array_equal(waves, [do_file_wave(day) for day in days])
+
+
+def test_a_wave_starts_on_its_first_day():
+    days = np.array(DO_FILE_CUTS, np.int32)
+    assert PeriodBins([WAVES]).periods(days)["wave"].tolist() == [0, 1, 2, 3, 4, 5]
+    assert PeriodBins([WAVES]).periods(days - 1)["wave"].tolist() == [
+        -1,
+        0,
+        1,
+        2,
+        3,
+        4,
+    ]
+
+
+def test_wave_test_matches_the_do_file():
+    days = boundary_days()
+    df = pd.DataFrame(
+        {"first_positive_test_date": to_datetime64(days), "covid_vax": pd.NaT}
+    )
+    df = wave_test(df)
+    np.testing.assert_array_equal(
+        df["wave_test"].values, [do_file_wave(day) for day in days]
+    )
+
+
+MONTHS = Scheme(
+    "month",
+    [("Mar 2020", "2020-03-01"), ("Apr 2020", "2020-04-01")],
+    end="2020-05-01",
+)
+
+
+def test_schemes_binned_together_agree_with_each_alone():
+    days = np.concatenate(
+        [boundary_days(), [day_number("2020-04-30"), day_number("2020-05-01")]]
+    ).astype(np.int32)
+    together = PeriodBins([WAVES, MONTHS]).periods(days)
+    assert (
+        together["wave"].tolist() == PeriodBins([WAVES]).periods(days)["wave"].tolist()
+    )
+    assert (
+        together["month"].tolist()
+        == PeriodBins([MONTHS]).periods(days)["month"].tolist()
+    )
+    # the last period ends the day before the scheme's end
+    assert together["month"][-2:].tolist() == [1, -1]
+
+
+def test_a_matrix_of_days_is_binned_in_one_search():
+    days = np.array([[21997, MISSING_DATE], [22627, 22628]], np.int32)
+    assert PeriodBins([WAVES]).periods(days)["wave"].tolist() == [[0, -1], [4, 5]]
+
+
+def test_labels():
+    bins = PeriodBins([WAVES])
+    assert list(bins.labels("wave", np.array([0, 5, -1]))) == [
+        "Wave 1, 23/03/20-30/05/20",
+        "Easing 3, 14/12/21-01/09/22",
+        None,
+    ]
+
+
+def test_periods_out_of_order_are_refused():
+    scheme = Scheme("bad", [("b", "2020-02-01"), ("a", "2020-01-01")])
+    with pytest.raises(ValueError, match="not in date order"):
+        PeriodBins([scheme])
@@ -0,0 +1,111 @@
+import re
+
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+from cohortextractor.tpp_backend import TPPBackend
+
+import population_first
+import shared_scans
+from population_first import PopulationFirstStudyDefinition, PopulationFirstTPPBackend
+
+ASTHMA = codelist(["X1", "X2"], system="ctv3")
+COPD = codelist(["Y1"], system="ctv3")
+
+VARIABLES = dict(
+    population=patients.satisfying(
+        "age >= 18 AND registered",
+        registered=patients.registered_as_of("2020-01-01"),
+    ),
+    age=patients.age_as_of("2020-01-01"),
+    asthma=patients.with_these_clinical_events(
+        ASTHMA, returning="binary_flag", between=["2020-01-01", "2020-06-30"]
+    ),
+    copd=patients.with_these_clinical_events(COPD, returning="binary_flag"),
+    asthma_count=patients.with_these_clinical_events(
+        ASTHMA, returning="number_of_matches_in_period"
+    ),
+)
+
+POPULATION_VARIABLES = {"population", "age", "registered"}
+
+
+@pytest.fixture
+def population_first_set(monkeypatch):
+    monkeypatch.setattr(population_first, "POPULATION_FIRST", True)
+
+
+def queries(study_class=PopulationFirstStudyDefinition):
+    study = study_class(**VARIABLES)
+    return study.create_backend("mssql://localhost/dummy", dummy_data=True).queries
+
+
+def column_queries(queries):
+    """{variable: the query which selects it into its own table}."""
+    return {
+        re.search(r"-- Query for (\w+)", query).group(1): query
+        for query in queries
+        if "-- Query for" in query
+    }
+
+
+def ids_table(queries):
+    (table,) = set(re.findall(r"INTO (#tmp\d+_population_ids)", "\n".join(queries)))
+    return table
+
+
+def test_queries_are_unchanged_without_population_first():
+    url = "mssql://localhost/dummy"
+    assert PopulationFirstStudyDefinition.get_backend_for_database_url(url) is (
+        TPPBackend
+    )
+    assert queries() == queries(StudyDefinition)
+
+
+def test_queries_are_unchanged_without_a_categorised_population(
+    population_first_set,
+):
+    study = PopulationFirstStudyDefinition(
+        **{**VARIABLES, "population": patients.all()}
+    )
+    backend = study.create_backend("mssql://localhost/dummy", dummy_data=True)
+    assert isinstance(backend, PopulationFirstTPPBackend)
+    plain = StudyDefinition(**{**VARIABLES, "population": patients.all()})
+    assert (
+        backend.queries
+        == plain.create_backend("mssql://localhost/dummy", dummy_data=True).queries
+    )
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_the_ids_are_selected_before_their_first_use(
+    monkeypatch, population_first_set, shared
+):
+    monkeypatch.setattr(shared_scans, "SHARED_SCANS", shared)
+    all_queries = queries()
+    table = ids_table(all_queries)
+    uses = [i for i, query in enumerate(all_queries) if table in query]
+    assert f"INTO {table}" in all_queries[uses[0]]
+    # the population's own variables come before it, and don't use it
+    selected = column_queries(all_queries[: uses[0]])
+    assert set(selected) == POPULATION_VARIABLES - {"population"}
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_every_other_column_is_limited_to_the_population(
+    monkeypatch, population_first_set, shared
+):
+    monkeypatch.setattr(shared_scans, "SHARED_SCANS", shared)
+    all_queries = queries()
+    table = ids_table(all_queries)
+    filtered = f"WHERE t.patient_id IN (SELECT patient_id FROM {table})"
+    scans = [query for query in all_queries if "-- Shared scan" in query]
+    assert len(scans) == shared
+    for scan in scans:
+        assert f"INNER JOIN {table} ON {table}.patient_id" in scan
+    for name, query in column_queries(all_queries).items():
+        if name in POPULATION_VARIABLES:
+            assert table not in query
+        elif shared and name in ("asthma", "copd"):
+            assert "_shared_scan\n" in query and filtered not in query
+        else:
+            assert filtered in query, name
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from cr_dataset_1a import AGEGROUP, ETHNICITY, REGION, SEX, SMOKING, destring
+from recode import lookup, lookup_codes, recode_table, unrecoded
+from study_parameters import categories
+
+# Stata can't run here, so the expected values are read off the `replace`
+# chains of cr_dataset_1a.do (lines 119-179) rather than produced by it: each
+# row is (input, value the do-file gives it), with . where it gives none
+DO_FILE = {
+    "smoking_status": [("N", 1), ("E", 2), ("S", 3), ("M", None), ("", None)],
+    "ageband_broad": [
+        ("18-39", 1),
+        ("40-49", 2),
+        ("50-59", 3),
+        ("60-69", 4),
+        ("70-79", 5),
+        ("80+", 6),
+        ("0", None),
+    ],
+    "sex": [("M", 1), ("F", 2)],
+    "ethnicity": [
+        ("White", 1),
+        ("Black", 2),
+        ("South Asian", 3),
+        ("Mixed", 4),
+        ("Other", 5),
+        ("Missing", None),
+    ],
+    "region": [
+        ("East Midlands", 1),
+        ("East", 2),
+        ("London", 3),
+        ("North East", 4),
+        ("North West", 5),
+        ("South East", 6),
+        ("West Midlands", 7),
+        ("Yorkshire and The Humber", 8),
+        # as study_definition.py spells them, which the do-file doesn't match
+        ("Yorkshire and the Humber", None),
+        ("East of England", None),
+    ],
+    # substr(stp, 8, 2), destring
+    "stp": [("E54000005", 5), ("E54000027", 27), ("E54000049", 49), ("", None)],
+}
+
+RECODES = {
+    "smoking_status": SMOKING,
+    "ageband_broad": AGEGROUP,
+    "sex": SEX,
+    "ethnicity": ETHNICITY,
+    "region": REGION,
+}
+
+# the columns destring() leaves them in
+RECODED = {
+    "smoking_status": "smok_status",
+    "ageband_broad": "agegroup",
+    "sex": "sex",
+    "ethnicity": "eth5",
+    "region": "region",
+    "stp": "stp",
+}
+
+
+def expected(rows):
+    return np.array([np.nan if value is None else value for _, value in rows])
+
+
+def test_recode_table_follows_the_declared_categories():
+    table = recode_table("smoking_status", SMOKING)
+    assert table.categories == categories("smoking_status") == ["S", "E", "N", "M"]
+    np.testing.assert_array_equal(table.values, [3, 2, 1, np.nan])
+
+
+def test_recoded_but_undeclared_categories_are_appended():
+    table = recode_table("region", REGION)
+    assert table.categories[: len(table.declared)] == categories("region")
+    assert table.categories[len(table.declared) :] == [
+        "East",
+        "Yorkshire and The Humber",
+    ]
+
+
+def test_lookup_matches_the_do_file():
+    for variable, codes in RECODES.items():
+        rows = DO_FILE[variable]
+        column = pd.Series([label for label, _ in rows], dtype=object)
+        values, _ = lookup(recode_table(variable, codes), column)
+        np.testing.assert_array_equal(values.values, expected(rows), variable)
+
+
+def test_values_outside_the_table_are_missing_and_reported():
+    table = recode_table("smoking_status", SMOKING)
+    column = pd.Series(["N", "X", "M", "M", "", "X"], dtype=object)
+    values, codes = lookup(table, column)
+    np.testing.assert_array_equal(values.values, [1, np.nan] + [np.nan] * 4)
+    assert list(codes) == [2, -1, 3, 3, -1, -1]
+    assert unrecoded(table, column, codes) == [
+        'smoking_status: 2 rows of "M" left missing '
+        "(declared in study_definition.py, not recoded)",
+        'smoking_status: 2 rows of "X" left missing (neither declared nor recoded)',
+        'smoking_status: 1 rows of "" left missing (neither declared nor recoded)',
+    ]
+
+
+def test_misspelt_categories_are_reported_even_without_rows():
+    table = recode_table("region", REGION)
+    column = pd.Series(["London"], dtype=object)
+    _, codes = lookup(table, column)
+    assert unrecoded(table, column, codes) == [
+        'region: "East" is recoded but not declared in study_definition.py (0 rows)',
+        'region: "Yorkshire and The Humber" is recoded but not declared '
+        "in study_definition.py (0 rows)",
+    ]
+
+
+def test_lookup_codes_recodes_labels_not_rows():
+    table = recode_table("sex", SEX)
+    values = lookup_codes(table, np.array([1, 0, -1, 1]), ["M", "F"])
+    np.testing.assert_array_equal(values, [2, 1, np.nan, 2])
+
+
+def test_destring_matches_the_do_file():
+    n = max(len(rows) for rows in DO_FILE.values())
+    df = pd.DataFrame(
+        {
+            variable: [rows[i % len(rows)][0] for i in range(n)]
+            for variable, rows in DO_FILE.items()
+        }
+    )
+    df["index_of_multiple_deprivation"] = np.arange(n) * 100.0
+    df = destring(df)
+    assert len(df) == n
+    for variable, rows in DO_FILE.items():
+        want = np.resize(expected(rows), n)
+        np.testing.assert_array_equal(df[RECODED[variable]].values, want, variable)
@@ -0,0 +1,189 @@
+import os
+import subprocess
+
+import pytest
+
+import run_actions
+from run_actions import depth, run_actions as run, with_needs
+
+# a fake project: each action writes output/<name>.csv, from the outputs of
+# the actions it needs
+ACTIONS = {
+    "extract": {},
+    "dataset": {"needs": ["extract"]},
+    "dataset_b": {"needs": ["extract", "dataset"]},
+    "table": {"needs": ["dataset"]},
+    "table_b": {"needs": ["dataset_b"]},
+    "households": {"needs": ["extract"]},
+}
+
+
+def project(**changes):
+    actions = {}
+    for name, action in ACTIONS.items():
+        actions[name] = {
+            **action,
+            "run": f"python:latest analysis/make.py {name}",
+            "outputs": {"highly_sensitive": {"output": f"output/{name}.csv"}},
+        }
+        actions[name].update(changes.get(name, {}))
+    return actions
+
+
+class FakeRunner:
+    """Stands in for subprocess.run, running each action by writing its
+    command and inputs to its output, unless it is one of `failing`."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.ran = []
+
+    def __call__(self, args, **kwargs):
+        name = args[-1]
+        self.ran.append(name)
+        if name in self.failing:
+            return subprocess.CompletedProcess(args, 1)
+        inputs = "".join(
+            open(f"output/{need}.csv").read() for need in ACTIONS[name].get("needs", [])
+        )
+        with open(f"output/{name}.csv", "w") as f:
+            f.write(f"{' '.join(args[3:])}({inputs})")
+        return subprocess.CompletedProcess(args, 0)
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output").mkdir()
+
+
+def statuses(actions, runner, monkeypatch, force=False, max_workers=2):
+    monkeypatch.setattr(run_actions.subprocess, "run", runner)
+    results = run(actions, with_needs(actions, list(actions)), max_workers, force)
+    return {name: status for name, (status, _, _) in results.items()}
+
+
+def test_with_needs_adds_every_action_needed():
+    actions = project()
+    assert with_needs(actions, ["table"]) == {"table", "dataset", "extract"}
+    assert with_needs(actions, ["table_b", "households"]) == {
+        "table_b",
+        "dataset_b",
+        "dataset",
+        "extract",
+        "households",
+    }
+    with pytest.raises(ValueError, match="unknown action"):
+        with_needs(actions, ["missing"])
+
+
+def test_cycles_are_found():
+    actions = project(extract={"needs": ["table"]})
+    # with_needs still finishes, and depth reports the cycle
+    assert with_needs(actions, ["table"]) == {"table", "dataset", "extract"}
+    with pytest.raises(ValueError, match="form a cycle"):
+        depth(actions, "table")
+    with pytest.raises(ValueError, match="form a cycle"):
+        run(actions, with_needs(actions, ["table"]), 2)
+
+
+def test_depth_is_the_longest_chain_of_needs():
+    actions = project()
+    assert {name: depth(actions, name) for name in actions} == {
+        "extract": 0,
+        "dataset": 1,
+        "dataset_b": 2,
+        "table": 2,
+        "table_b": 3,
+        "households": 1,
+    }
+
+
+def test_every_action_runs_after_its_needs(workspace, monkeypatch):
+    runner = FakeRunner()
+    assert set(statuses(project(), runner, monkeypatch).values()) == {"ran"}
+    for name, action in ACTIONS.items():
+        for need in action.get("needs", []):
+            assert runner.ran.index(need) < runner.ran.index(name)
+
+
+def test_dependants_of_a_failed_action_are_not_run(workspace, monkeypatch):
+    runner = FakeRunner(failing=["dataset"])
+    assert statuses(project(), runner, monkeypatch) == {
+        "extract": "ran",
+        "dataset": "failed",
+        "dataset_b": "not run",
+        "table": "not run",
+        "table_b": "not run",
+        "households": "ran",
+    }
+    assert sorted(runner.ran) == ["dataset", "extract", "households"]
+    assert "dataset" not in run_actions.read_state()
+
+
+def test_an_action_which_cannot_start_has_failed(workspace, monkeypatch):
+    def missing(args, **kwargs):
+        raise FileNotFoundError(2, "No such file or directory", args[0])
+
+    assert set(statuses(project(), missing, monkeypatch).values()) == {
+        "failed",
+        "not run",
+    }
+    assert "No such file" in open("logs/extract.log").read()
+
+
+def test_an_action_without_its_outputs_has_failed(workspace, monkeypatch):
+    actions = project(
+        households={"outputs": {"highly_sensitive": {"output": "output/other.csv"}}}
+    )
+    assert statuses(actions, FakeRunner(), monkeypatch)["households"] == "failed"
+
+
+def test_unchanged_actions_are_skipped(workspace, monkeypatch):
+    statuses(project(), FakeRunner(), monkeypatch)
+    runner = FakeRunner()
+    assert set(statuses(project(), runner, monkeypatch).values()) == {"unchanged"}
+    assert runner.ran == []
+
+
+def test_a_changed_command_runs_the_action_and_its_dependants(workspace, monkeypatch):
+    statuses(project(), FakeRunner(), monkeypatch)
+    actions = project(
+        dataset_b={"run": "python:latest analysis/make.py --again dataset_b"}
+    )
+    assert statuses(actions, FakeRunner(), monkeypatch) == {
+        "extract": "unchanged",
+        "dataset": "unchanged",
+        "households": "unchanged",
+        "table": "unchanged",
+        # its output changed with the command, so what needs it runs again
+        "dataset_b": "ran",
+        "table_b": "ran",
+    }
+
+
+def test_edited_outputs_run_the_action_again(workspace, monkeypatch):
+    statuses(project(), FakeRunner(), monkeypatch)
+    with open("output/dataset.csv", "a") as f:
+        f.write(" edited")
+    runner = FakeRunner()
+    result = statuses(project(), runner, monkeypatch)
+    # running dataset again restores its output, so what needs it is unchanged
+    assert runner.ran == ["dataset"]
+    assert result["dataset"] == "ran"
+
+
+def test_missing_outputs_run_the_action_again(workspace, monkeypatch):
+    statuses(project(), FakeRunner(), monkeypatch)
+    os.remove("output/households.csv")
+    runner = FakeRunner()
+    assert statuses(project(), runner, monkeypatch)["households"] == "ran"
+    assert runner.ran == ["households"]
+
+
+def test_force_runs_everything(workspace, monkeypatch):
+    statuses(project(), FakeRunner(), monkeypatch)
+    runner = FakeRunner()
+    result = statuses(project(), runner, monkeypatch, force=True)
+    assert set(result.values()) == {"ran"}
+    assert sorted(runner.ran) == sorted(ACTIONS)
@@ -0,0 +1,187 @@
+import random
+import re
+import sqlite3
+
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+from cohortextractor.tpp_backend import TPPBackend
+
+import shared_scans
+from shared_scans import (
+    SharedScanStudyDefinition,
+    SharedScanTPPBackend,
+    check_cohortextractor_version,
+)
+
+ASTHMA = codelist(["X1", "X2"], system="ctv3")
+COPD = codelist(["Y1"], system="ctv3")
+ASTHMA_AGAIN = codelist(["X2", "X1"], system="ctv3")
+
+VARIABLES = dict(
+    asthma=patients.with_these_clinical_events(
+        ASTHMA, returning="binary_flag", between=["2020-01-01", "2020-06-30"]
+    ),
+    first_copd=patients.with_these_clinical_events(
+        COPD,
+        returning="date",
+        date_format="YYYY-MM-DD",
+        find_first_match_in_period=True,
+        between=["2020-03-01", "2020-12-31"],
+    ),
+    last_asthma=patients.with_these_clinical_events(
+        ASTHMA_AGAIN,
+        returning="date",
+        date_format="YYYY-MM-DD",
+        find_last_match_in_period=True,
+        on_or_before="2020-03-31",
+    ),
+    recent_copd=patients.with_these_clinical_events(
+        COPD, returning="binary_flag", on_or_after="2020-07-01"
+    ),
+    ever_asthma=patients.with_these_clinical_events(
+        ASTHMA, returning="date", date_format="YYYY-MM-DD"
+    ),
+)
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    monkeypatch.setattr(shared_scans, "SHARED_SCANS", True)
+
+
+def backend(study_class, **variables):
+    study = study_class(population=patients.all(), **variables)
+    return study.create_backend("mssql://localhost/dummy", dummy_data=True)
+
+
+def scan_query(**variables):
+    queries = backend(SharedScanStudyDefinition, **variables).queries
+    (query,) = [query for query in queries if "-- Shared scan" in query]
+    return query
+
+
+def group_by(query):
+    return re.search(r"GROUP BY (.*)", query).group(1).strip()
+
+
+def test_shared_scans_are_opt_in():
+    assert not shared_scans.SHARED_SCANS
+    url = "mssql://localhost/dummy"
+    assert SharedScanStudyDefinition.get_backend_for_database_url(url) is TPPBackend
+    plain = backend(StudyDefinition, **VARIABLES).queries
+    assert backend(SharedScanStudyDefinition, **VARIABLES).queries == plain
+
+
+def test_other_cohortextractors_are_refused(shared):
+    check_cohortextractor_version()
+    with pytest.raises(RuntimeError, match="unset SHARED_SCANS"):
+        check_cohortextractor_version("1.94.0")
+
+
+def test_scan_sql(shared):
+    queries = backend(SharedScanStudyDefinition, **VARIABLES).queries
+    assert isinstance(
+        backend(SharedScanStudyDefinition, **VARIABLES), SharedScanTPPBackend
+    )
+    # one tag per codelist, ASTHMA and ASTHMA_AGAIN being the same codes
+    assert "('X1', 'c0'),\n('X2', 'c0'),\n('Y1', 'c1')" in queries[1]
+    scan = queries[2]
+    assert scan.count("FROM CodedEvent") == 1
+    assert "-- Shared scan for asthma, first_copd, last_asthma" in scan
+    cuts = ["2020-01-01", "2020-03-01", "2020-04-01", "2020-07-01", "2021-01-01"]
+    assert re.findall(r"< '([\d-]+)'", scan) == cuts * 2
+    readers = {
+        re.search(r"-- Query for (\w+)", query).group(1): query
+        for query in queries
+        if "-- Query for" in query and "FROM #tmp2_shared_scan" in query
+    }
+    assert {
+        name: re.search(
+            r"tag = '(\w+)'\s+AND segment BETWEEN (\d) AND (\d)", query
+        ).groups()
+        for name, query in readers.items()
+    } == {
+        "asthma": ("c0", "1", "3"),
+        "first_copd": ("c1", "2", "4"),
+        "last_asthma": ("c0", "0", "2"),
+        "recent_copd": ("c1", "4", "5"),
+        "ever_asthma": ("c0", "0", "5"),
+    }
+    assert "MIN(first_date)" in readers["first_copd"]
+    assert "MAX(last_date)" in readers["last_asthma"]
+
+
+def test_scan_with_no_cuts_does_not_group_by_a_constant(shared):
+    query = scan_query(
+        asthma=patients.with_these_clinical_events(ASTHMA, returning="binary_flag"),
+        copd=patients.with_these_clinical_events(
+            COPD, returning="date", find_first_match_in_period=True
+        ),
+    )
+    assert "0 AS segment" in query
+    assert "segment" not in group_by(query)
+    assert not re.search(r",\s*\d+\s*$", group_by(query))
+
+
+def test_scan_with_cuts_groups_by_segment(shared):
+    query = scan_query(
+        asthma=patients.with_these_clinical_events(
+            ASTHMA, returning="binary_flag", between=["2020-01-01", "2020-12-31"]
+        ),
+        copd=patients.with_these_clinical_events(COPD, returning="binary_flag"),
+    )
+    assert group_by(query).endswith("ELSE 2 END")
+
+
+# SQL Server to SQLite, for the statements of the queries above
+DIALECT = [
+    (r"CAST\('(\d{4})(\d\d)(\d\d)' AS date\)", r"'\1-\2-\3'"),
+    (r"CAST\((\w+) AS date\)", r"date(\1)"),
+    (r"COLLATE Latin1_General_BIN", ""),
+    (r"VARCHAR\(MAX\)", "TEXT"),
+    (r"(?s)SELECT(.*?)INTO (#\w+)\s+FROM", r"CREATE TABLE \2 AS SELECT\1 FROM"),
+    (r"#", "tmp_"),
+]
+
+
+def run_on_sqlite(queries, events):
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE Patient (Patient_ID INTEGER)")
+    db.execute(
+        "CREATE TABLE CodedEvent (Patient_ID INTEGER, CTV3Code TEXT, "
+        "ConsultationDate TEXT)"
+    )
+    db.executemany("INSERT INTO Patient VALUES (?)", [(i,) for i in range(50)])
+    db.executemany("INSERT INTO CodedEvent VALUES (?, ?, ?)", events)
+    # the last query is the final join
+    for query in queries[:-1]:
+        if "CLUSTERED INDEX" in query:
+            continue
+        for pattern, replacement in DIALECT:
+            query = re.sub(pattern, replacement, query)
+        db.execute(query)
+    return {
+        name: sorted(db.execute(f"SELECT * FROM tmp_{name}"))
+        for name in ["population", *VARIABLES]
+    }
+
+
+def test_shared_scans_agree_with_the_plain_backend(shared):
+    rng = random.Random(5)
+    boundaries = ["2019-12-31", "2020-01-01", "2020-06-30", "2020-07-01"]
+    events = [
+        (
+            rng.randrange(50),
+            rng.choice(["X1", "X2", "Y1", "Z9"]),
+            rng.choice(boundaries + [f"2020-{month:02}-15" for month in range(1, 13)])
+            + rng.choice([" 00:00:00", " 23:59:59"]),
+        )
+        for _ in range(400)
+    ]
+    plain = backend(StudyDefinition, **VARIABLES).queries
+    shared = backend(SharedScanStudyDefinition, **VARIABLES).queries
+    assert not any("-- Shared scan" in query for query in plain)
+    assert any("-- Shared scan" in query for query in shared)
+    expected = run_on_sqlite(plain, events)
+    assert all(expected.values())
+    assert run_on_sqlite(shared, events) == expected
@@ -0,0 +1,134 @@
+import os
+
+import pytest
+from cohortextractor import patients
+
+import codelists
+from variables import EventDate, clinical_event_dates
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+# the variables of the hand-written study definition the tables replaced, in
+# the order it defined them (hidden variables before the one using them, and
+# the population last)
+BASELINE_VARIABLES = [
+    "in_cis",
+    "covid_vax",
+    "sex",
+    "age",
+    "ageband_broad",
+    "ethnicity_sus",
+    "eth",
+    "ethnicity",
+    "died",
+    "is_registered_with_tpp",
+    "is_registered_with_tpp_feb2020",
+    "has_follow_up",
+    "household_id",
+    "household_size",
+    "index_of_multiple_deprivation",
+    "stp",
+    "urban",
+    "region",
+    "severely_clinically_vulnerable",
+    "date_severely_clinically_vulnerable",
+    "less_vulnerable",
+    "shielded",
+    "first_positive_test_date",
+    "bmi",
+    "bmi_date_measured",
+    "most_recent_smoking_code",
+    "ever_smoked",
+    "smoking_status",
+    "smoking_status_date",
+    "hypertension",
+    "bp_sys",
+    "bp_sys_date_measured",
+    "bp_dias",
+    "bp_dias_date_measured",
+    "dementia",
+    "diabetes",
+    "hba1c_mmol_per_mol",
+    "hba1c_mmol_per_mol_date",
+    "hba1c_percentage",
+    "hba1c_percentage_date",
+    "copd",
+    "other_respiratory",
+    "recent_asthma_code",
+    "asthma_code_ever",
+    "copd_code_ever",
+    "prednisolone_last_year",
+    "asthma",
+    "cancer",
+    "haem_cancer",
+    "permanent_immunodeficiency",
+    "transplant",
+    "asplenia",
+    "aplastic_anaemia",
+    "temporary_immunodeficiency",
+    "heart_failure",
+    "stroke",
+    "tia",
+    "myocardial_infarct",
+    "heart_disease",
+    "pad",
+    "vte",
+    "af",
+    "systemic_lupus_erythematosus",
+    "rheumatoid_arthritis",
+    "psoriasis",
+    "chronic_liver_disease",
+    "other_neuro",
+    "creatinine",
+    "creatinine_date",
+    "dialysis",
+    "population",
+]
+
+
+@pytest.fixture
+def study(monkeypatch):
+    if not hasattr(patients, "with_an_ons_cis_record"):
+        pytest.skip("this cohortextractor has no with_an_ons_cis_record")
+    monkeypatch.chdir(ROOT)
+    from study_definition import study
+
+    return study
+
+
+def test_study_defines_the_baseline_variables_in_order(study):
+    assert list(study.covariate_definitions) == BASELINE_VARIABLES
+
+
+def test_event_dates_are_the_hand_written_variables(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    generated = clinical_event_dates(
+        EventDate("hypertension", "hypertension_codes", (None, "index_date"), "first"),
+        EventDate(
+            "aplastic_anaemia",
+            "aplastic_codes",
+            ("index_date - 365 days", "index_date"),
+            "last",
+            earliest="2019-03-01",
+        ),
+    )
+    assert generated == {
+        "hypertension": patients.with_these_clinical_events(
+            codelists.hypertension_codes,
+            on_or_before="index_date",
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+            return_expectations={"date": {"latest": "index_date"}},
+        ),
+        "aplastic_anaemia": patients.with_these_clinical_events(
+            codelists.aplastic_codes,
+            between=["index_date - 365 days", "index_date"],
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "2019-03-01", "latest": "index_date"}
+            },
+        ),
+    }
@@ -0,0 +1,77 @@
+import csv
+
+import numpy as np
+import pandas as pd
+
+from tabulate import Section, Table, tabulate
+
+# in_cis for 25 patients, not for 15
+TABLE = Table(
+    input=None,
+    output=None,
+    stratum="in_cis",
+    headings=("In CIS", "Not in CIS"),
+    sections=[
+        Section("cons", 1, 1),
+        Section("sex", 1, 2),
+        Section("smok_status", 1, 3, missing=True),
+    ],
+    prepare=None,
+)
+
+
+def cohort():
+    nan = np.nan
+    return pd.DataFrame(
+        {
+            "in_cis": [1] * 25 + [0] * 15,
+            "sex": [1] * 20 + [2] * 5 + [1] * 3 + [2] * 12,
+            "smok_status": [1] * 12
+            + [2] * 10
+            + [nan] * 3
+            + [1] * 4
+            + [3] * 8
+            + [nan] * 3,
+            "bmi": [nan] * 7 + [25.0] * 33,
+        }
+    )
+
+
+def test_table_of_known_counts(tmp_path):
+    path = tmp_path / "table.csv"
+    assert tabulate(cohort(), TABLE, path) == 8
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    redacted = ["", "redacted"]
+    assert rows == [
+        [
+            "variable",
+            "level",
+            "totaln",
+            "totalpercent",
+            "incisn",
+            "incispercent",
+            "notincisn",
+            "notincispercent",
+        ],
+        # totals: 40 patients, stratum totals 25 and 15
+        ["cons", "==1", "40", " (100.0)", "25", " (100.00)", "15", " (100.00)"],
+        # 23, 20, 3 round to 25, 20, 5
+        ["sex", "==1", "25", " (62.5)", "20", " (80.00)", *redacted],
+        # 17, 5, 12 round to 15, 5, 10
+        ["sex", "==2", "15", " (37.5)", *redacted, "10", " (66.67)"],
+        ["smok_status", "==1", "15", " (37.5)", "10", " (40.00)", *redacted],
+        ["smok_status", "==2", "10", " (25.0)", "10", " (40.00)", *redacted],
+        ["smok_status", "==3", "10", " (25.0)", *redacted, "10", " (66.67)"],
+        # 6 missing, 3 and 3
+        ["smok_status", ">=.", *redacted, *redacted, *redacted],
+        # the footnote's numbers are not rounded
+        [
+            "*missing could be included in 'not obese' (n = 7 (17.5%); "
+            "missing smoking could be included in 'never smoker' (n = 6 (15.0%))",
+            "",
+            *redacted,
+            *redacted,
+            *redacted,
+        ],
+    ]